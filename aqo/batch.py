@@ -0,0 +1,198 @@
+# Optimizing a whole workload at once, from a file of queries, a MySQL slow
+# query log or a pg_stat_statements export.
+
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+from dataclasses import asdict
+import io
+import re
+import threading
+import time
+
+from typing import Iterable, Iterator, Optional
+
+from aqo.config import Config
+from aqo.db import ConnectionPool, returns_rows
+from aqo.llm import LLM
+from aqo.sql import fingerprint, split_statements
+from aqo.workload import Statement
+
+WORKLOAD_FORMATS = ["auto", "queries", "slow_log", "pg_stat_statements"]
+
+
+def parse_queries(text: str) -> list[tuple[str, int, float]]:
+    return [(query, 1, 0.0) for query in split_statements(text)]
+
+
+_SLOW_LOG_QUERY_TIME = re.compile(r"^# Query_time:\s*([\d.]+)")
+_SLOW_LOG_NOISE = re.compile(
+    r"^(SET timestamp=\d+;|use \S+;|\S+, Version: .*|Tcp port: .*|Time\s+Id\s+Command\s+Argument)$",
+    re.IGNORECASE,
+)
+
+
+def parse_slow_log(text: str) -> list[tuple[str, int, float]]:
+    """
+    Parse a MySQL slow query log. Each entry is a block of `#` header lines,
+    one of which has the query time, followed by the statement.
+    """
+
+    entries = []
+    query_time = 0.0
+    lines: list[str] = []
+
+    def flush():
+        query = "\n".join(lines).strip().rstrip(";").strip()
+        if query:
+            entries.append((query, 1, query_time))
+        lines.clear()
+
+    for line in text.splitlines():
+        if line.startswith("#"):
+            if lines:
+                flush()
+            match = _SLOW_LOG_QUERY_TIME.match(line)
+            if match:
+                query_time = float(match.group(1))
+        elif not _SLOW_LOG_NOISE.match(line.strip()):
+            lines.append(line)
+    flush()
+
+    return entries
+
+
+def parse_pg_stat_statements(text: str) -> list[tuple[str, int, float]]:
+    """
+    Parse a CSV export of pg_stat_statements, e.g. from
+    `\\copy (SELECT * FROM pg_stat_statements) TO 'file.csv' CSV HEADER`.
+    Only the `query` column is required.
+    """
+
+    entries = []
+    for row in csv.DictReader(io.StringIO(text)):
+        calls = int(row.get("calls") or 1)
+        # The column was renamed in Postgres 13, and is in milliseconds.
+        total_ms = row.get("total_exec_time") or row.get("total_time") or 0
+        entries.append((row["query"], calls, float(total_ms) / 1000))
+    return entries
+
+
+def detect_format(text: str) -> str:
+    first_line = text.lstrip().split("\n", 1)[0].lower()
+    if "# query_time:" in text.lower() or "# user@host:" in text.lower():
+        return "slow_log"
+    if "query" in [column.strip().strip('"') for column in first_line.split(",")]:
+        return "pg_stat_statements"
+    return "queries"
+
+
+def load_workload(text: str, format: str = "auto") -> list[Statement]:
+    """
+    Parse a workload and deduplicate it by fingerprint, ordered by total time
+    and then by number of calls.
+    """
+
+    if format == "auto":
+        format = detect_format(text)
+
+    if format == "slow_log":
+        entries = parse_slow_log(text)
+    elif format == "pg_stat_statements":
+        entries = parse_pg_stat_statements(text)
+    elif format == "queries":
+        entries = parse_queries(text)
+    else:
+        raise ValueError(f"Workload format must be one of {WORKLOAD_FORMATS}.")
+
+    statements: dict[str, Statement] = {}
+    for query, calls, total_time in entries:
+        key = fingerprint(query)
+        statement = statements.setdefault(key, Statement(query=query, fingerprint=key))
+        statement.calls += calls
+        statement.total_time += total_time
+
+    return sorted(
+        statements.values(), key=lambda s: (s.total_time, s.calls), reverse=True
+    )
+
+
+class RateLimiter:
+    """
+    Spaces calls out evenly so that no more than `per_minute` start in any
+    minute. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, per_minute: float):
+        self.interval = 60 / per_minute if per_minute else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class BatchOptimizer:
+    """
+    Runs EXPLAIN and LLM optimization for many statements concurrently, with
+    at most `batch_workers` in flight and every LLM request rate limited.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        pool: ConnectionPool,
+        llm: LLM,
+        replica: Optional[ConnectionPool] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        self.config = config
+        self.pool = pool
+        # EXPLAIN, schema introspection and verification go to `replica`.
+        self.replica = replica or pool
+        self.llm = llm
+        self.rate_limiter = rate_limiter or RateLimiter(
+            config.batch_requests_per_minute
+        )
+
+    def optimize(self, statement: Statement) -> dict:
+        record = asdict(statement)
+        try:
+            reads = self.replica if returns_rows(statement.query) else self.pool
+            with reads.database() as db:
+                with db.statement_timeout(db.timeout_for(None)):
+                    plan = db.explain_plan(
+                        statement.query, analyze=self.config.batch_analyze
+                    )
+                # EXPLAIN ANALYZE runs the statement, whose changes aren't
+                # kept.
+                db.conn.rollback()
+                schema = db.schema_model_for(statement.query)
+
+            advice = self.llm.optimize_as_json(
+                schema, statement.query, plan, throttle=self.rate_limiter.wait
+            )
+            if advice.error is None:
+                self.pool.check_advice(statement.query, advice, self.replica)
+            record.update(explain=plan.digest(), advice=asdict(advice), error=None)
+        except Exception as e:
+            record.update(explain=None, advice=None, error=str(e))
+        return record
+
+    def run(self, statements: Iterable[Statement]) -> Iterator[dict]:
+        """Yield one result per statement, in order of completion."""
+
+        with ThreadPoolExecutor(max_workers=self.config.batch_workers) as executor:
+            futures = [executor.submit(self.optimize, s) for s in statements]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # If the consumer stops early, don't start anything new.
+                for future in futures:
+                    future.cancel()
@@ -0,0 +1,137 @@
+from __future__ import annotations
+from contextlib import contextmanager
+import hashlib
+import json
+import re
+import sqlite3
+import time
+
+from typing import Iterator, Optional, Union
+
+from aqo import metrics
+from aqo.config import Config
+from aqo.plan import Plan
+from aqo.sql import fingerprint
+
+# Where a plan digest's summary follows the tree. Which sections appear
+# depends on the timings and estimates, not on the plan.
+_SUMMARY = re.compile(
+    r"^(?:Planning time|Execution time|Slowest nodes|Worst row estimates)",
+    re.MULTILINE,
+)
+
+
+def plan_shape(explain_output: Union[str, Plan]) -> str:
+    """
+    Reduce a plan to its shape, dropping costs, timings, row counts and
+    literals, so that reruns of the same plan, and the plans of queries that
+    differ only in literals, hash the same.
+    """
+
+    if isinstance(explain_output, Plan):
+        return explain_output.shape()
+    summary = _SUMMARY.search(explain_output)
+    if summary is not None:
+        explain_output = explain_output[: summary.start()]
+    explain_output = re.sub(r"'(?:[^']|'')*'", "", explain_output)
+    return re.sub(r"\d+(\.\d+)?", "", explain_output)
+
+
+class AdviceCache:
+    """
+    An on-disk cache of LLM optimization advice, stored in SQLite.
+
+    Entries are keyed on the query's fingerprint, a hash of the schema, the
+    shape of the query plan and the model, so literal-only variants of a query
+    share advice while schema changes, plan changes or a different model don't.
+    The query the advice was given for is kept with it, so that a variant can
+    tell whether the suggested rewrite is its own.
+    Entries expire after `cache_ttl` seconds, and the least recently used
+    entries are evicted past `cache_max_entries`.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.path = config.cache_path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS advice (
+                    key TEXT PRIMARY KEY,
+                    advice TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS advice_accessed_at ON advice (accessed_at)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per operation keeps the cache safe to use from the
+        # server's worker threads.
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def key(
+        self,
+        database_schema: str,
+        slow_query: str,
+        explain_output: Union[str, Plan],
+        model: str,
+    ) -> str:
+        parts = [
+            fingerprint(slow_query),
+            hashlib.sha256(database_schema.encode()).hexdigest(),
+            hashlib.sha256(plan_shape(explain_output).encode()).hexdigest(),
+            model,
+        ]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def get(self, keys: list[str]) -> Optional[dict]:
+        """Return the advice under the first of `keys` that has any."""
+
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT key, advice, created_at FROM advice WHERE key IN "
+                f"({', '.join('?' * len(keys))})",
+                keys,
+            ).fetchall()
+            if not rows:
+                metrics.cache_lookup("advice", hit=False)
+                return None
+
+            key, advice, created_at = min(rows, key=lambda row: keys.index(row[0]))
+            if now - created_at > self.config.cache_ttl:
+                conn.execute("DELETE FROM advice WHERE key = ?", (key,))
+                metrics.cache_lookup("advice", hit=False)
+                return None
+
+            conn.execute("UPDATE advice SET accessed_at = ? WHERE key = ?", (now, key))
+        metrics.cache_lookup("advice", hit=True)
+        return json.loads(advice)
+
+    def put(self, key: str, advice: dict) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO advice VALUES (?, ?, ?, ?)",
+                (key, json.dumps(advice), now, now),
+            )
+            conn.execute(
+                "DELETE FROM advice WHERE created_at < ?",
+                (now - self.config.cache_ttl,),
+            )
+            conn.execute(
+                """
+                DELETE FROM advice WHERE key IN (
+                    SELECT key FROM advice ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.config.cache_max_entries,),
+            )
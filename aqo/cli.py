@@ -1,77 +1,180 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
 import readline  # noqa: F401
+import sys
+import time
 
 from cmd import Cmd
 from tabulate import tabulate
+from typing import Optional
 
+from aqo.batch import WORKLOAD_FORMATS, BatchOptimizer, load_workload
 from aqo.config import Config
-from aqo.db import Database
+from aqo.db import Database, DatabaseRegistry
+from aqo.history import History
 from aqo.llm import LLM
+from aqo.verify import Verification
+from aqo.whatif import IndexEvaluation
+from aqo.workload import RANKINGS, Statement
 
 
 class AQOShell(Cmd):
     prompt = "aqo>>> "
     intro = "Welcome to the AQO shell. Type help or ? to list commands.\n"
 
-    def __init__(self, config_file_path: str):
+    def __init__(self, config_file_path: str, database: Optional[str] = None):
         super().__init__()
-        self.config = Config(config_file_path)
+        self.config = load_config(config_file_path, database)
+        # The result session and offset that "more" continues from.
+        self.page: tuple[Optional[str], int] = (None, 0)
         self.intro = (
             f"Welcome to the AQO shell. Type help or ? to list commands.\n"
             f"Config points to databse '{self.config.db_name}' on {self.config.db_type} at {self.config.db_host}:{self.config.db_port}.\n"
         )
 
+    def cancellable(self, function, *args):
+        """
+        Call `function` in a worker thread, so that Ctrl-C can cancel the
+        statement it is running on the server instead of leaving it behind.
+        """
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(function, *args)
+            try:
+                return future.result()
+            except KeyboardInterrupt:
+                print("Cancelling query...")
+                self.database.cancel()
+                return future.result()
+
     def default(self, args):
         if args == "EOF":
             return self.do_quit(args)
 
         try:
-            results, headers, rowcount, query_time = self.database.query(args)
-            max_results = 50
-            results_as_list = []
-
-            for row in results:
-                results_as_list.append(list(row))
-                if len(results_as_list) >= max_results:
-                    break
-            results = results_as_list
+            result = self.cancellable(self.database.query_as_json, args)
+            if result.query_error is not None:
+                raise Exception(result.query_error)
 
-            print(f"{rowcount} rows returned in {query_time} seconds.")
-            if rowcount > max_results:
-                print(f"Showing first {max_results} results.")
-            print(tabulate(results, headers=headers, tablefmt="rounded_outline"))
+            if result.rowcount == -1:
+                print(f"Query ran in {result.query_time} seconds.")
+            elif result.rowcount_estimated:
+                print(
+                    f"About {result.rowcount} rows returned in {result.query_time} seconds."
+                )
+            else:
+                print(
+                    f"{result.rowcount} rows returned in {result.query_time} seconds."
+                )
+            if result.message is not None:
+                print(result.message)
+            if result.headers:
+                if result.rowcount == -1 or result.rowcount > len(result.results):
+                    print(f"Showing first {len(result.results)} results.")
+                    if result.session_id is not None:
+                        print('Type "more" to see the next page.')
+                print(
+                    tabulate(
+                        result.results,
+                        headers=result.headers,
+                        tablefmt="rounded_outline",
+                    )
+                )
+                self.page = (result.session_id, len(result.results))
 
-            query_explain = self.database.explain_query(args)
+            # The plan from the run above is reused rather than running the
+            # query again.
+            plan = self.cancellable(self.database.plan_for, args)
             print("Query EXPLAIN results:")
-            print(query_explain)
+            print(plan.digest())
 
             print("Checking for optimizations...")
 
-            result = self.llm.optimize(self.database.schema, args, query_explain)
-            try:
-                advice = json.loads(result["choices"][0]["message"]["content"])
-                print("LLM advice:")
-                print("-" * 10)
-                print("Query-related advice:")
-                print(advice["query_advice"])
-                print("Suggested query:")
-                print(advice["query_optimized"])
-                print("-" * 10)
-                print("Schema-related advice:")
-                print(advice["schema_advice"])
-                print("Suggested schema:")
-                print(advice["schema_optimized"])
-                print("-" * 10)
-                print("Explanation for advice:")
-                print(advice["explanation"])
-            except:
+            advice = self.llm.optimize_as_json(
+                self.database.schema_model_for(args), args, plan
+            )
+            if advice.error is not None:
                 print("Error: LLM provided bad response.")
+                return
+
+            print("LLM advice:")
+            print("-" * 10)
+            print("Query-related advice:")
+            print(advice.query_advice)
+            print("Suggested query:")
+            print(advice.query_optimized)
+            print("-" * 10)
+            print("Schema-related advice:")
+            print(advice.schema_advice)
+            print("Suggested schema:")
+            print(advice.schema_optimized)
+            print("-" * 10)
+            print("Explanation for advice:")
+            print(advice.explanation)
+            if advice.omitted:
+                print("Left out of the prompt to fit the model's context:")
+                for omitted in advice.omitted:
+                    print(f"  {omitted}")
+
+            if self.config.verify_enabled or self.config.whatif_enabled:
+                print("-" * 10)
+                print("Measuring suggestions...")
+            self.database.check_advice(args, advice)
+            if advice.verification is not None:
+                self.print_verification(advice.verification)
+            if advice.index_evaluation is not None:
+                self.print_index_evaluation(advice.index_evaluation)
 
         except Exception as e:
             print("Error: Query failed to run. Details of error: ")
             print(e)
 
+    def print_verification(self, verification: Verification):
+        if verification.error is not None:
+            print(f"Verification failed: {verification.error}")
+            return
+
+        assert verification.original and verification.optimized
+        if verification.equivalent:
+            print("Suggested query returns the same results.")
+        else:
+            print("Warning: suggested query returns different results!")
+        rows = [
+            [name, t.cold, t.warm_p50, t.warm_p95, t.rowcount]
+            for name, t in [
+                ("original", verification.original),
+                ("suggested", verification.optimized),
+            ]
+        ]
+        print(
+            tabulate(
+                rows,
+                headers=["", "cold (s)", "warm p50 (s)", "warm p95 (s)", "rows"],
+                tablefmt="rounded_outline",
+            )
+        )
+        if verification.speedup is not None:
+            print(f"Measured speedup: {verification.speedup:.2f}x")
+
+    def print_index_evaluation(self, evaluation: IndexEvaluation):
+        if evaluation.error is not None:
+            print(f"Index evaluation failed: {evaluation.error}")
+            return
+
+        print(
+            f"Estimated cost: {evaluation.baseline_cost} without the suggested "
+            f"indexes, {evaluation.hypothetical_cost} with them."
+        )
+        if evaluation.sample_rows is not None:
+            print(
+                f"Estimated on copies of the tables with up to "
+                f"{evaluation.sample_rows} rows each, not the real statistics."
+            )
+        print(f"Indexes used by the new plan: {len(evaluation.used_indexes)}")
+        for index in evaluation.used_indexes:
+            print(f"  {index}")
+
     def do_help(self, args):
         """List available commands with "help" or detailed help with "help cmd"."""
 
@@ -81,6 +184,30 @@ class AQOShell(Cmd):
 
         super().do_help(args)
 
+    def do_more(self, _):
+        """Show the next page of the last query's results."""
+        session_id, offset = self.page
+        session = self.database.results.get(session_id) if session_id else None
+        if session is None:
+            print("No more results to show.")
+            return
+
+        try:
+            rows = session.rows(offset, self.config.query_preview_limit)
+        except FileNotFoundError:
+            print("No more results to show.")
+            return
+        if not rows:
+            if not session.complete:
+                print(f"Only the first {session.rowcount} results were kept.")
+            else:
+                print("No more results to show.")
+            return
+
+        print(f"Showing results {offset + 1} to {offset + len(rows)}.")
+        print(tabulate(rows, headers=session.headers, tablefmt="rounded_outline"))
+        self.page = (session_id, offset + len(rows))
+
     def do_schema(self, _):
         """Show the database schema."""
         print(self.database.schema)
@@ -101,12 +228,113 @@ class AQOShell(Cmd):
         self.database = Database(self.config)
         self.llm = LLM(self.config)
         print("Connected to database.")
-        while True:
-            try:
-                super(AQOShell, self).cmdloop(intro="")
-                break
-            except KeyboardInterrupt:
-                print("^C")
+        try:
+            while True:
+                try:
+                    super(AQOShell, self).cmdloop(intro="")
+                    break
+                except KeyboardInterrupt:
+                    print("^C")
+        finally:
+            self.database.close()
+            self.llm.providers.close()
+
+
+def load_config(config_file_path: str, database: Optional[str] = None) -> Config:
+    """Load the config, with the `db_*` settings of `database` if given."""
+    config = Config(config_file_path)
+    return config.for_database(database) if database else config
+
+
+def run_batch(
+    config_file_path: str,
+    workload_path: str,
+    format: str,
+    output_path: str | None,
+    database: Optional[str] = None,
+) -> None:
+    config = Config(config_file_path)
+    with open(workload_path) as workload_file:
+        statements = load_workload(workload_file.read(), format)
+
+    registry = DatabaseRegistry(config)
+    try:
+        _optimize_statements(config, registry, database, statements, output_path)
+    finally:
+        registry.close()
+
+
+def run_top(
+    config_file_path: str,
+    by: str,
+    limit: int,
+    output_path: str | None,
+    database: Optional[str] = None,
+) -> None:
+    config = Config(config_file_path)
+    registry = DatabaseRegistry(config)
+    try:
+        with registry.pool(database).database() as db:
+            statements = db.top_statements(by, limit)
+        _optimize_statements(config, registry, database, statements, output_path)
+    finally:
+        registry.close()
+
+
+def run_regressions(
+    config_file_path: str, days: float, database: Optional[str] = None
+) -> None:
+    config = load_config(config_file_path, database)
+    history = History(config)
+    try:
+        changes = history.plan_changes(since=time.time() - days * 86400)
+    finally:
+        history.close()
+    if not changes:
+        print(f"No plans have changed in the last {days:g} days.")
+        return
+
+    rows = [
+        [
+            change["fingerprint"],
+            change["query"][:60],
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(change["changed_at"])),
+            change["old_mean_time"],
+            change["new_mean_time"],
+        ]
+        for change in changes
+    ]
+    print(
+        tabulate(
+            rows,
+            headers=["Fingerprint", "Query", "Changed", "Old mean (s)", "New mean (s)"],
+            tablefmt="rounded_outline",
+        )
+    )
+
+
+def _optimize_statements(
+    config: Config,
+    registry: DatabaseRegistry,
+    database: Optional[str],
+    statements: list[Statement],
+    output_path: str | None,
+) -> None:
+    print(f"Optimizing {len(statements)} distinct statements.", file=sys.stderr)
+    optimizer = BatchOptimizer(
+        config,
+        registry.pool(database),
+        LLM(config),
+        replica=registry.replica(database),
+    )
+    output = open(output_path, "w") if output_path else sys.stdout
+    try:
+        for record in optimizer.run(statements):
+            output.write(json.dumps(record, default=str) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
 
 
 def main():
@@ -117,16 +345,77 @@ def main():
         type=str,
         help="command to run",
         nargs="?",
-        choices=["shell", "serve"],
+        choices=["shell", "serve", "batch", "top", "regressions"],
         default="shell",
         const="shell",
     )
+    parser.add_argument(
+        "--workload",
+        type=str,
+        help="batch: file of queries, MySQL slow query log or pg_stat_statements CSV",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=WORKLOAD_FORMATS,
+        default="auto",
+        help="batch: format of the workload file",
+    )
+    parser.add_argument(
+        "--by",
+        type=str,
+        choices=RANKINGS,
+        default="total_time",
+        help="top: how to rank the statements the database has seen",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="top: number of statements to optimize",
+    )
+    parser.add_argument(
+        "--days",
+        type=float,
+        default=7,
+        help="regressions: how far back to look for plan changes",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="batch, top: JSONL file to write results to, instead of stdout",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        help="id of the database to use, from [databases], instead of the default",
+    )
     args = parser.parse_args()
 
+    if args.database is not None:
+        try:
+            Config(args.config_file_path).for_database(args.database)
+        except ValueError as e:
+            parser.error(str(e))
+
     if args.command == "serve":
         from aqo.server import start_server
 
         start_server(args.config_file_path)
+    elif args.command == "batch":
+        if args.workload is None:
+            parser.error("the batch command requires --workload")
+        run_batch(
+            args.config_file_path,
+            args.workload,
+            args.format,
+            args.output,
+            args.database,
+        )
+    elif args.command == "top":
+        run_top(args.config_file_path, args.by, args.limit, args.output, args.database)
+    elif args.command == "regressions":
+        run_regressions(args.config_file_path, args.days, args.database)
     else:
-        shell = AQOShell(args.config_file_path)
+        shell = AQOShell(args.config_file_path, args.database)
         shell.cmdloop()
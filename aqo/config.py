@@ -1,5 +1,19 @@
+import copy
+import os
+import re
 import tomllib
 
+# How /query and the shell run a query: "preview" runs it once for a preview of
+# the rows and plans it without running it again, "instrumented" runs it once
+# under EXPLAIN ANALYZE for timing, row count and plan but no rows, and
+# "estimate" only plans it.
+QUERY_MODES = ["preview", "instrumented", "estimate"]
+
+# The id of the database in the [database] table, as opposed to the named ones
+# in [databases.<id>].
+DEFAULT_DATABASE = "default"
+DATABASE_ID = re.compile(r"[A-Za-z0-9_-]+")
+
 
 class Config:
     def __init__(self, config_path):
@@ -7,76 +21,392 @@ class Config:
             config_data = tomllib.load(config_file)
 
         self.database = config_data.get("database", {})
+        self.databases = config_data.get("databases", {})
         self.ai_model = config_data.get("ai_model", {})
+        self.fallback_models = config_data.get("fallback_models", [])
+        self.hedge = config_data.get("hedge", {})
+        self.response = config_data.get("response", {})
+        self.query = config_data.get("query", {})
+        self.pool = config_data.get("pool", {})
+        self.storage = config_data.get("storage", {})
+        self.cache = config_data.get("cache", {})
+        self.prompt = config_data.get("prompt", {})
+        self.schema = config_data.get("schema", {})
+        self.batch = config_data.get("batch", {})
+        self.verify = config_data.get("verify", {})
+        self.whatif = config_data.get("whatif", {})
+        self.history = config_data.get("history", {})
+        self.results = config_data.get("results", {})
+        self.jobs = config_data.get("jobs", {})
         self._validate_database_config()
         self._validate_ai_model_config()
+        self._validate_hedge_config()
+        self._validate_response_config()
+        self._validate_query_config()
+        self._validate_pool_config()
+        self._validate_cache_config()
+        self._validate_prompt_config()
+        self._validate_schema_config()
+        self._validate_batch_config()
+        self._validate_verify_config()
+        self._validate_whatif_config()
+        self._validate_history_config()
+        self._validate_results_config()
+        self._validate_jobs_config()
+
+        # Every configured database's table, by id. Everything else reads the
+        # settings of one of them, the default one unless a view on another is
+        # made with `for_database`.
+        self.database_tables = self._database_tables()
+        self.db_id = self.default_database
+        self.database = self.database_tables[self.db_id]
+
+    def _database_tables(self):
+        tables = {DEFAULT_DATABASE: self.database} if self.database else {}
+        tables.update(self.databases)
+        return tables
 
     def _validate_database_config(self):
-        if self.database is None:
+        if not isinstance(self.databases, dict):
+            raise ValueError("'databases' must be a table of tables.")
+        if not self.database and not self.databases:
             raise ValueError("Database configuration is missing.")
+        if self.database:
+            self._validate_database(self.database, "Database")
+            if "replica_of" in self.database:
+                raise ValueError("Replicas must be defined under [databases].")
+
+        tables = self._database_tables()
+
+        for database_id, database in self.databases.items():
+            if not DATABASE_ID.fullmatch(database_id):
+                raise ValueError(
+                    f"Database id '{database_id}' may only contain letters, "
+                    "digits, '_' and '-'."
+                )
+            if database_id == DEFAULT_DATABASE and self.database:
+                raise ValueError(
+                    f"Database id '{DEFAULT_DATABASE}' is taken by [database]."
+                )
+            self._validate_database(database, f"Database '{database_id}'")
+
+            primary = database.get("replica_of")
+            if primary is not None and (
+                primary not in tables or "replica_of" in tables[primary]
+            ):
+                raise ValueError(
+                    f"Database '{database_id}' 'replica_of' must be the id of a "
+                    "database that is not itself a replica."
+                )
+            if primary is not None and database["type"] != tables[primary].get("type"):
+                raise ValueError(
+                    f"Database '{database_id}' must have the same type as its primary."
+                )
+
+        if all("replica_of" in database for database in tables.values()):
+            raise ValueError("At least one database must not be a replica.")
+
+    def _validate_database(self, database, label):
+        if not isinstance(database, dict):
+            raise ValueError(f"{label} configuration must be a table.")
 
         required_fields = ["type", "host", "port", "name", "username", "password"]
         for field in required_fields:
-            if field not in self.database:
-                raise ValueError(f"Database configuration is missing '{field}' field.")
-        if self.database["type"] not in ["mysql", "postgres"]:
-            raise ValueError("Database type must be 'mysql' or 'postgres'.")
+            if field not in database:
+                raise ValueError(f"{label} configuration is missing '{field}' field.")
+        if database["type"] not in ["mysql", "postgres"]:
+            raise ValueError(f"{label} type must be 'mysql' or 'postgres'.")
         try:
-            port = int(self.database["port"])
+            port = int(database["port"])
             if port <= 0 or port > 65535:
                 raise ValueError("Port number must be between 1 and 65535.")
         except ValueError:
-            raise ValueError("Database 'port' must be an integer.")
+            raise ValueError(f"{label} 'port' must be an integer.")
 
-        if not isinstance(self.database["host"], str) or not self.database["host"]:
-            raise ValueError("Database 'host' must be a non-empty string.")
+        if not isinstance(database["host"], str) or not database["host"]:
+            raise ValueError(f"{label} 'host' must be a non-empty string.")
 
     def _validate_ai_model_config(self):
         if self.ai_model is None:
             raise ValueError("AI model configuration is missing.")
+        self._validate_model(self.ai_model)
+
+        if not isinstance(self.fallback_models, list):
+            raise ValueError("'fallback_models' must be an array of tables.")
+        for model in self.fallback_models:
+            self._validate_model(model)
 
+    def _validate_model(self, model):
         required_fields = ["provider", "model_name"]
         for field in required_fields:
-            if field not in self.ai_model:
+            if field not in model:
                 raise ValueError(f"AI model configuration is missing '{field}' field.")
 
         external_api_providers = ["openai", "anthropic"]
         local_api_providers = ["ollama"]
-        if (
-            self.ai_model["provider"]
-            not in external_api_providers + local_api_providers
-        ):
+        if model["provider"] not in external_api_providers + local_api_providers:
             raise ValueError(
                 "AI model provider must be one of 'openai', 'anthropic', or 'ollama'."
             )
 
-        if self.ai_model["provider"] in external_api_providers:
-            if "api_key" not in self.ai_model:
+        if model["provider"] in external_api_providers:
+            if "api_key" not in model:
                 raise ValueError(
                     "API key must be provided when using an external API provider."
                 )
 
-            if "api_base" in self.ai_model and "api_version" in self.ai_model:
-                if (
-                    not isinstance(self.ai_model["api_base"], str)
-                    or not self.ai_model["api_base"]
-                ):
+            if "api_base" in model and "api_version" in model:
+                if not isinstance(model["api_base"], str) or not model["api_base"]:
                     raise ValueError(
                         "API base must be a non-empty string when provided."
                     )
                 if (
-                    not isinstance(self.ai_model["api_version"], str)
-                    or not self.ai_model["api_version"]
+                    not isinstance(model["api_version"], str)
+                    or not model["api_version"]
                 ):
                     raise ValueError(
                         "API version must be a non-empty string when provided."
                     )
-        if self.ai_model["provider"] in local_api_providers:
-            if "api_base" not in self.ai_model:
+        if model["provider"] in local_api_providers:
+            if "api_base" not in model:
                 raise ValueError(
                     "API base must be provided when using a local API provider."
                 )
 
+        if not isinstance(model.get("json_mode", False), bool):
+            raise ValueError("AI model 'json_mode' must be a boolean.")
+
+        max_input_tokens = model.get("max_input_tokens", 1)
+        if not isinstance(max_input_tokens, int) or max_input_tokens <= 0:
+            raise ValueError("AI model 'max_input_tokens' must be a positive integer.")
+
+    def _validate_hedge_config(self):
+        delay = self.hedge.get("delay", 5)
+        if not isinstance(delay, (int, float)) or delay < 0:
+            raise ValueError("Hedge 'delay' must be a non-negative number of seconds.")
+
+        failure_threshold = self.hedge.get("failure_threshold", 3)
+        if not isinstance(failure_threshold, int) or failure_threshold <= 0:
+            raise ValueError("Hedge 'failure_threshold' must be a positive integer.")
+
+        cooldown = self.hedge.get("cooldown", 60)
+        if not isinstance(cooldown, (int, float)) or cooldown <= 0:
+            raise ValueError("Hedge 'cooldown' must be a positive number of seconds.")
+
+    def _validate_response_config(self):
+        max_repairs = self.response.get("max_repairs", 1)
+        if not isinstance(max_repairs, int) or max_repairs < 0:
+            raise ValueError("Response 'max_repairs' must be a non-negative integer.")
+
+    def _validate_query_config(self):
+        preview_limit = self.query.get("preview_limit", 50)
+        if not isinstance(preview_limit, int) or preview_limit <= 0:
+            raise ValueError("Query 'preview_limit' must be a positive integer.")
+
+        if self.query.get("count_mode", "exact") not in ["exact", "estimate", "skip"]:
+            raise ValueError(
+                "Query 'count_mode' must be one of 'exact', 'estimate', or 'skip'."
+            )
+
+        if self.query.get("mode", "preview") not in QUERY_MODES:
+            raise ValueError(
+                "Query 'mode' must be one of 'preview', 'instrumented', or 'estimate'."
+            )
+
+        if not isinstance(self.query.get("optimize_analyze", True), bool):
+            raise ValueError("Query 'optimize_analyze' must be a boolean.")
+
+        timeout = self.query.get("statement_timeout", 0)
+        if not isinstance(timeout, (int, float)) or timeout < 0:
+            raise ValueError(
+                "Query 'statement_timeout' must be a non-negative number of seconds."
+            )
+
+        max_timeout = self.query.get("max_statement_timeout", 0)
+        if not isinstance(max_timeout, (int, float)) or max_timeout < 0:
+            raise ValueError(
+                "Query 'max_statement_timeout' must be a non-negative number of seconds."
+            )
+
+        plan_ttl = self.query.get("plan_ttl", 300)
+        if not isinstance(plan_ttl, (int, float)) or plan_ttl < 0:
+            raise ValueError(
+                "Query 'plan_ttl' must be a non-negative number of seconds."
+            )
+
+    def _validate_pool_config(self):
+        size = self.pool.get("size", 5)
+        if not isinstance(size, int) or size <= 0:
+            raise ValueError("Pool 'size' must be a positive integer.")
+
+        max_overflow = self.pool.get("max_overflow", 10)
+        if not isinstance(max_overflow, int) or max_overflow < 0:
+            raise ValueError("Pool 'max_overflow' must be a non-negative integer.")
+
+        timeout = self.pool.get("timeout", 30)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise ValueError("Pool 'timeout' must be a positive number of seconds.")
+
+    def _validate_cache_config(self):
+        if not isinstance(self.cache.get("enabled", True), bool):
+            raise ValueError("Cache 'enabled' must be a boolean.")
+
+        ttl = self.cache.get("ttl", 86400)
+        if not isinstance(ttl, (int, float)) or ttl <= 0:
+            raise ValueError("Cache 'ttl' must be a positive number of seconds.")
+
+        max_entries = self.cache.get("max_entries", 1000)
+        if not isinstance(max_entries, int) or max_entries <= 0:
+            raise ValueError("Cache 'max_entries' must be a positive integer.")
+
+    def _validate_prompt_config(self):
+        if not isinstance(self.prompt.get("slice_schema", True), bool):
+            raise ValueError("Prompt 'slice_schema' must be a boolean.")
+
+        max_tokens = self.prompt.get("max_tokens", 0)
+        if not isinstance(max_tokens, int) or max_tokens < 0:
+            raise ValueError("Prompt 'max_tokens' must be a non-negative integer.")
+
+        reserve_tokens = self.prompt.get("reserve_tokens", 1024)
+        if not isinstance(reserve_tokens, int) or reserve_tokens < 0:
+            raise ValueError("Prompt 'reserve_tokens' must be a non-negative integer.")
+
+    def _validate_schema_config(self):
+        if not isinstance(self.schema.get("persist", True), bool):
+            raise ValueError("Schema 'persist' must be a boolean.")
+
+        refresh_interval = self.schema.get("refresh_interval", 60)
+        if not isinstance(refresh_interval, (int, float)) or refresh_interval < 0:
+            raise ValueError(
+                "Schema 'refresh_interval' must be a non-negative number of seconds."
+            )
+
+    def _validate_batch_config(self):
+        workers = self.batch.get("workers", 4)
+        if not isinstance(workers, int) or workers <= 0:
+            raise ValueError("Batch 'workers' must be a positive integer.")
+
+        requests_per_minute = self.batch.get("requests_per_minute", 60)
+        if not isinstance(requests_per_minute, (int, float)) or requests_per_minute < 0:
+            raise ValueError(
+                "Batch 'requests_per_minute' must be a non-negative number."
+            )
+
+        if not isinstance(self.batch.get("analyze", False), bool):
+            raise ValueError("Batch 'analyze' must be a boolean.")
+
+    def _validate_verify_config(self):
+        if not isinstance(self.verify.get("enabled", False), bool):
+            raise ValueError("Verify 'enabled' must be a boolean.")
+
+        runs = self.verify.get("runs", 5)
+        if not isinstance(runs, int) or runs <= 0:
+            raise ValueError("Verify 'runs' must be a positive integer.")
+
+        timeout = self.verify.get("statement_timeout", 30)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise ValueError(
+                "Verify 'statement_timeout' must be a positive number of seconds."
+            )
+
+    def _validate_whatif_config(self):
+        if not isinstance(self.whatif.get("enabled", False), bool):
+            raise ValueError("Whatif 'enabled' must be a boolean.")
+
+        sample_rows = self.whatif.get("mysql_sample_rows", 100000)
+        if not isinstance(sample_rows, int) or sample_rows <= 0:
+            raise ValueError("Whatif 'mysql_sample_rows' must be a positive integer.")
+
+        shadow = self.whatif.get("mysql_shadow")
+        if shadow is not None:
+            if not isinstance(shadow, dict):
+                raise ValueError("Whatif 'mysql_shadow' must be a table.")
+            for field in ["host", "port", "username", "password"]:
+                if field not in shadow:
+                    raise ValueError(
+                        f"Whatif 'mysql_shadow' is missing '{field}' field."
+                    )
+
+    def _validate_history_config(self):
+        if not isinstance(self.history.get("enabled", True), bool):
+            raise ValueError("History 'enabled' must be a boolean.")
+
+        retention = self.history.get("retention", 2592000)
+        if not isinstance(retention, (int, float)) or retention <= 0:
+            raise ValueError(
+                "History 'retention' must be a positive number of seconds."
+            )
+
+    def _validate_results_config(self):
+        if not isinstance(self.results.get("enabled", True), bool):
+            raise ValueError("Results 'enabled' must be a boolean.")
+
+        idle_timeout = self.results.get("idle_timeout", 600)
+        if not isinstance(idle_timeout, (int, float)) or idle_timeout <= 0:
+            raise ValueError(
+                "Results 'idle_timeout' must be a positive number of seconds."
+            )
+
+        for key, default in [
+            ("max_sessions", 100),
+            ("max_rows", 100000),
+            ("max_bytes", 1073741824),
+            ("max_page_size", 1000),
+        ]:
+            value = self.results.get(key, default)
+            if not isinstance(value, int) or value <= 0:
+                raise ValueError(f"Results '{key}' must be a positive integer.")
+
+    def _validate_jobs_config(self):
+        for key, default in [
+            ("workers", 4),
+            ("max_per_user", 2),
+            ("max_queued", 1000),
+        ]:
+            value = self.jobs.get(key, default)
+            if not isinstance(value, int) or value <= 0:
+                raise ValueError(f"Jobs '{key}' must be a positive integer.")
+
+        retention = self.jobs.get("retention", 86400)
+        if not isinstance(retention, (int, float)) or retention <= 0:
+            raise ValueError("Jobs 'retention' must be a positive number of seconds.")
+
+        max_priority = self.jobs.get("max_priority", 10)
+        if not isinstance(max_priority, int) or max_priority < 0:
+            raise ValueError("Jobs 'max_priority' must be a non-negative integer.")
+
+    @property
+    def database_ids(self):
+        """The ids of the configured databases, other than read replicas."""
+        return [
+            database_id
+            for database_id, database in self.database_tables.items()
+            if "replica_of" not in database
+        ]
+
+    @property
+    def default_database(self):
+        return self.database_ids[0]
+
+    def replica_ids(self, database_id):
+        return [
+            replica_id
+            for replica_id, database in self.database_tables.items()
+            if database.get("replica_of") == database_id
+        ]
+
+    def for_database(self, database_id):
+        """
+        Return a view of the config in which the `db_*` settings are those of
+        another database. Everything else is shared.
+        """
+        if database_id not in self.database_tables:
+            raise ValueError(f"Unknown database '{database_id}'.")
+        view = copy.copy(self)
+        view.db_id = database_id
+        view.database = self.database_tables[database_id]
+        return view
+
     @property
     def db_type(self):
         return self.database.get("type")
@@ -120,3 +450,260 @@ class Config:
     @property
     def ai_api_version(self):
         return self.ai_model.get("api_version", None)
+
+    @property
+    def ai_models(self):
+        """
+        The primary model followed by the fallbacks, in the order they are
+        tried.
+        """
+        return [self.ai_model, *self.fallback_models]
+
+    @property
+    def hedge_delay(self):
+        """
+        How long to wait on a model before also asking the next one, in
+        seconds. 0 only moves on when a model fails.
+        """
+        return self.hedge.get("delay", 5)
+
+    @property
+    def hedge_failure_threshold(self):
+        return self.hedge.get("failure_threshold", 3)
+
+    @property
+    def hedge_cooldown(self):
+        return self.hedge.get("cooldown", 60)
+
+    @property
+    def response_max_repairs(self):
+        """
+        How many times to ask a model to fix a response that doesn't parse
+        before giving up.
+        """
+        return self.response.get("max_repairs", 1)
+
+    @property
+    def query_preview_limit(self):
+        return self.query.get("preview_limit", 50)
+
+    @property
+    def query_count_mode(self):
+        return self.query.get("count_mode", "exact")
+
+    @property
+    def query_mode(self):
+        return self.query.get("mode", "preview")
+
+    @property
+    def query_optimize_analyze(self):
+        """Whether to EXPLAIN ANALYZE for /optimize when no plan is cached."""
+        return self.query.get("optimize_analyze", True)
+
+    @property
+    def query_statement_timeout(self):
+        """Statement timeout in seconds for user queries, where 0 means none."""
+        return self.query.get("statement_timeout", 0)
+
+    @property
+    def query_max_statement_timeout(self):
+        """
+        The longest statement timeout a request may ask for, where 0 means
+        there is no cap.
+        """
+        return self.query.get("max_statement_timeout", 0)
+
+    @property
+    def query_plan_ttl(self):
+        return self.query.get("plan_ttl", 300)
+
+    @property
+    def pool_size(self):
+        return self.pool.get("size", 5)
+
+    @property
+    def pool_max_overflow(self):
+        return self.pool.get("max_overflow", 10)
+
+    @property
+    def pool_timeout(self):
+        return self.pool.get("timeout", 30)
+
+    @property
+    def data_dir(self):
+        """Directory for AQO's local state, created on first use."""
+        data_dir = os.path.expanduser(self.storage.get("data_dir", "~/.aqo"))
+        os.makedirs(data_dir, exist_ok=True)
+        return data_dir
+
+    @property
+    def cache_enabled(self):
+        return self.cache.get("enabled", True)
+
+    @property
+    def cache_path(self):
+        if "path" in self.cache:
+            return os.path.expanduser(self.cache["path"])
+        return os.path.join(self.data_dir, "advice.sqlite3")
+
+    @property
+    def cache_ttl(self):
+        return self.cache.get("ttl", 86400)
+
+    @property
+    def cache_max_entries(self):
+        return self.cache.get("max_entries", 1000)
+
+    @property
+    def prompt_slice_schema(self):
+        return self.prompt.get("slice_schema", True)
+
+    @property
+    def prompt_max_tokens(self):
+        """
+        The most tokens to send in a prompt, below the model's own limit,
+        where 0 means only the model's limit applies.
+        """
+        return self.prompt.get("max_tokens", 0)
+
+    @property
+    def prompt_reserve_tokens(self):
+        """Tokens of a model's context window to leave for its answer."""
+        return self.prompt.get("reserve_tokens", 1024)
+
+    @property
+    def schema_persist(self):
+        return self.schema.get("persist", True)
+
+    @property
+    def schema_refresh_interval(self):
+        return self.schema.get("refresh_interval", 60)
+
+    @property
+    def schema_cache_path(self):
+        if "cache_path" in self.schema:
+            return os.path.expanduser(self.schema["cache_path"])
+        file_name = (
+            f"schema-{self.db_type}-{self.db_host}-{self.db_port}-{self.db_name}.json"
+        )
+        return os.path.join(self.data_dir, file_name)
+
+    @property
+    def batch_workers(self):
+        return self.batch.get("workers", 4)
+
+    @property
+    def batch_requests_per_minute(self):
+        """The LLM request rate limit for batches, where 0 means unlimited."""
+        return self.batch.get("requests_per_minute", 60)
+
+    @property
+    def batch_analyze(self):
+        return self.batch.get("analyze", False)
+
+    @property
+    def verify_enabled(self):
+        return self.verify.get("enabled", False)
+
+    @property
+    def verify_runs(self):
+        return self.verify.get("runs", 5)
+
+    @property
+    def verify_statement_timeout(self):
+        return self.verify.get("statement_timeout", 30)
+
+    @property
+    def whatif_enabled(self):
+        return self.whatif.get("enabled", False)
+
+    @property
+    def whatif_mysql_sample_rows(self):
+        return self.whatif.get("mysql_sample_rows", 100000)
+
+    @property
+    def whatif_mysql_shadow(self):
+        return self.whatif.get("mysql_shadow")
+
+    @property
+    def history_enabled(self):
+        return self.history.get("enabled", True)
+
+    @property
+    def history_path(self):
+        """Where to keep the history, in a file of its own per database."""
+        if "path" in self.history:
+            path = os.path.expanduser(self.history["path"])
+        else:
+            path = os.path.join(self.data_dir, "history.sqlite3")
+        if self.db_id == DEFAULT_DATABASE:
+            return path
+        root, extension = os.path.splitext(path)
+        return f"{root}-{self.db_id}{extension}"
+
+    @property
+    def history_retention(self):
+        """How long to keep executions and advice, in seconds."""
+        return self.history.get("retention", 2592000)
+
+    @property
+    def results_enabled(self):
+        """Whether to keep query results on disk for paging through."""
+        return self.results.get("enabled", True)
+
+    @property
+    def results_path(self):
+        if "path" in self.results:
+            return os.path.expanduser(self.results["path"])
+        return os.path.join(self.data_dir, "results")
+
+    @property
+    def results_idle_timeout(self):
+        return self.results.get("idle_timeout", 600)
+
+    @property
+    def results_max_sessions(self):
+        return self.results.get("max_sessions", 100)
+
+    @property
+    def results_max_rows(self):
+        """The most rows to keep for a single query's result."""
+        return self.results.get("max_rows", 100000)
+
+    @property
+    def results_max_bytes(self):
+        """The most disk space to use for all kept results together."""
+        return self.results.get("max_bytes", 1073741824)
+
+    @property
+    def results_max_page_size(self):
+        return self.results.get("max_page_size", 1000)
+
+    @property
+    def jobs_path(self):
+        if "path" in self.jobs:
+            return os.path.expanduser(self.jobs["path"])
+        return os.path.join(self.data_dir, "jobs.sqlite3")
+
+    @property
+    def jobs_workers(self):
+        """How many jobs run at once, across all users and databases."""
+        return self.jobs.get("workers", 4)
+
+    @property
+    def jobs_max_per_user(self):
+        return self.jobs.get("max_per_user", 2)
+
+    @property
+    def jobs_max_queued(self):
+        return self.jobs.get("max_queued", 1000)
+
+    @property
+    def jobs_max_priority(self):
+        """The highest priority a client may give a job, 0 being the lowest."""
+        return self.jobs.get("max_priority", 10)
+
+    @property
+    def jobs_retention(self):
+        """How long to keep finished jobs and their results, in seconds."""
+        return self.jobs.get("retention", 86400)
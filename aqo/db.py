@@ -1,19 +1,80 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from functools import cached_property
-import subprocess
+import json
+import re
+import threading
 import time
+import uuid
 
 import mysql.connector
+import mysql.connector.pooling
 import psycopg2
+import psycopg2.pool
 
+from aqo import metrics
 from aqo.config import Config
+from aqo.formats import ColumnType
+from aqo.history import History
+from aqo.plan import Plan, PlanCache, parse_mysql, parse_postgres
+from aqo.results import ResultSession, ResultStore
+from aqo.schema import Schema, SchemaCache
+from aqo.sql import returns_rows
+from aqo.verify import Verification, verify_rewrite
+from aqo.whatif import IndexEvaluation, evaluate_indexes
+from aqo.workload import Statement, top_statements
 
-from typing import TYPE_CHECKING, Iterable, Optional, Tuple
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Tuple
 
 if TYPE_CHECKING:
     from _typeshed.dbapi import DBAPIConnection, DBAPICursor
 
+    from aqo.llm import OptimizationResult
+
+# How many rows to fetch at a time when spilling a result to disk.
+SPILL_BATCH_SIZE = 1000
+
+# Column types, as named in aqo.formats, by Postgres type OID and by MySQL
+# field type. Columns of other types are typed by their values.
+POSTGRES_TYPES = {
+    16: "boolean",
+    17: "binary",
+    20: "integer",
+    21: "integer",
+    23: "integer",
+    26: "integer",
+    114: "json",
+    700: "float",
+    701: "float",
+    1082: "date",
+    1083: "time",
+    1114: "datetime",
+    1184: "datetime",
+    1186: "interval",
+    1700: "decimal",
+    3802: "json",
+}
+POSTGRES_TIMESTAMPTZ = 1184
+MYSQL_TYPES = {
+    0: "decimal",
+    1: "integer",
+    2: "integer",
+    3: "integer",
+    4: "float",
+    5: "float",
+    7: "datetime",
+    8: "integer",
+    9: "integer",
+    10: "date",
+    # The driver returns TIME values as timedeltas.
+    11: "interval",
+    12: "datetime",
+    13: "integer",
+    14: "date",
+    246: "decimal",
+}
+
 
 @dataclass
 class QueryResult:
@@ -28,6 +89,33 @@ class QueryResult:
     query_time: float
     explain: str
     query_error: Optional[str] = None
+    rowcount_estimated: bool = False
+    plan: Optional[dict] = None
+    query_id: Optional[str] = None
+    # The rows are kept for paging through when this is set.
+    session_id: Optional[str] = None
+    # The type of each column, where the database reports one.
+    types: list[Optional[ColumnType]] = field(default_factory=list)
+    # How the query was run, one of QUERY_MODES. Only "preview" returns rows,
+    # and `message` says why the others don't.
+    mode: str = "preview"
+    message: Optional[str] = None
+
+
+@dataclass
+class ResultPreview:
+    """
+    The first few rows of a query's result, along with a row count that was
+    obtained without materializing the rest of the result set. A rowcount of
+    -1 means that counting was skipped.
+    """
+
+    headers: list[str]
+    rows: list[list]
+    rowcount: int
+    query_time: float
+    rowcount_estimated: bool = False
+    types: list[Optional[ColumnType]] = field(default_factory=list)
 
 
 class Database:
@@ -37,9 +125,13 @@ class Database:
     used irrespective of the database type.
     """
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, pool: Optional[ConnectionPool] = None):
         self.config = config
-        self.conn = self._create_connection()
+        self.pool = pool
+        if pool is not None:
+            self.conn = pool.acquire()
+        else:
+            self.conn = self._create_connection()
 
     def _create_connection(self) -> DBAPIConnection:
         db_type = self.config.db_type
@@ -88,33 +180,326 @@ class Database:
             cursor.close()
             return [], [], 0, end_time - start_time
 
-    def query_as_json(self, query: str) -> QueryResult:
+    def query_preview(
+        self,
+        query: str,
+        limit: Optional[int] = None,
+        count_mode: Optional[str] = None,
+        session: Optional[ResultSession] = None,
+    ) -> ResultPreview:
         """
-        Run a query on the DB and return the results as a JSON object.
+        Run a query on the DB and fetch only the first `limit` rows, so that
+        memory use stays flat no matter how large the result is.
+
+        `count_mode` controls how the total row count is obtained: "exact"
+        counts the remaining rows without keeping them, "estimate" asks the
+        planner and "skip" doesn't count at all. Both default to the values in
+        the config.
+
+        With a `session`, the rest of the result is fetched into it after the
+        preview, up to its caps, so that it can be paged through later.
         """
 
-        try:
+        limit = limit or self.config.query_preview_limit
+        count_mode = count_mode or self.config.query_count_mode
+
+        if not returns_rows(query):
             results, headers, rowcount, query_time = self.query(query)
-            max_n = 50
-            n = 0
+            return ResultPreview(
+                headers=headers,
+                rows=[list(row) for row in results],
+                rowcount=rowcount,
+                query_time=query_time,
+            )
 
-            results_as_list = []
-            for row in results:
-                if n >= max_n:
-                    break
+        if self.config.db_type == "postgres":
+            return self._postgres_preview(query, limit, count_mode, session)
+        else:
+            return self._mysql_preview(query, limit, count_mode, session)
 
-                results_as_list.append(list(row))
-                n += 1
+    def _postgres_preview(
+        self,
+        query: str,
+        limit: int,
+        count_mode: str,
+        session: Optional[ResultSession],
+    ) -> ResultPreview:
+        # A named cursor is a server-side cursor, so only the rows we fetch are
+        # sent to the client.
+        cursor_name = f"aqo_preview_{uuid.uuid4().hex}"
+        cursor = self.conn.cursor(name=cursor_name)  # type: ignore
+        cursor.itersize = limit
+        try:
+            start_time = time.monotonic()
+            cursor.execute(query)
+            rows = [list(row) for row in cursor.fetchmany(limit)]
+            end_time = time.monotonic()
+            headers = [column[0] for column in cursor.description]
+            types = self._column_types(cursor.description)
 
-            return QueryResult(
+            rowcount = len(rows)
+            exhausted = False
+            if session is not None:
+                exhausted = self._spill(cursor, session, headers, types, rows)
+                rowcount = session.rowcount
+            if count_mode == "exact" and not exhausted:
+                # MOVE skips over the remaining rows on the server without
+                # transferring them, and reports how many it skipped.
+                mover = self.cursor()
+                mover.execute(f'MOVE FORWARD ALL IN "{cursor_name}"')
+                rowcount += mover.rowcount
+                mover.close()
+            cursor.close()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        return self._preview(
+            query,
+            headers,
+            types,
+            rows,
+            rowcount,
+            end_time - start_time,
+            count_mode,
+            exhausted,
+        )
+
+    def _mysql_preview(
+        self,
+        query: str,
+        limit: int,
+        count_mode: str,
+        session: Optional[ResultSession],
+    ) -> ResultPreview:
+        # An unbuffered cursor reads rows off the socket as they are fetched,
+        # instead of loading the whole result set on execute.
+        cursor = self.conn.cursor(buffered=False)  # type: ignore
+        try:
+            start_time = time.monotonic()
+            cursor.execute(query)
+            rows = [list(row) for row in cursor.fetchmany(limit)]
+            end_time = time.monotonic()
+            headers = [column[0] for column in cursor.description]
+            types = self._column_types(cursor.description)
+
+            rowcount = len(rows)
+            exhausted = False
+            if session is not None:
+                exhausted = self._spill(cursor, session, headers, types, rows)
+                rowcount = session.rowcount
+            if count_mode == "exact":
+                while batch := cursor.fetchmany(1000):
+                    rowcount += len(batch)
+            else:
+                self.conn.consume_results()  # type: ignore
+            cursor.close()
+        except Exception:
+            # Rolling back also reads whatever is left of the result off the
+            # socket, so the connection can be used again.
+            self.conn.rollback()
+            raise
+
+        return self._preview(
+            query,
+            headers,
+            types,
+            rows,
+            rowcount,
+            end_time - start_time,
+            count_mode,
+            exhausted,
+        )
+
+    def _spill(
+        self,
+        cursor: DBAPICursor,
+        session: ResultSession,
+        headers: list[str],
+        types: list[Optional[ColumnType]],
+        rows: list[list],
+    ) -> bool:
+        """
+        Write the preview rows and then the rest of the result to `session`,
+        until it is full. Returns whether every row was fetched.
+        """
+
+        # Sessions only come from this database's result store.
+        results = self.results
+        assert results is not None
+        session.headers = headers
+        session.types = types
+        session.append(rows)
+        while not results.full(session):
+            size = min(
+                SPILL_BATCH_SIZE, self.config.results_max_rows - session.rowcount
+            )
+            batch = cursor.fetchmany(size)
+            session.append([list(row) for row in batch])
+            if len(batch) < size:
+                session.complete = True
+                return True
+        return False
+
+    def _preview(
+        self,
+        query: str,
+        headers: list[str],
+        types: list[Optional[ColumnType]],
+        rows: list[list],
+        rowcount: int,
+        query_time: float,
+        count_mode: str,
+        exhausted: bool,
+    ) -> ResultPreview:
+        # Once every row has been fetched the count is exact, whatever the
+        # count mode.
+        if count_mode == "estimate" and not exhausted:
+            return ResultPreview(
                 headers=headers,
-                results=results_as_list,
-                rowcount=rowcount,
+                rows=rows,
+                rowcount=self._estimate_rowcount(query),
                 query_time=query_time,
-                query_error=None,
-                explain=self.explain_query(query),
+                rowcount_estimated=True,
+                types=types,
             )
+
+        return ResultPreview(
+            headers=headers,
+            rows=rows,
+            rowcount=rowcount if count_mode == "exact" or exhausted else -1,
+            query_time=query_time,
+            types=types,
+        )
+
+    def _column_types(self, description) -> list[Optional[ColumnType]]:
+        """
+        The type of each column of a result, as reported by the driver, so
+        that it doesn't depend on which values happen to come first.
+        """
+
+        types: list[Optional[ColumnType]] = []
+        for column in description:
+            if self.config.db_type == "mysql":
+                kind = MYSQL_TYPES.get(column[1])
+                types.append(ColumnType(kind) if kind else None)
+                continue
+            kind = POSTGRES_TYPES.get(column[1])
+            types.append(
+                ColumnType(
+                    kind,
+                    # Only set for numeric columns with a declared scale.
+                    precision=column[4],
+                    scale=column[5],
+                    timezone=column[1] == POSTGRES_TIMESTAMPTZ,
+                )
+                if kind
+                else None
+            )
+        return types
+
+    def _estimate_rowcount(self, query: str) -> int:
+        """
+        Return the planner's estimate of the number of rows a query returns,
+        without running it.
+        """
+
+        if self.config.db_type == "postgres":
+            cursor = self.cursor()
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}")
+            plan = cursor.fetchone()[0]  # type: ignore
+            cursor.close()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"])
+
+        # MySQL's tabular EXPLAIN has one row per table in the join; the
+        # product of rows examined and the filtered fraction approximates the
+        # size of the output.
+        cursor = self.conn.cursor(dictionary=True)  # type: ignore
+        cursor.execute(f"EXPLAIN {query}")
+        estimate = 1.0
+        for row in cursor.fetchall():
+            estimate *= (row.get("rows") or 1) * (row.get("filtered") or 100) / 100
+        cursor.close()
+        return int(estimate)
+
+    def query_as_json(
+        self,
+        query: str,
+        mode: Optional[str] = None,
+        timeout: Optional[float] = None,
+        session_id: Optional[str] = None,
+    ) -> QueryResult:
+        """
+        Run a query on the DB and return the results as a JSON object. The
+        query is executed at most once, as set by `mode` (see QUERY_MODES),
+        which defaults to the config. The plan is kept for `plan_for`.
+        `timeout` overrides the configured statement timeout, up to its cap.
+
+        In preview mode, the rows are also kept in a result session, under
+        `session_id` or a new id, unless result sessions are disabled.
+        """
+
+        mode = mode or self.config.query_mode
+        results = self.results
+        session = None
+        if mode == "preview" and results is not None and returns_rows(query):
+            session = results.create(session_id or uuid.uuid4().hex, query)
+        try:
+            with (
+                metrics.span("db.query", mode=mode),
+                metrics.QUERY_SECONDS.time(mode=mode),
+                self.statement_timeout(self.timeout_for(timeout)),
+            ):
+                if mode == "preview":
+                    preview = self.query_preview(query, session=session)
+                    # Planning doesn't run the query again.
+                    plan = self._try_explain_plan(query)
+                    result = QueryResult(
+                        headers=preview.headers,
+                        results=preview.rows,
+                        rowcount=preview.rowcount,
+                        rowcount_estimated=preview.rowcount_estimated,
+                        query_time=preview.query_time,
+                        query_error=None,
+                        explain=plan.digest() if plan else "",
+                        plan=plan.to_dict() if plan else None,
+                        session_id=session.id if session else None,
+                        types=preview.types,
+                    )
+                else:
+                    plan = self.explain_plan(query, analyze=mode == "instrumented")
+                    result = QueryResult(
+                        headers=[],
+                        results=[],
+                        rowcount=int(
+                            (plan.root.rows_actual if plan.analyzed else None)
+                            or plan.root.rows_estimated
+                            or 0
+                        ),
+                        rowcount_estimated=not plan.analyzed,
+                        query_time=(plan.execution_time or plan.root.time or 0) / 1000,
+                        query_error=None,
+                        explain=plan.digest(),
+                        plan=plan.to_dict(),
+                        mode=mode,
+                        message=(
+                            "The query was run under EXPLAIN ANALYZE for its "
+                            "timing, row count and plan, so no rows are returned."
+                            if mode == "instrumented"
+                            else "The query was only planned, not run, so no rows "
+                            "are returned and the row count is an estimate."
+                        ),
+                    )
+            # Keep whatever the statement changed.
+            self.commit()
         except Exception as e:
+            self.conn.rollback()
+            if results is not None and session is not None:
+                results.delete(session.id)
+            if self.history is not None:
+                self.history.record_execution(query, None, None, error=str(e))
             return QueryResult(
                 headers=[],
                 results=[],
@@ -122,52 +507,574 @@ class Database:
                 query_time=0,
                 query_error=str(e),
                 explain="",
+                mode=mode,
+            )
+
+        if plan is not None:
+            self.plan_cache.put(query, plan)
+        if self.history is not None:
+            self.history.record_execution(
+                query,
+                result.query_time,
+                None if result.rowcount_estimated else result.rowcount,
+                plan,
             )
+        return result
+
+    def _try_explain_plan(self, query: str) -> Optional[Plan]:
+        # Statements like DDL can't be explained. The statement itself has run
+        # by now, so only the failed EXPLAIN is rolled back.
+        cursor = self.cursor()
+        cursor.execute("SAVEPOINT aqo_explain")
+        try:
+            return self.explain_plan(query, analyze=False)
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT aqo_explain")
+            return None
+        finally:
+            cursor.close()
+
+    def plan_for(self, query: str, timeout: Optional[float] = None) -> Plan:
+        """
+        Return the plan for a query, reusing one from a recent run of the same
+        query text instead of executing it again.
+        """
+
+        plan = self.plan_cache.get(query)
+        if plan is None:
+            with self.statement_timeout(self.timeout_for(timeout)):
+                plan = self.explain_plan(
+                    query, analyze=self.config.query_optimize_analyze
+                )
+            # EXPLAIN ANALYZE runs the statement, but optimizing it shouldn't
+            # change anything.
+            self.conn.rollback()
+            self.plan_cache.put(query, plan)
+        return plan
+
+    def timeout_for(self, requested: Optional[float]) -> float:
+        """
+        Return the statement timeout to use for a request, in seconds, capped
+        at `query_max_statement_timeout`. 0 means no timeout.
+        """
+
+        timeout = self.config.query_statement_timeout
+        if requested is not None:
+            timeout = requested
+        cap = self.config.query_max_statement_timeout
+        if cap and (not timeout or timeout > cap):
+            timeout = cap
+        return timeout
+
+    def cancel(self) -> None:
+        """
+        Cancel the statement running on this connection. Safe to call from any
+        thread while another thread is blocked on the statement.
+        """
 
-    def explain_query(self, query: str) -> str:
+        if self.config.db_type == "postgres":
+            # Equivalent to pg_cancel_backend, but sent over the cancellation
+            # channel libpq keeps for this connection, so it can't be blocked
+            # by an exhausted pool.
+            self.conn.cancel()  # type: ignore
+        else:
+            # This connection is busy, so KILL it from a fresh one.
+            killer = Database(self.config)
+            cursor = killer.cursor()
+            cursor.execute(f"KILL QUERY {int(self.conn.connection_id)}")  # type: ignore
+            cursor.close()
+            killer.close()
+
+    @contextmanager
+    def statement_timeout(self, seconds: float) -> Iterator[None]:
         """
-        Run an EXPLAIN query on the DB and return the output.
+        Limit how long statements run within a block, where 0 means no limit.
+        On MySQL, this only applies to SELECT statements. The transaction is
+        left open for the caller to commit, unless a statement fails.
         """
 
+        if not seconds:
+            yield
+            return
+
+        timeout_ms = int(seconds * 1000)
+        if self.config.db_type == "postgres":
+            variable = "statement_timeout"
+        else:
+            variable = "max_execution_time"
+
         cursor = self.cursor()
-        cursor.execute(f"EXPLAIN ANALYZE {query}")
-        explain_output = cursor.fetchall()
+        cursor.execute(f"SET SESSION {variable} = {timeout_ms}")
         cursor.close()
+        try:
+            yield
+        except BaseException:
+            # A failed or timed out statement aborts the transaction on
+            # Postgres, which has to be cleared before the setting can be
+            # reset.
+            if self.config.db_type == "postgres":
+                self.conn.rollback()
+            raise
+        finally:
+            cursor = self.cursor()
+            cursor.execute(f"SET SESSION {variable} = DEFAULT")
+            cursor.close()
+
+    def explain_query(self, query: str, analyze: bool = True) -> str:
+        """
+        Run an EXPLAIN query on the DB and return a compact digest of the plan.
+        With `analyze`, the query is actually run to get real timings.
+        """
+
+        return self.explain_plan(query, analyze).digest()
+
+    def explain_plan(self, query: str, analyze: bool = True) -> Plan:
+        """
+        Run an EXPLAIN query on the DB and parse the output into a plan tree.
+        """
+
+        if self.config.db_type == "mysql":
+            # EXPLAIN ANALYZE only supports the tree format, so use it for both.
+            explain = "EXPLAIN ANALYZE" if analyze else "EXPLAIN FORMAT=TREE"
+        elif analyze:
+            explain = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)"
+        elif re.search(r"\$\d", query):
+            # Normalized statements from pg_stat_statements have $n parameters,
+            # which only a generic plan (Postgres 16+) can handle.
+            explain = "EXPLAIN (GENERIC_PLAN, FORMAT JSON)"
+        else:
+            explain = "EXPLAIN (FORMAT JSON)"
+
+        labels = {"analyze": str(analyze).lower()}
+        with (
+            metrics.span("db.explain", **labels),
+            metrics.EXPLAIN_SECONDS.time(**labels),
+        ):
+            cursor = self.cursor()
+            cursor.execute(f"{explain} {query}")
+            explain_output = cursor.fetchall()
+            cursor.close()
+
+        if self.config.db_type == "mysql":
+            return parse_mysql("\n".join([row[0] for row in explain_output]))
+        return parse_postgres(explain_output[0][0])
+
+    @cached_property
+    def plan_cache(self) -> PlanCache:
+        if self.pool is not None:
+            return self.pool.plan_cache
+        return PlanCache(self.config.query_plan_ttl)
 
-        return "\n".join([row[0] for row in explain_output])
+    @cached_property
+    def history(self) -> Optional[History]:
+        if self.pool is not None:
+            return self.pool.history
+        return History(self.config) if self.config.history_enabled else None
+
+    @cached_property
+    def results(self) -> Optional[ResultStore]:
+        if self.pool is not None:
+            return self.pool.results
+        return ResultStore(self.config) if self.config.results_enabled else None
 
     @cached_property
+    def schema_cache(self) -> SchemaCache:
+        if self.pool is not None:
+            return self.pool.schema_cache
+        return SchemaCache(self.config)
+
+    @property
+    def schema_model(self) -> Schema:
+        """
+        Return a structured model of the database's schema, refreshed from the
+        catalog when it changes.
+        """
+
+        return self.schema_cache.get(self)
+
+    @property
     def schema(self) -> str:
         """
         Return the schema of the database as a string.
         """
 
-        host = self.config.db_host
-        port = self.config.db_port
-        password = self.config.db_password
-        user = self.config.db_username
-        db_name = self.config.db_name
+        return self.schema_model.to_ddl()
 
-        if self.config.db_type == "mysql":
-            command = f"mysqldump -h {host} -u {user} -p{password} --no-data {db_name}"
-        else:
-            command = f"PGPASSWORD={password} pg_dump --host={host} --port={port} --username={user} --schema-only {db_name}"
+    def schema_for(self, query: str) -> str:
+        """
+        Return the DDL to show the LLM for a query: only the relevant slice of
+        the schema, unless slicing is disabled in the config.
+        """
+
+        return self.schema_model_for(query).to_ddl()
+
+    def schema_model_for(self, query: str) -> Schema:
+        """Like `schema_for`, but return the structured model."""
+
+        with metrics.span("db.schema"):
+            if self.config.prompt_slice_schema:
+                return self.schema_model.relevant_to(query)
+            return self.schema_model
+
+    def top_statements(
+        self, by: str = "total_time", limit: int = 20
+    ) -> list[Statement]:
+        """
+        Return the statements that consume the most database time, from the
+        database's own statement statistics.
+        """
+
+        return top_statements(self, by, limit)
+
+    def verify_rewrite(self, original: str, optimized: str) -> Verification:
+        """
+        Check that a rewritten query returns the same rows as the original,
+        and measure how much faster it is.
+        """
+
+        return verify_rewrite(
+            self,
+            original,
+            optimized,
+            runs=self.config.verify_runs,
+            timeout=self.config.verify_statement_timeout,
+        )
+
+    def evaluate_indexes(self, query: str, ddl: str) -> Optional[IndexEvaluation]:
+        """
+        Estimate what the indexes in `ddl` would do to the query's plan,
+        without building them on the real tables.
+        """
 
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+        return evaluate_indexes(
+            self,
+            query,
+            ddl,
+            sample_rows=self.config.whatif_mysql_sample_rows,
+            shadow=self.config.whatif_mysql_shadow,
         )
-        stdout, stderr = process.communicate()
 
-        if process.returncode != 0:
-            raise Exception(f"Error in mysqldump: {stderr.decode()}")
+    def check_advice(
+        self,
+        query: str,
+        advice: OptimizationResult,
+        replica: Optional[Database] = None,
+    ) -> None:
+        """
+        Measure the LLM's suggestions against the database, as enabled in the
+        config, and attach the results to `advice`. The advice is then kept in
+        the history.
+
+        Rewrites are verified on `replica` if one is given. Indexes are always
+        evaluated here, where HypoPG is installed.
+        """
 
-        return stdout.decode()
+        if self.config.verify_enabled and advice.query_optimized:
+            advice.verification = (replica or self).verify_rewrite(
+                query, advice.query_optimized
+            )
+        if self.config.whatif_enabled and advice.schema_optimized:
+            advice.index_evaluation = self.evaluate_indexes(
+                query, advice.schema_optimized
+            )
+        if self.history is not None:
+            self.history.record_advice(
+                query, asdict(advice), self.plan_cache.get(query)
+            )
 
     def commit(self):
         self.conn.commit()
 
     def close(self):
-        self.conn.close()
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+            # Only what was actually opened, since these are created lazily.
+            results = self.__dict__.get("results")
+            if results is not None:
+                results.close()
+            history = self.__dict__.get("history")
+            if history is not None:
+                history.close()
+
+
+class QueryIdInUse(Exception):
+    pass
+
+
+class RunningQueries:
+    """
+    A registry of the statements currently running, by id, so that they can be
+    listed and cancelled from another request.
+    """
+
+    def __init__(self) -> None:
+        self._queries: dict[str, tuple[Database, str, float]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, query_id: str, db: Database, query: str) -> Iterator[None]:
+        with self._lock:
+            if query_id in self._queries:
+                raise QueryIdInUse(f"A query with id '{query_id}' is already running.")
+            self._queries[query_id] = (db, query, time.time())
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._queries.pop(query_id, None)
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"id": query_id, "query": query, "started_at": started_at}
+                for query_id, (_, query, started_at) in self._queries.items()
+            ]
+
+    def cancel(self, query_id: str) -> bool:
+        """Cancel a running query, returning False if there is none by that id."""
+        with self._lock:
+            entry = self._queries.get(query_id)
+        if entry is None:
+            return False
+        entry[0].cancel()
+        return True
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of DB connections.
+
+    Up to `pool_size` connections are kept open and reused. When all of them
+    are checked out, up to `pool_max_overflow` extra connections are opened,
+    and closed again as soon as they are released. Past that, acquiring a
+    connection waits up to `pool_timeout` seconds before raising PoolTimeout.
+
+    A pool for a read replica is given its `primary`'s pool, and shares its
+    caches, history and running queries, since both hold the same data.
+    """
+
+    def __init__(self, config: Config, primary: Optional[ConnectionPool] = None):
+        self.config = config
+        self.primary = primary
+        self._slots = threading.BoundedSemaphore(
+            config.pool_size + config.pool_max_overflow
+        )
+        self._overflow: set[int] = set()
+        self._lock = threading.Lock()
+        if primary is not None:
+            self.schema_cache = primary.schema_cache
+            self.plan_cache = primary.plan_cache
+            self.running = primary.running
+            self.history = primary.history
+            self.results = primary.results
+        else:
+            self.schema_cache = SchemaCache(config)
+            self.plan_cache = PlanCache(config.query_plan_ttl)
+            self.running = RunningQueries()
+            self.history = History(config) if config.history_enabled else None
+            self.results = ResultStore(config) if config.results_enabled else None
+        self._in_use = 0
+        metrics.POOL_CONNECTIONS.collect(self._connection_states)
+
+        if config.db_type == "mysql":
+            self._pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name=f"aqo_{config.db_id}",
+                pool_size=config.pool_size,
+                host=config.db_host,
+                port=config.db_port,
+                user=config.db_username,
+                password=config.db_password,
+                database=config.db_name,
+            )
+        elif config.db_type == "postgres":
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                1,
+                config.pool_size,
+                host=config.db_host,
+                port=config.db_port,
+                user=config.db_username,
+                password=config.db_password,
+                dbname=config.db_name,
+            )
+        else:
+            raise ValueError(f"Unsupported database type: {config.db_type}")
+
+    def acquire(self) -> DBAPIConnection:
+        """
+        Check out a connection, opening an overflow connection if the pool is
+        exhausted.
+        """
+
+        if not self._slots.acquire(timeout=self.config.pool_timeout):
+            raise PoolTimeout(
+                f"Timed out after {self.config.pool_timeout} seconds waiting "
+                "for a database connection."
+            )
+
+        try:
+            try:
+                conn = self._checkout()
+            except (mysql.connector.errors.PoolError, psycopg2.pool.PoolError):
+                conn = Database(self.config).conn
+                with self._lock:
+                    self._overflow.add(id(conn))
+
+            if self.config.db_type == "mysql":
+                conn.cursor().execute("SET profiling = 1;")
+            with self._lock:
+                self._in_use += 1
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: DBAPIConnection) -> None:
+        """
+        Return a connection to the pool, or close it if it was an overflow
+        connection.
+        """
+
+        try:
+            with self._lock:
+                overflow = id(conn) in self._overflow
+                self._overflow.discard(id(conn))
+                self._in_use -= 1
+
+            if overflow:
+                conn.close()
+            elif self.config.db_type == "mysql":
+                # Closing a pooled MySQL connection hands it back to the pool.
+                conn.close()
+            else:
+                self._pool.putconn(conn)  # type: ignore
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def database(self) -> Iterator[Database]:
+        """
+        Check out a connection for the duration of a block, wrapped in a
+        Database.
+        """
+
+        database = Database(self.config, pool=self)
+        try:
+            yield database
+        finally:
+            database.close()
+
+    def check_advice(
+        self,
+        query: str,
+        advice: OptimizationResult,
+        replica: Optional[ConnectionPool] = None,
+    ) -> None:
+        """Database.check_advice on pooled connections, verifying on `replica`."""
+
+        with self.database() as db:
+            if replica is None or replica is self:
+                db.check_advice(query, advice)
+                return
+            with replica.database() as replica_db:
+                db.check_advice(query, advice, replica=replica_db)
+
+    def _connection_states(self) -> dict[tuple, float]:
+        database = self.config.db_id
+        with self._lock:
+            return {
+                (database, "in_use"): self._in_use,
+                (database, "overflow"): len(self._overflow),
+                (database, "capacity"): self.config.pool_size
+                + self.config.pool_max_overflow,
+            }
+
+    def _checkout(self) -> DBAPIConnection:
+        if self.config.db_type == "mysql":
+            return self._pool.get_connection()  # type: ignore
+        return self._pool.getconn()  # type: ignore
+
+    def close(self) -> None:
+        metrics.POOL_CONNECTIONS.remove(self._connection_states)
+        if self.primary is None and self.results is not None:
+            self.results.close()
+        if self.primary is None and self.history is not None:
+            self.history.close()
+        if self.config.db_type == "postgres":
+            self._pool.closeall()  # type: ignore
+
+
+class DatabaseRegistry:
+    """
+    The pools of every configured database, by id, each opened the first time
+    it is used, so that idle databases cost no connections or schema dumps.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._pools: dict[str, ConnectionPool] = {}
+        # Held while a database's pool is opened, so that connecting to one
+        # database doesn't hold up requests for the others.
+        self._opening: dict[str, threading.Lock] = {}
+        self._next_replica: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def pool(self, database_id: Optional[str] = None) -> ConnectionPool:
+        """
+        Return the pool for a database, the default one if no id is given.
+        Raises ValueError for an unknown id.
+        """
+
+        database_id = database_id or self.config.default_database
+        with self._lock:
+            pool = self._pools.get(database_id)
+        if pool is not None:
+            return pool
+
+        config = self.config.for_database(database_id)
+        primary_id = config.database.get("replica_of")
+        primary = self.pool(primary_id) if primary_id is not None else None
+        with self._lock:
+            opening = self._opening.setdefault(database_id, threading.Lock())
+        with opening:
+            # Another thread may have opened it in the meantime.
+            with self._lock:
+                pool = self._pools.get(database_id)
+            if pool is None:
+                pool = ConnectionPool(config, primary=primary)
+                with self._lock:
+                    self._pools[database_id] = pool
+        return pool
+
+    def replica(self, database_id: Optional[str] = None) -> ConnectionPool:
+        """
+        Return a pool for reads that don't need to see the latest writes, such
+        as EXPLAIN and verification: the database's replicas in turn, or the
+        database itself if it has none.
+        """
+
+        database_id = database_id or self.config.default_database
+        replica_ids = self.config.replica_ids(database_id)
+        if not replica_ids:
+            return self.pool(database_id)
+        with self._lock:
+            turn = self._next_replica.get(database_id, 0)
+            self._next_replica[database_id] = turn + 1
+        return self.pool(replica_ids[turn % len(replica_ids)])
+
+    def active(self) -> list[str]:
+        with self._lock:
+            return list(self._pools)
+
+    def close(self) -> None:
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        # Replicas first, since they share state with their primaries.
+        for pool in sorted(pools, key=lambda pool: pool.primary is None):
+            pool.close()
@@ -0,0 +1,364 @@
+# Encodings for query results besides the default row-oriented JSON: a
+# column-oriented JSON and, when pyarrow is installed, Arrow IPC streams. Both
+# are written a batch of rows at a time, so a large result is never encoded
+# whole in memory.
+
+from __future__ import annotations
+import base64
+from dataclasses import dataclass
+import datetime
+import decimal
+import io
+import json
+
+from typing import Iterable, Iterator, Optional
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+JSON = "application/json"
+COLUMNS_JSON = "application/vnd.aqo.columns+json"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def available() -> list[str]:
+    return [JSON, COLUMNS_JSON] + ([ARROW_STREAM] if pa is not None else [])
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """
+    Pick the format for a response from an `Accept` header, preferring higher
+    quality values and then the order given. Falls back to plain JSON.
+    """
+
+    choices = []
+    for position, part in enumerate((accept or "").split(",")):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in available() and quality > 0:
+            choices.append((-quality, position, media_type))
+    return min(choices)[2] if choices else JSON
+
+
+def type_name(value: object) -> Optional[str]:
+    """The name of a value's type in the column-oriented JSON format."""
+
+    if value is None:
+        return None
+    # bool is a subclass of int, so it has to come first.
+    for kind, name in [
+        (bool, "boolean"),
+        (int, "integer"),
+        (float, "float"),
+        (decimal.Decimal, "decimal"),
+        (datetime.datetime, "datetime"),
+        (datetime.date, "date"),
+        (datetime.time, "time"),
+        (datetime.timedelta, "interval"),
+        ((bytes, bytearray, memoryview), "binary"),
+        ((dict, list), "json"),
+    ]:
+        if isinstance(value, kind):
+            return name
+    return "string"
+
+
+def _json_value(value: object) -> object:
+    # Decimals are sent as strings so that no precision is lost, and binary
+    # as base64. The column's type says how to read them back.
+    if value is None or isinstance(value, (bool, int, float, str, dict, list)):
+        return value
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode()
+    return str(value)
+
+
+def _from_json(kind: str, value: object) -> object:
+    # The reverse of _json_value, for a column of type `kind`.
+    if value is None:
+        return None
+    if kind == "decimal":
+        return decimal.Decimal(value)  # type: ignore
+    if kind == "datetime":
+        return datetime.datetime.fromisoformat(value)  # type: ignore
+    if kind == "date":
+        return datetime.date.fromisoformat(value)  # type: ignore
+    if kind == "time":
+        return datetime.time.fromisoformat(value)  # type: ignore
+    if kind == "interval":
+        return datetime.timedelta(seconds=value)  # type: ignore
+    if kind == "binary":
+        return base64.b64decode(value)  # type: ignore
+    return value
+
+
+@dataclass
+class ColumnType:
+    """
+    A column's type, named as in `type_name`, along with what the database
+    declares of its precision, scale and time zone, where it does.
+    """
+
+    kind: str
+    precision: Optional[int] = None
+    scale: Optional[int] = None
+    timezone: bool = False
+
+
+def column_types(
+    headers: list[str],
+    rows: list[list],
+    declared: Optional[list[Optional[ColumnType]]] = None,
+) -> list[ColumnType]:
+    """
+    The type of each column: as `declared` by the database where it is given,
+    and otherwise from the column's first non-null value in `rows`. Columns
+    whose type is unknown and that are all null are typed as strings.
+    """
+
+    types: list[Optional[ColumnType]] = list(declared or [None] * len(headers))
+    for row in rows:
+        if all(types):
+            break
+        for i, value in enumerate(row):
+            kind = type_name(value)
+            if types[i] is None and kind is not None:
+                types[i] = ColumnType(
+                    kind,
+                    timezone=isinstance(value, datetime.datetime)
+                    and value.tzinfo is not None,
+                )
+    return [column or ColumnType("string") for column in types]
+
+
+def columns_json(
+    headers: list[str],
+    batches: Iterable[list[list]],
+    meta: dict,
+    declared: Optional[list[Optional[ColumnType]]] = None,
+) -> Iterator[str]:
+    """
+    Encode a result as column-oriented JSON, one batch at a time:
+
+        {"meta": {...}, "headers": [...], "types": [...],
+         "batches": [{"length": 2, "columns": [[1, 2], ["a", "b"]]}, ...]}
+
+    Column types are as `declared`, or else taken from the first batch.
+    """
+
+    yield '{"meta": ' + json.dumps(meta, default=str)
+    yield ', "headers": ' + json.dumps(headers)
+    types = None
+    separator = ', "batches": ['
+    for rows in batches:
+        if types is None:
+            types = [column.kind for column in column_types(headers, rows, declared)]
+            yield ', "types": ' + json.dumps(types)
+        columns = [[_json_value(row[i]) for row in rows] for i in range(len(headers))]
+        yield separator + json.dumps(
+            {"length": len(rows), "columns": columns}, default=str
+        )
+        separator = ", "
+    if types is None:
+        types = [column.kind for column in column_types(headers, [], declared)]
+        yield ', "types": ' + json.dumps(types)
+        yield ', "batches": []}'
+    else:
+        yield "]}"
+
+
+def _arrow_type(column: ColumnType):
+    if column.kind == "decimal":
+        # Arrow decimals have a fixed scale. Unless the database declares it,
+        # a later value may need more digits than the first ones, so the
+        # exact text is sent instead.
+        if column.scale is None:
+            return pa.string()
+        precision = column.precision or 38
+        if precision > 76:
+            return pa.string()
+        decimal_type = pa.decimal128 if precision <= 38 else pa.decimal256
+        return decimal_type(precision, column.scale)
+    if column.kind == "datetime":
+        return pa.timestamp("us", tz="UTC" if column.timezone else None)
+    return {
+        "boolean": pa.bool_(),
+        "integer": pa.int64(),
+        "float": pa.float64(),
+        "date": pa.date32(),
+        "time": pa.time64("us"),
+        "interval": pa.duration("us"),
+        "binary": pa.binary(),
+    }.get(column.kind, pa.string())
+
+
+def _arrow_values(kind: str, arrow_type, values: list) -> list:
+    if pa.types.is_decimal(arrow_type):
+        # Values have at most the declared scale, so this only pads them.
+        quantum = decimal.Decimal(1).scaleb(-arrow_type.scale)
+        return [
+            value.quantize(quantum) if isinstance(value, decimal.Decimal) else value
+            for value in values
+        ]
+    if kind == "binary":
+        return [None if value is None else bytes(value) for value in values]
+    if kind == "json":
+        return [None if value is None else json.dumps(value) for value in values]
+    if arrow_type == pa.string():
+        return [None if value is None else str(value) for value in values]
+    return values
+
+
+def _arrow_schema(
+    headers: list[str], types: list[ColumnType], metadata: Optional[dict] = None
+):
+    # Each field names its type as in the JSON formats, since types such as
+    # JSON and decimals without a declared scale are sent as strings.
+    return pa.schema(
+        [
+            pa.field(header, _arrow_type(column), metadata={"aqo.type": column.kind})
+            for header, column in zip(headers, types)
+        ],
+        metadata=metadata,
+    )
+
+
+def _record_batch(schema, rows: list[list]):
+    arrays = [
+        pa.array(
+            _arrow_values(
+                field.metadata[b"aqo.type"].decode(),
+                field.type,
+                [row[i] for row in rows],
+            ),
+            type=field.type,
+        )
+        for i, field in enumerate(schema)
+    ]
+    return pa.record_batch(arrays, schema=schema)
+
+
+def arrow_stream(
+    headers: list[str],
+    batches: Iterable[list[list]],
+    meta: dict,
+    declared: Optional[list[Optional[ColumnType]]] = None,
+) -> Iterator[bytes]:
+    """
+    Encode a result as an Arrow IPC stream, one record batch per batch of
+    rows. Column types are as `declared`, or else taken from the first batch.
+    `meta` is kept as JSON in the schema's metadata under "aqo".
+    """
+
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed.")
+
+    # The writer keeps writing to the same buffer, which is emptied after
+    # each batch.
+    sink = io.BytesIO()
+    writer = None
+    schema = None
+
+    def flush() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    def open_writer(rows: list[list]):
+        nonlocal schema
+        schema = _arrow_schema(
+            headers,
+            column_types(headers, rows, declared),
+            {"aqo": json.dumps(meta, default=str)},
+        )
+        return pa.ipc.new_stream(sink, schema)
+
+    for rows in batches:
+        if writer is None:
+            writer = open_writer(rows)
+        writer.write_batch(_record_batch(schema, rows))
+        yield flush()
+
+    if writer is None:
+        writer = open_writer([])
+    writer.close()
+    yield flush()
+
+
+def dump_batch(headers: list[str], rows: list[list]) -> bytes:
+    """
+    Serialize a batch of rows for `load_batch`, with the types of its columns:
+    as an Arrow IPC stream when pyarrow is installed, or else as
+    column-oriented JSON.
+    """
+
+    if pa is not None:
+        sink = io.BytesIO()
+        schema = _arrow_schema(headers, column_types(headers, rows))
+        with pa.ipc.new_stream(sink, schema) as writer:
+            writer.write_batch(_record_batch(schema, rows))
+        return sink.getvalue()
+
+    kinds = [column.kind for column in column_types(headers, rows)]
+    columns = [[_json_value(row[i]) for row in rows] for i in range(len(headers))]
+    return json.dumps(
+        {"length": len(rows), "kinds": kinds, "columns": columns}, default=str
+    ).encode()
+
+
+def load_batch(data: bytes) -> list[list]:
+    """Read back a batch of rows written by `dump_batch`."""
+
+    if pa is not None:
+        table = pa.ipc.open_stream(data).read_all()
+        kinds = [field.metadata[b"aqo.type"].decode() for field in table.schema]
+        length = table.num_rows
+        columns = [
+            [_from_arrow(kind, value) for value in column.to_pylist()]
+            for kind, column in zip(kinds, table.columns)
+        ]
+    else:
+        batch = json.loads(data)
+        kinds, length = batch["kinds"], batch["length"]
+        columns = [
+            [_from_json(kind, value) for value in column]
+            for kind, column in zip(kinds, batch["columns"])
+        ]
+    return [[column[i] for column in columns] for i in range(length)]
+
+
+def _from_arrow(kind: str, value: object) -> object:
+    # JSON, and decimals without a declared scale, are sent as text.
+    if kind == "json" and isinstance(value, str):
+        return json.loads(value)
+    if kind == "decimal" and isinstance(value, str):
+        return decimal.Decimal(value)
+    return value
+
+
+def encode(
+    media_type: str,
+    headers: list[str],
+    batches,
+    meta: dict,
+    declared: Optional[list[Optional[ColumnType]]] = None,
+) -> Iterator:
+    if media_type == ARROW_STREAM:
+        return arrow_stream(headers, batches, meta, declared)
+    return columns_json(headers, batches, meta, declared)
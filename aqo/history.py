@@ -0,0 +1,261 @@
+# A record of what AQO has run and advised, for following latency and plan
+# changes over time.
+
+from __future__ import annotations
+from contextlib import contextmanager
+import json
+import sqlite3
+import time
+
+from typing import Iterator, Optional
+
+from aqo.config import Config
+from aqo.plan import Plan
+from aqo.sql import fingerprint
+
+
+class History:
+    """
+    An on-disk record of every query AQO runs and every piece of advice it
+    gets, stored in SQLite.
+
+    Executions are kept with their latency, row count and the shape of their
+    plan, so that latency trends and plan changes can be followed per
+    fingerprint. Records older than `history_retention` seconds are pruned.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.path = config.history_path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS executions (
+                    id INTEGER PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    executed_at REAL NOT NULL,
+                    query_time REAL,
+                    rowcount INTEGER,
+                    plan_shape TEXT,
+                    plan TEXT,
+                    error TEXT
+                )
+                """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS advice (
+                    id INTEGER PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    plan_shape TEXT,
+                    advice TEXT NOT NULL
+                )
+                """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS executions_fingerprint "
+                "ON executions (fingerprint, executed_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS executions_executed_at "
+                "ON executions (executed_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS advice_fingerprint "
+                "ON advice (fingerprint, created_at)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per operation keeps the history safe to use from the
+        # server's worker threads.
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        """
+        Call when done with the history. Connections aren't held between
+        operations, so this only refreshes the planner statistics SQLite keeps
+        for the indexes, as it recommends doing before closing.
+        """
+        with self._connect() as conn:
+            conn.execute("PRAGMA optimize")
+
+    def record_execution(
+        self,
+        query: str,
+        query_time: Optional[float],
+        rowcount: Optional[int],
+        plan: Optional[Plan] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO executions (
+                    fingerprint, query, executed_at, query_time, rowcount,
+                    plan_shape, plan, error
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    fingerprint(query),
+                    query,
+                    now,
+                    query_time,
+                    rowcount,
+                    plan.shape() if plan else None,
+                    plan.digest() if plan else None,
+                    error,
+                ),
+            )
+            self._prune(conn, now)
+
+    def record_advice(
+        self, query: str, advice: dict, plan: Optional[Plan] = None
+    ) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO advice (fingerprint, query, created_at, plan_shape, advice)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    fingerprint(query),
+                    query,
+                    now,
+                    plan.shape() if plan else None,
+                    json.dumps(advice, default=str),
+                ),
+            )
+            self._prune(conn, now)
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        cutoff = now - self.config.history_retention
+        conn.execute("DELETE FROM executions WHERE executed_at < ?", (cutoff,))
+        conn.execute("DELETE FROM advice WHERE created_at < ?", (cutoff,))
+
+    def executions(self, fingerprint: str, limit: int = 100) -> list[dict]:
+        """The most recent executions of a fingerprint, newest first."""
+
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                """
+                SELECT * FROM executions WHERE fingerprint = ?
+                ORDER BY executed_at DESC LIMIT ?
+                """,
+                (fingerprint, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def latency_trend(
+        self, fingerprint: str, since: float = 0, bucket: float = 86400
+    ) -> list[dict]:
+        """
+        Latency statistics for a fingerprint's successful executions since
+        `since`, grouped into buckets of `bucket` seconds.
+        """
+
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                """
+                SELECT
+                    CAST(executed_at / :bucket AS INTEGER) * :bucket AS period,
+                    COUNT(*) AS runs,
+                    AVG(query_time) AS mean_time,
+                    MIN(query_time) AS min_time,
+                    MAX(query_time) AS max_time,
+                    COUNT(DISTINCT plan_shape) AS plans
+                FROM executions
+                WHERE fingerprint = :fingerprint
+                    AND executed_at >= :since
+                    AND error IS NULL
+                GROUP BY period
+                ORDER BY period
+                """,
+                {"bucket": bucket, "fingerprint": fingerprint, "since": since},
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def plan_changes(self, since: float) -> list[dict]:
+        """
+        The fingerprints whose latest plan since `since` differs from the last
+        plan they had before it, with the mean latency under each, so that
+        regressions after a deploy or a statistics change stand out.
+        """
+
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                """
+                WITH ranked AS (
+                    SELECT
+                        fingerprint,
+                        query,
+                        executed_at,
+                        plan_shape,
+                        executed_at >= :since AS recent,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY fingerprint, executed_at >= :since
+                            ORDER BY executed_at DESC
+                        ) AS position
+                    FROM executions
+                    WHERE plan_shape IS NOT NULL
+                ),
+                before AS (SELECT * FROM ranked WHERE NOT recent AND position = 1),
+                after AS (SELECT * FROM ranked WHERE recent AND position = 1)
+                SELECT
+                    after.fingerprint,
+                    after.query,
+                    before.plan_shape AS old_plan_shape,
+                    after.plan_shape AS new_plan_shape,
+                    (
+                        SELECT MIN(executed_at) FROM executions e
+                        WHERE e.fingerprint = after.fingerprint
+                            AND e.plan_shape = after.plan_shape
+                            AND e.executed_at >= :since
+                    ) AS changed_at,
+                    (
+                        SELECT AVG(query_time) FROM executions e
+                        WHERE e.fingerprint = after.fingerprint
+                            AND e.plan_shape = before.plan_shape
+                            AND e.error IS NULL
+                    ) AS old_mean_time,
+                    (
+                        SELECT AVG(query_time) FROM executions e
+                        WHERE e.fingerprint = after.fingerprint
+                            AND e.plan_shape = after.plan_shape
+                            AND e.error IS NULL
+                    ) AS new_mean_time
+                FROM after JOIN before USING (fingerprint)
+                WHERE after.plan_shape != before.plan_shape
+                ORDER BY changed_at DESC
+                """,
+                {"since": since},
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def latest_advice(
+        self, fingerprint: str, plan_shape: Optional[str] = None
+    ) -> Optional[dict]:
+        """
+        The most recent advice for a fingerprint, optionally only advice given
+        for the same plan.
+        """
+
+        query = "SELECT advice FROM advice WHERE fingerprint = ?"
+        params: list = [fingerprint]
+        if plan_shape is not None:
+            query += " AND plan_shape = ?"
+            params.append(plan_shape)
+        query += " ORDER BY created_at DESC LIMIT 1"
+
+        with self._connect() as conn:
+            row = conn.execute(query, params).fetchone()
+        return json.loads(row[0]) if row else None
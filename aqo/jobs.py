@@ -0,0 +1,312 @@
+# Optimization requests run as background jobs, so that a client doesn't have
+# to hold a connection open through the EXPLAIN and the model's answer. Jobs
+# are kept in SQLite, so their state and results survive a restart.
+
+from __future__ import annotations
+from bisect import insort
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from typing import Callable, Iterator, Optional
+
+from aqo.config import Config
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    user: str
+    priority: int
+    # What the job was submitted with, such as the query to optimize.
+    request: dict
+    status: str = QUEUED
+    # What a running job is doing, as reported by the job itself.
+    stage: Optional[str] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# Run a job, calling the second argument with the name of each stage as it
+# starts, and return its result.
+Runner = Callable[[Job, Callable[[str], None]], dict]
+
+
+def _order(job: Job) -> tuple:
+    return (-job.priority, job.created_at)
+
+
+class JobQueue:
+    """
+    Runs jobs on `jobs_workers` threads, highest priority first and then in
+    order of submission, with no more than `jobs_max_per_user` of one user's
+    jobs running at a time. At most `jobs_max_queued` jobs wait to run.
+
+    Every change to a job is saved, and finished jobs are kept for
+    `jobs_retention` seconds. Jobs still queued when the process exits are run
+    when it starts again; ones that were running are marked as failed, since
+    they may have been partway through running the query.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        run: Runner,
+        cancel: Optional[Callable[[Job], None]] = None,
+    ):
+        self.config = config
+        self.path = config.jobs_path
+        self._run = run
+        self._cancel = cancel
+        self._queued: list[Job] = []
+        self._running: dict[str, Job] = {}
+        self._cancelled: set[str] = set()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    request TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+            )
+        self._recover()
+
+        self._workers = [
+            threading.Thread(target=self._work, name=f"aqo-job-{i}", daemon=True)
+            for i in range(config.jobs_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _save(self, job: Job) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO jobs (
+                    id, user, priority, request, status, stage, result, error,
+                    created_at, started_at, finished_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    job.id,
+                    job.user,
+                    job.priority,
+                    json.dumps(job.request),
+                    job.status,
+                    job.stage,
+                    None if job.result is None else json.dumps(job.result, default=str),
+                    job.error,
+                    job.created_at,
+                    job.started_at,
+                    job.finished_at,
+                ),
+            )
+
+    def _load(self, where: str, params: tuple = (), limit: int = -1) -> list[Job]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE {where} ORDER BY created_at DESC LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        jobs = []
+        for row in rows:
+            data = dict(row)
+            data["request"] = json.loads(data["request"])
+            if data["result"] is not None:
+                data["result"] = json.loads(data["result"])
+            jobs.append(Job(**data))
+        return jobs
+
+    def _recover(self) -> None:
+        for job in self._load("status IN (?, ?)", (QUEUED, RUNNING)):
+            if job.status == QUEUED:
+                insort(self._queued, job, key=_order)
+                continue
+            job.status = FAILED
+            job.error = "AQO was restarted while the job was running."
+            job.finished_at = time.time()
+            self._save(job)
+
+    def submit(self, request: dict, user: str, priority: int = 0) -> Job:
+        job = Job(id=uuid.uuid4().hex, user=user, priority=priority, request=request)
+        with self._condition:
+            if len(self._queued) >= self.config.jobs_max_queued:
+                raise QueueFull(f"{len(self._queued)} jobs are already waiting to run.")
+            self._save(job)
+            insort(self._queued, job, key=_order)
+            self._condition.notify()
+        self._prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        jobs = self._load("id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def list(
+        self,
+        user: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 100,
+    ) -> list[Job]:
+        """The most recent jobs, newest first."""
+
+        conditions, params = ["1 = 1"], []
+        if user is not None:
+            conditions.append("user = ?")
+            params.append(user)
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        return self._load(" AND ".join(conditions), tuple(params), limit)
+
+    def position(self, job_id: str) -> Optional[int]:
+        """How many jobs will start before a queued one, or None if it isn't."""
+
+        with self._condition:
+            for i, job in enumerate(self._queued):
+                if job.id == job_id:
+                    return i
+        return None
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued or running job, returning False if there is none by
+        that id that hasn't finished. A running job stops at its next stage,
+        and `cancel` is called to interrupt what it is doing.
+        """
+
+        with self._condition:
+            for job in self._queued:
+                if job.id == job_id:
+                    self._queued.remove(job)
+                    job.status = CANCELLED
+                    job.finished_at = time.time()
+                    self._save(job)
+                    return True
+            job = self._running.get(job_id)
+            if job is None:
+                return False
+            self._cancelled.add(job_id)
+        if self._cancel is not None:
+            self._cancel(job)
+        return True
+
+    def stats(self) -> dict[tuple, float]:
+        """The number of jobs waiting and running, for the metrics."""
+
+        with self._condition:
+            return {(QUEUED,): len(self._queued), (RUNNING,): len(self._running)}
+
+    def _next(self) -> Optional[Job]:
+        running = Counter(job.user for job in self._running.values())
+        for job in self._queued:
+            if running[job.user] < self.config.jobs_max_per_user:
+                return job
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                job = self._next()
+                while job is None and not self._closed:
+                    self._condition.wait()
+                    job = self._next()
+                if self._closed:
+                    return
+                assert job is not None
+                self._queued.remove(job)
+                self._running[job.id] = job
+                job.status = RUNNING
+                job.started_at = time.time()
+            self._save(job)
+
+            try:
+                job.result = self._run(job, lambda stage: self._stage(job, stage))
+            except JobCancelled:
+                pass
+            except Exception as e:
+                job.error = str(e) or type(e).__name__
+
+            with self._condition:
+                del self._running[job.id]
+                if job.id in self._cancelled:
+                    self._cancelled.discard(job.id)
+                    job.status = CANCELLED
+                    job.result = None
+                else:
+                    job.status = FAILED if job.error is not None else DONE
+                job.stage = None
+                job.finished_at = time.time()
+                # The user may have other jobs that can run now.
+                self._condition.notify_all()
+            self._save(job)
+
+    def _stage(self, job: Job, stage: str) -> None:
+        if job.id in self._cancelled:
+            raise JobCancelled()
+        job.stage = stage
+        self._save(job)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.config.jobs_retention
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+
+    def close(self) -> None:
+        """
+        Stop taking new jobs off the queue. Jobs already running are left to
+        finish, and queued ones run the next time a queue is opened.
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
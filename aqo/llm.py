@@ -1,13 +1,23 @@
 from __future__ import annotations
-from dataclasses import dataclass
+import asyncio
+from dataclasses import asdict, dataclass, field
 import json
+import re
+import time
 
 import os
-from typing import Optional
-
-from litellm import completion
+from typing import AsyncIterator, Callable, Optional, Union
 
+from aqo import metrics
+from aqo.cache import AdviceCache
 from aqo.config import Config
+from aqo.plan import Plan
+from aqo.prompt import Prompt, PromptBuilder, PromptTooLarge
+from aqo.providers import Provider, ProviderPool
+from aqo.schema import Schema
+from aqo.sql import literals
+from aqo.verify import Verification
+from aqo.whatif import IndexEvaluation
 
 
 @dataclass
@@ -18,6 +28,145 @@ class OptimizationResult:
     schema_optimized: str
     explanation: str
     error: Optional[str] = None
+    verification: Optional[Verification] = None
+    index_evaluation: Optional[IndexEvaluation] = None
+    # What was left out of the schema and plan to fit the models' context.
+    omitted: list[str] = field(default_factory=list)
+    # The configured model that gave the advice, as provider/model.
+    model: Optional[str] = None
+
+
+ADVICE_FIELDS = [
+    "query_advice",
+    "schema_advice",
+    "query_optimized",
+    "schema_optimized",
+    "explanation",
+]
+
+
+class InvalidAdvice(ValueError):
+    pass
+
+
+_FENCED = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+def extract_json(text: str) -> dict:
+    """
+    Find the JSON object in a model's response, whether it is the whole
+    response, in a code fence, or surrounded by prose.
+    """
+
+    candidates = [text.strip(), *(match.strip() for match in _FENCED.findall(text))]
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, dict):
+            return data
+
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            data, _ = decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            data = None
+        if isinstance(data, dict):
+            return data
+        start = text.find("{", start + 1)
+
+    raise InvalidAdvice("the response does not contain a JSON object")
+
+
+def parse_advice(text: str) -> OptimizationResult:
+    """Parse and validate a model's response against OptimizationResult."""
+
+    data = extract_json(text)
+    missing = [key for key in ADVICE_FIELDS if key not in data]
+    if missing:
+        raise InvalidAdvice(f"the JSON object is missing {', '.join(missing)}")
+
+    values = {}
+    for key in [*ADVICE_FIELDS, "error"]:
+        value = data.get(key)
+        # Models often give several DDL statements as a list.
+        if isinstance(value, list) and all(isinstance(v, str) for v in value):
+            value = "\n".join(value)
+        if value is not None and not isinstance(value, str):
+            raise InvalidAdvice(f"'{key}' must be a string or null")
+        values[key] = value
+    return OptimizationResult(**values)
+
+
+def _content(result: dict) -> str:
+    return result["choices"][0]["message"]["content"] or ""
+
+
+class AdviceFields:
+    """
+    Parses a JSON object as it streams in, returning each top-level key once
+    its value is complete, so that advice can be shown before the model has
+    finished the whole response.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self._position: Optional[int] = None
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text: str) -> list[tuple[str, object]]:
+        self.buffer += text
+        if self._position is None:
+            # Models sometimes wrap the object in a code fence.
+            start = self.buffer.find("{")
+            if start == -1:
+                return []
+            self._position = start + 1
+
+        fields = []
+        while True:
+            field = self._next_field()
+            if field is None:
+                return fields
+            fields.append(field)
+
+    def _skip(self, position: int, separators: str = "") -> int:
+        while position < len(self.buffer) and (
+            self.buffer[position].isspace() or self.buffer[position] in separators
+        ):
+            position += 1
+        return position
+
+    def _next_field(self) -> Optional[tuple[str, object]]:
+        assert self._position is not None
+        try:
+            position = self._skip(self._position, ",")
+            key, position = self._decoder.raw_decode(self.buffer, position)
+            position = self._skip(position)
+            if self.buffer[position : position + 1] != ":":
+                return None
+            value, position = self._decoder.raw_decode(
+                self.buffer, self._skip(position + 1)
+            )
+        except (json.JSONDecodeError, IndexError):
+            return None
+
+        # A number or literal at the end of the buffer may not be finished
+        # yet, so wait until something follows it.
+        end = self._skip(position)
+        if end >= len(self.buffer) or not isinstance(key, str):
+            return None
+        self._position = position
+        return key, value
+
+
+# The schema and plan can be given as text, or as models that the prompt
+# builder can compress if the prompt doesn't fit.
+SchemaInput = Union[Schema, str]
+PlanInput = Union[Plan, str]
 
 
 class LLM:
@@ -69,8 +218,28 @@ class LLM:
     ```sql
     """
 
+    omitted_prompt = """
+    To fit in your context window, the following were left out of the schema
+    and the EXPLAIN output: {omitted}.
+    """
+
+    repair_prompt = """
+    Your response could not be used because {problem}. Reply again with only
+    the JSON object, with the keys query_advice, schema_advice,
+    query_optimized, schema_optimized, explanation and error, each a string or
+    null, and no other text.
+    """
+
     def __init__(self, config: Config) -> None:
         self.config = config
+        self.cache = AdviceCache(config) if config.cache_enabled else None
+        self.providers = ProviderPool(
+            [Provider.from_dict(model) for model in config.ai_models],
+            delay=config.hedge_delay,
+            failure_threshold=config.hedge_failure_threshold,
+            cooldown=config.hedge_cooldown,
+        )
+        self.prompts = PromptBuilder(config, self.providers.providers, self._render)
         self._setup_llm()
 
     def _setup_llm(self) -> None:
@@ -79,55 +248,237 @@ class LLM:
         elif self.config.ai_provider == "anthropic":
             os.environ["ANTHROPIC_API_KEY"] = self.config.ai_api_key
 
-    def optimize(
-        self, database_schema: str, slow_query: str, explain_output: str
-    ) -> dict:
+    def _render(
+        self,
+        database_schema: str,
+        slow_query: str,
+        explain_output: str,
+        omitted: list[str],
+    ) -> list[dict]:
         system_prompt = self.system_prompt.format(database_schema=database_schema)
         user_prompt = self.user_prompt.format(
             slow_query=slow_query, explain_output=explain_output
         )
+        if omitted:
+            user_prompt += self.omitted_prompt.format(omitted="; ".join(omitted))
 
-        messages = [
+        return [
             {"content": system_prompt, "role": "system"},
             {"content": user_prompt, "role": "user"},
         ]
-        return completion(
-            self._litellm_model(),
-            messages=messages,
-            api_base=self.config.ai_api_base,
-        )
+
+    def _prompt(
+        self, database_schema: SchemaInput, slow_query: str, explain_output: PlanInput
+    ) -> Prompt:
+        return self.prompts.build(database_schema, slow_query, explain_output)
+
+    async def astream_optimize(
+        self, database_schema: SchemaInput, slow_query: str, explain_output: PlanInput
+    ) -> AsyncIterator[tuple[str, object]]:
+        """
+        Stream advice as it is generated, as `(event, data)` pairs: a "token"
+        for each chunk of text, a "field" with `(key, value)` as each key of
+        the advice completes, and finally "advice" with the parsed
+        OptimizationResult. Cached advice is returned as a single "advice".
+        """
+
+        key, cached = self._cached_advice(database_schema, slow_query, explain_output)
+        if cached is not None:
+            yield "advice", cached
+            return
+
+        try:
+            prompt = self._prompt(database_schema, slow_query, explain_output)
+        except PromptTooLarge as e:
+            yield "advice", self._error_advice(str(e))
+            return
+
+        messages = prompt.messages
+        start_time = time.monotonic()
+        provider, response, finish = await self.providers.stream(messages)
+        fields = AdviceFields()
+        try:
+            async for chunk in response:  # type: ignore
+                text = chunk.choices[0].delta.content
+                if not text:
+                    continue
+                if not fields.buffer:
+                    metrics.LLM_FIRST_TOKEN_SECONDS.observe(
+                        time.monotonic() - start_time, provider=provider.name
+                    )
+                yield "token", text
+                for field in fields.feed(text):
+                    yield "field", field
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client went away mid-stream, so there is no outcome to
+            # record, but a trial request on the provider has to be given up.
+            finish(None)
+            raise
+        except Exception:
+            finish(False)
+            raise
+
+        # The provider answered, whether or not the answer parses.
+        finish(True)
+        try:
+            advice = parse_advice(fields.buffer)
+            advice.model = provider.name
+        except InvalidAdvice as e:
+            repairs = self.config.response_max_repairs
+            if repairs:
+                messages = self._repair_messages(messages, fields.buffer, str(e))
+                advice = await self._aadvise(messages, repairs - 1)
+            else:
+                advice = self._invalid_advice(str(e))
+        advice.omitted = prompt.omitted
+        yield "advice", self._cache_advice(key, slow_query, advice)
 
     def optimize_as_json(
-        self, database_schema: str, slow_query: str, explain_output: str
+        self,
+        database_schema: SchemaInput,
+        slow_query: str,
+        explain_output: PlanInput,
+        throttle: Optional[Callable[[], None]] = None,
     ) -> OptimizationResult:
-        result = self.optimize(database_schema, slow_query, explain_output)
-        advice = result["choices"][0]["message"]["content"]
+        """
+        Ask for advice on a query, from the cache if possible. `throttle` is
+        called before every completion request, repairs and hedges included.
+        """
+
+        key, cached = self._cached_advice(database_schema, slow_query, explain_output)
+        if cached is not None:
+            return cached
+
         try:
-            json_advice = json.loads(advice)
-            return OptimizationResult(**json_advice)
-        except json.JSONDecodeError:
-            return OptimizationResult(
-                query_advice="",
-                schema_advice="",
-                query_optimized="",
-                schema_optimized="",
-                explanation="",
-                error="Error: LLM returned invalid JSON.",
+            prompt = self._prompt(database_schema, slow_query, explain_output)
+        except PromptTooLarge as e:
+            return self._error_advice(str(e))
+
+        advice = self._advise(
+            prompt.messages, self.config.response_max_repairs, throttle
+        )
+        advice.omitted = prompt.omitted
+        return self._cache_advice(key, slow_query, advice)
+
+    def _advise(
+        self,
+        messages: list[dict],
+        repairs: int,
+        throttle: Optional[Callable[[], None]] = None,
+    ) -> OptimizationResult:
+        """
+        Ask for advice, and if the response doesn't parse, show the model its
+        response and ask again, up to `repairs` more times.
+        """
+
+        while True:
+            provider, result = self.providers.complete_sync(
+                messages, accept=self._valid, throttle=throttle
             )
-        except Exception as e:
-            return OptimizationResult(
-                query_advice="",
-                schema_advice="",
-                query_optimized="",
-                schema_optimized="",
-                explanation="",
-                error=f"Error: LLM returned invalid response. Details: {e}",
+            try:
+                return self._parse(provider, result)
+            except InvalidAdvice as e:
+                if repairs <= 0:
+                    return self._invalid_advice(str(e))
+                messages = self._repair_messages(messages, _content(result), str(e))
+                repairs -= 1
+
+    async def _aadvise(self, messages: list[dict], repairs: int) -> OptimizationResult:
+        while True:
+            provider, result = await self.providers.complete(
+                messages, accept=self._valid
             )
+            try:
+                return self._parse(provider, result)
+            except InvalidAdvice as e:
+                if repairs <= 0:
+                    return self._invalid_advice(str(e))
+                messages = self._repair_messages(messages, _content(result), str(e))
+                repairs -= 1
 
-    def _litellm_model(self) -> str:
-        if self.config.ai_provider == "openai":
-            return self.config.ai_model_name
-        elif self.config.ai_provider == "anthropic":
-            return self.config.ai_model_name
-        else:
-            return f"{self.config.ai_provider}/{self.config.ai_model_name}"
+    def _repair_messages(
+        self, messages: list[dict], response: str, problem: str
+    ) -> list[dict]:
+        return [
+            *messages,
+            {"content": response, "role": "assistant"},
+            {
+                "content": self.repair_prompt.format(problem=problem),
+                "role": "user",
+            },
+        ]
+
+    def _cached_advice(
+        self, database_schema: SchemaInput, slow_query: str, explain_output: PlanInput
+    ) -> tuple[dict[str, str], Optional[OptimizationResult]]:
+        """
+        Look up advice from any of the configured models, preferring the
+        first. Returns the cache key for each model too, for `_cache_advice`.
+        """
+
+        if self.cache is None:
+            return {}, None
+
+        # The key is on the full schema, before any compression, and on the
+        # shape of the plan.
+        if isinstance(database_schema, Schema):
+            database_schema = database_schema.to_ddl()
+        keys = {
+            provider.name: self.cache.key(
+                database_schema, slow_query, explain_output, provider.litellm_model
+            )
+            for provider in self.providers.providers
+        }
+        advice = self.cache.get(list(keys.values()))
+        if advice is None:
+            return keys, None
+
+        original = advice.pop("query", None)
+        if original is None:
+            return keys, None
+        if literals(original) != literals(slow_query):
+            # The advice was given for a variant of the query with other
+            # literals. Its text still applies, but there's no telling which
+            # literals in its rewrite came from the variant, so the rewrite is
+            # left out, along with DDL that mentions the variant's literals.
+            changed = set(literals(original)) - set(literals(slow_query))
+            advice["query_optimized"] = ""
+            if changed & set(literals(advice["schema_optimized"] or "")):
+                advice["schema_optimized"] = ""
+        return keys, OptimizationResult(**advice)
+
+    def _cache_advice(
+        self, keys: dict[str, str], slow_query: str, advice: OptimizationResult
+    ) -> OptimizationResult:
+        # Errors aren't cached, so that a bad response can be retried. Advice
+        # is kept under the model that gave it, which may be a fallback.
+        key = keys.get(advice.model) if advice.model is not None else None
+        if self.cache is not None and key is not None and advice.error is None:
+            measurements = {"verification": None, "index_evaluation": None}
+            self.cache.put(key, {**asdict(advice), **measurements, "query": slow_query})
+        return advice
+
+    def _valid(self, result: dict) -> bool:
+        try:
+            parse_advice(_content(result))
+        except InvalidAdvice:
+            return False
+        return True
+
+    def _parse(self, provider: Provider, result: dict) -> OptimizationResult:
+        advice = parse_advice(_content(result))
+        advice.model = provider.name
+        return advice
+
+    def _invalid_advice(self, problem: str) -> OptimizationResult:
+        return self._error_advice(f"LLM returned invalid response. Details: {problem}")
+
+    def _error_advice(self, problem: str) -> OptimizationResult:
+        return OptimizationResult(
+            query_advice="",
+            schema_advice="",
+            query_optimized="",
+            schema_optimized="",
+            explanation="",
+            error=f"Error: {problem}",
+        )
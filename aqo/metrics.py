@@ -0,0 +1,247 @@
+# Metrics in the Prometheus text format, and tracing spans when OpenTelemetry
+# is installed, for the stages of a request: running and planning the query,
+# introspecting the schema, and waiting on the model.
+
+from __future__ import annotations
+from contextlib import contextmanager
+import threading
+import time
+
+from typing import Callable, Iterator, Optional
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Latencies here range from sub-millisecond plan lookups to minute-long
+# completions on local models.
+DEFAULT_BUCKETS = [
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+]
+
+
+def _labels(names: list[str], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Optional[list[str]] = None):
+        self.name = name
+        self.help = help
+        self.label_names = labels or []
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose values are read from `collect` when metrics are scraped."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Optional[list[str]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = labels or []
+        self._collectors: list[Callable[[], dict[tuple, float]]] = []
+
+    def collect(self, collector: Callable[[], dict[tuple, float]]) -> None:
+        self._collectors.append(collector)
+
+    def remove(self, collector: Callable[[], dict[tuple, float]]) -> None:
+        self._collectors.remove(collector)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        # A copy, since collectors come and go as pools and apps close.
+        for collector in list(self._collectors):
+            for key, value in sorted(collector().items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Optional[list[str]] = None,
+        buckets: Optional[list[float]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = labels or []
+        self.buckets = buckets or DEFAULT_BUCKETS
+        # Per label set: a count per bucket, then the sum and total count.
+        self._values: dict[tuple, tuple[list[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                names = [*self.label_names, "le"]
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _labels(names, (*key, f"{bound:g}"))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _labels(names, (*key, "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total:g}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+QUERY_SECONDS = Histogram(
+    "aqo_query_seconds", "Time to run a user query.", labels=["mode"]
+)
+EXPLAIN_SECONDS = Histogram(
+    "aqo_explain_seconds", "Time to EXPLAIN a query.", labels=["analyze"]
+)
+SCHEMA_SECONDS = Histogram(
+    "aqo_schema_introspection_seconds",
+    "Time to introspect the schema from the catalog.",
+)
+LLM_SECONDS = Histogram(
+    "aqo_llm_seconds",
+    "Time for a model to return a completion.",
+    labels=["provider", "outcome"],
+)
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    "aqo_llm_time_to_first_token_seconds",
+    "Time for a streamed completion to return its first token.",
+    labels=["provider"],
+)
+LLM_TOKENS = Counter(
+    "aqo_llm_tokens_total",
+    "Tokens sent to and received from each model.",
+    labels=["provider", "direction"],
+)
+CACHE_REQUESTS = Counter(
+    "aqo_cache_requests_total",
+    "Lookups in AQO's caches, by whether they hit.",
+    labels=["cache", "result"],
+)
+POOL_CONNECTIONS = Gauge(
+    "aqo_pool_connections",
+    "Database connections in each database's pool, by state.",
+    labels=["database", "state"],
+)
+JOBS = Gauge(
+    "aqo_jobs",
+    "Optimization jobs waiting and running, by status.",
+    labels=["status"],
+)
+
+METRICS = [
+    QUERY_SECONDS,
+    EXPLAIN_SECONDS,
+    SCHEMA_SECONDS,
+    LLM_SECONDS,
+    LLM_FIRST_TOKEN_SECONDS,
+    LLM_TOKENS,
+    CACHE_REQUESTS,
+    POOL_CONNECTIONS,
+    JOBS,
+]
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_usage(provider: str, result: dict) -> None:
+    """Count the tokens a completion used, if the provider reported them."""
+
+    def field(data, name: str):
+        if isinstance(data, dict):
+            return data.get(name)
+        return getattr(data, name, None)
+
+    usage = field(result, "usage")
+    if not usage:
+        return
+    prompt_tokens = field(usage, "prompt_tokens")
+    completion_tokens = field(usage, "completion_tokens")
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, provider=provider, direction="in")
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, provider=provider, direction="out")
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    """
+    A tracing span around a stage of a request. Spans are only recorded when
+    OpenTelemetry is installed and a tracer provider is configured.
+    """
+
+    if trace is None:
+        yield
+        return
+
+    tracer = trace.get_tracer("aqo")
+    with tracer.start_as_current_span(name, attributes=attributes):
+        yield
@@ -0,0 +1,354 @@
+# A structured model of query plans, parsed from Postgres' JSON EXPLAIN or
+# MySQL's tree EXPLAIN, with a compact text digest for the LLM and the UI.
+
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+import hashlib
+import json
+import re
+import threading
+import time
+
+from typing import Iterator, Optional
+
+from aqo import metrics
+
+
+@dataclass
+class PlanNode:
+    """
+    A node in a query plan. Costs are in the planner's units, times are in
+    milliseconds. `time` is inclusive of children across all loops, and
+    `self_time` excludes them. Actual values are None for a plain EXPLAIN.
+    """
+
+    node_type: str
+    relation: Optional[str] = None
+    detail: Optional[str] = None
+    cost: Optional[float] = None
+    rows_estimated: Optional[float] = None
+    rows_actual: Optional[float] = None
+    loops: Optional[int] = None
+    time: Optional[float] = None
+    self_time: Optional[float] = None
+    buffers_hit: Optional[int] = None
+    buffers_read: Optional[int] = None
+    children: list[PlanNode] = field(default_factory=list)
+
+    def walk(self) -> Iterator[PlanNode]:
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    @property
+    def estimate_error(self) -> Optional[float]:
+        """
+        How far off the row estimate was, as a ratio that is always at least 1.
+        """
+
+        if self.rows_actual is None or self.rows_estimated is None or not self.loops:
+            return None
+        # Compare per-loop rows, with a floor of one row so empty results
+        # don't divide by zero.
+        estimated = max(self.rows_estimated, 1)
+        actual = max(self.rows_actual, 1)
+        return max(estimated / actual, actual / estimated)
+
+    def describe(self) -> str:
+        """A one-line summary of the node."""
+
+        line = self.node_type
+        if self.relation and f" on {self.relation}" not in line:
+            line += f" on {self.relation}"
+        if self.detail and self.detail.startswith("("):
+            line += f" {self.detail}"
+        elif self.detail:
+            line += f" ({self.detail})"
+
+        stats = []
+        if self.cost is not None:
+            stats.append(f"cost={self.cost:g}")
+        if self.rows_actual is not None:
+            stats.append(f"rows={self.rows_actual:g}")
+        if self.rows_estimated is not None:
+            stats.append(f"est={self.rows_estimated:g}")
+        if self.loops is not None and self.loops != 1:
+            stats.append(f"loops={self.loops}")
+        if self.time is not None:
+            stats.append(f"time={self.time:.3g}ms")
+        if self.self_time is not None:
+            stats.append(f"self={self.self_time:.3g}ms")
+        if self.buffers_hit or self.buffers_read:
+            stats.append(f"hit={self.buffers_hit or 0} read={self.buffers_read or 0}")
+        return f"{line} [{' '.join(stats)}]" if stats else line
+
+
+@dataclass
+class Plan:
+    root: PlanNode
+    analyzed: bool
+    planning_time: Optional[float] = None
+    execution_time: Optional[float] = None
+
+    def nodes(self) -> list[PlanNode]:
+        return list(self.root.walk())
+
+    def slowest_nodes(self, n: int = 3) -> list[PlanNode]:
+        timed = [node for node in self.nodes() if node.self_time is not None]
+        return sorted(timed, key=lambda node: node.self_time or 0, reverse=True)[:n]
+
+    def misestimated_nodes(self, n: int = 3, threshold: float = 2) -> list[PlanNode]:
+        """The nodes whose row estimates were off by at least `threshold`x."""
+        off = [
+            node
+            for node in self.nodes()
+            if node.estimate_error is not None and node.estimate_error >= threshold
+        ]
+        return sorted(off, key=lambda node: node.estimate_error or 0, reverse=True)[:n]
+
+    def shape(self) -> str:
+        """
+        A hash of the plan's structure, ignoring costs, timings and row
+        counts, so that the same plan hashes the same across runs.
+        """
+
+        def structure(node: PlanNode) -> list:
+            return [
+                node.node_type,
+                node.relation,
+                [structure(child) for child in node.children],
+            ]
+
+        encoded = json.dumps(structure(self.root))
+        return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+    def digest(self, collapse_below: float = 0) -> str:
+        """
+        A compact rendering of the plan, one line per node, followed by its hot
+        spots. Subtrees that take less than `collapse_below` of the plan's
+        time, or of its cost if it wasn't analyzed, are shown as their top
+        node only.
+        """
+
+        lines = []
+        total = self._weight(self.root)
+
+        def render(node: PlanNode, depth: int):
+            line = f"{'  ' * depth}-> {node.describe()}"
+            if (
+                depth
+                and node.children
+                and collapse_below
+                and total
+                and (self._weight(node) or 0) < collapse_below * total
+            ):
+                hidden = sum(1 for _ in node.walk()) - 1
+                lines.append(f"{line} (+{hidden} nodes below)")
+                return
+            lines.append(line)
+            for child in node.children:
+                render(child, depth + 1)
+
+        render(self.root, 0)
+
+        if self.planning_time is not None:
+            lines.append(f"Planning time: {self.planning_time:.3g}ms")
+        if self.execution_time is not None:
+            lines.append(f"Execution time: {self.execution_time:.3g}ms")
+
+        slowest = self.slowest_nodes()
+        if slowest:
+            lines.append("Slowest nodes by self time:")
+            lines.extend(f"  {node.describe()}" for node in slowest)
+        misestimated = self.misestimated_nodes()
+        if misestimated:
+            lines.append("Worst row estimates:")
+            lines.extend(
+                f"  {node.estimate_error:.3g}x off: {node.describe()}"
+                for node in misestimated
+            )
+
+        return "\n".join(lines)
+
+    def _weight(self, node: PlanNode) -> Optional[float]:
+        return node.time if self.analyzed else node.cost
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class PlanCache:
+    """
+    Recently seen plans, keyed on query text, so that a query run through
+    /query isn't executed again for /optimize. Plans expire after `ttl`
+    seconds, and only the `max_entries` most recently used are kept.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._plans: OrderedDict[str, tuple[float, Plan]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[Plan]:
+        key = query.strip()
+        with self._lock:
+            entry = self._plans.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._plans[key]
+                entry = None
+            metrics.cache_lookup("plan", hit=entry is not None)
+            if entry is None:
+                return None
+            self._plans.move_to_end(key)
+            return entry[1]
+
+    def put(self, query: str, plan: Plan) -> None:
+        if self.ttl <= 0:
+            return
+        key = query.strip()
+        with self._lock:
+            self._plans[key] = (time.monotonic(), plan)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+
+
+def _set_self_times(node: PlanNode) -> None:
+    for child in node.children:
+        _set_self_times(child)
+    if node.time is not None:
+        children_time = sum(child.time or 0 for child in node.children)
+        node.self_time = max(node.time - children_time, 0)
+
+
+_PG_DETAIL_KEYS = [
+    "Index Cond",
+    "Hash Cond",
+    "Merge Cond",
+    "Join Filter",
+    "Filter",
+    "Sort Key",
+    "Group Key",
+]
+
+
+def _parse_postgres_node(data: dict) -> PlanNode:
+    details = []
+    for key in _PG_DETAIL_KEYS:
+        if key in data:
+            value = data[key]
+            if isinstance(value, list):
+                value = ", ".join(value)
+            details.append(f"{key}: {value}")
+    if data.get("Index Name"):
+        details.insert(0, f"using {data['Index Name']}")
+
+    loops = data.get("Actual Loops")
+    total_time = data.get("Actual Total Time")
+    return PlanNode(
+        node_type=" ".join(filter(None, [data.get("Join Type"), data["Node Type"]])),
+        relation=data.get("Relation Name"),
+        detail="; ".join(details) or None,
+        cost=data.get("Total Cost"),
+        rows_estimated=data.get("Plan Rows"),
+        rows_actual=data.get("Actual Rows"),
+        loops=loops,
+        # Actual times are per loop.
+        time=total_time * loops if total_time is not None and loops else None,
+        buffers_hit=data.get("Shared Hit Blocks"),
+        buffers_read=data.get("Shared Read Blocks"),
+        children=[_parse_postgres_node(child) for child in data.get("Plans", [])],
+    )
+
+
+def parse_postgres(explain: object) -> Plan:
+    """Parse the output of Postgres' `EXPLAIN (FORMAT JSON)`."""
+
+    if isinstance(explain, str):
+        explain = json.loads(explain)
+    top = explain[0]  # type: ignore
+    root = _parse_postgres_node(top["Plan"])
+    _set_self_times(root)
+    return Plan(
+        root=root,
+        analyzed="Actual Total Time" in top["Plan"],
+        planning_time=top.get("Planning Time"),
+        execution_time=top.get("Execution Time"),
+    )
+
+
+_MYSQL_NUMBER = r"[\d.]+(?:e[+-]?\d+)?"
+_MYSQL_LINE = re.compile(
+    rf"^(?P<indent> *)-> (?P<description>.*?)"
+    rf"(?:\s+\(cost=(?:{_MYSQL_NUMBER}\.\.)?(?P<cost>{_MYSQL_NUMBER})"
+    rf" rows=(?P<rows_estimated>{_MYSQL_NUMBER})\))?"
+    rf"(?:\s+\(actual time={_MYSQL_NUMBER}\.\.(?P<time>{_MYSQL_NUMBER})"
+    rf" rows=(?P<rows_actual>{_MYSQL_NUMBER}) loops=(?P<loops>\d+)\))?"
+    rf"(?P<never>\s+\(never executed\))?$"
+)
+_MYSQL_RELATION = re.compile(r" on (\w+)")
+
+
+def parse_mysql(explain: str) -> Plan:
+    """
+    Parse the output of MySQL's `EXPLAIN FORMAT=TREE` or `EXPLAIN ANALYZE`,
+    where each node is a line starting with `->`, indented four spaces per
+    level.
+    """
+
+    root: Optional[PlanNode] = None
+    stack: list[tuple[int, PlanNode]] = []
+    analyzed = False
+
+    for line in explain.splitlines():
+        match = _MYSQL_LINE.match(line)
+        if match is None:
+            # Long conditions wrap onto lines of their own.
+            if stack and line.strip():
+                node = stack[-1][1]
+                node.detail = f"{node.detail or ''} {line.strip()}".strip()
+            continue
+
+        description = match.group("description")
+        relation = _MYSQL_RELATION.search(description)
+        loops = int(match.group("loops")) if match.group("loops") else None
+        per_loop_time = match.group("time")
+        node_type, _, detail = description.partition(": ")
+        node = PlanNode(
+            node_type=node_type,
+            relation=relation.group(1) if relation else None,
+            detail=detail or None,
+            cost=float(match.group("cost")) if match.group("cost") else None,
+            rows_estimated=(
+                float(match.group("rows_estimated"))
+                if match.group("rows_estimated")
+                else None
+            ),
+            rows_actual=(
+                float(match.group("rows_actual"))
+                if match.group("rows_actual")
+                else None
+            ),
+            loops=loops,
+            time=float(per_loop_time) * loops if per_loop_time and loops else None,
+        )
+        if match.group("never"):
+            node.rows_actual, node.loops, node.time = 0, 0, 0
+        analyzed = analyzed or node.time is not None
+
+        depth = len(match.group("indent")) // 4
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        if stack:
+            stack[-1][1].children.append(node)
+        else:
+            root = node
+        stack.append((depth, node))
+
+    if root is None:
+        raise ValueError("Could not parse MySQL EXPLAIN output.")
+
+    _set_self_times(root)
+    return Plan(root=root, analyzed=analyzed)
@@ -0,0 +1,268 @@
+# Fitting prompts into the models' context windows: counting tokens the way
+# each configured model does, and compressing the schema and plan until the
+# prompt fits all of them.
+
+from __future__ import annotations
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import accumulate
+import re
+
+from typing import Callable, Iterator, Union
+
+from litellm import get_max_tokens, token_counter
+
+from aqo.config import Config
+from aqo.plan import Plan
+from aqo.providers import Provider
+from aqo.schema import Schema
+
+# For models litellm doesn't know the context window of, when the config
+# doesn't give `max_input_tokens` either.
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Roughly what chat formatting adds per message, on top of its content.
+MESSAGE_OVERHEAD = 4
+
+# Render the schema, query, plan and the list of what was left out as
+# messages for the model.
+Renderer = Callable[[str, str, str, list[str]], list[dict]]
+
+
+class PromptTooLarge(ValueError):
+    pass
+
+
+@dataclass
+class Prompt:
+    messages: list[dict]
+    tokens: int
+    # What was left out of the schema and plan to make the prompt fit.
+    omitted: list[str]
+
+
+@lru_cache(maxsize=None)
+def context_window(model: str) -> int:
+    try:
+        info = get_max_tokens(model)
+    except Exception:
+        return DEFAULT_CONTEXT_WINDOW
+    # Older versions of litellm return the model's whole entry.
+    if isinstance(info, dict):
+        info = info.get("max_input_tokens") or info.get("max_tokens")
+    return int(info) if info else DEFAULT_CONTEXT_WINDOW
+
+
+def count_tokens(model: str, messages: list[dict]) -> int:
+    try:
+        tokens = token_counter(model=model, messages=messages)
+    except Exception:
+        # Without a tokenizer for the model, assume about three characters
+        # per token, which errs on the side of SQL's short tokens.
+        tokens = sum(len(message["content"]) for message in messages) // 3
+    return tokens + MESSAGE_OVERHEAD * len(messages)
+
+
+def count_text(model: str, text: str) -> int:
+    try:
+        return token_counter(model=model, text=text)
+    except Exception:
+        return len(text) // 3
+
+
+class PromptBuilder:
+    """
+    Builds the messages for a request so that they fit the context window of
+    every configured model, less `prompt_reserve_tokens` for the answer, and
+    within `prompt_max_tokens` if set.
+
+    The query is always sent whole. When the rest doesn't fit, it is
+    compressed step by step, starting with what matters least: comments in the
+    schema, then repeated partitions, then the cheapest subtrees of the plan,
+    then tables the query doesn't mention, then constraints and indexes. As a
+    last resort the schema, and then the plan, are cut short. Whatever is left
+    out is listed in the prompt and in the returned Prompt.
+    """
+
+    def __init__(self, config: Config, providers: list[Provider], render: Renderer):
+        self.config = config
+        self.render = render
+        self.budgets: dict[str, int] = {}
+        for provider in providers:
+            window = provider.max_input_tokens or context_window(provider.litellm_model)
+            budget = window - config.prompt_reserve_tokens
+            if config.prompt_max_tokens:
+                budget = min(budget, config.prompt_max_tokens)
+            model = provider.litellm_model
+            self.budgets[model] = min(budget, self.budgets.get(model, budget))
+
+    def count(self, messages: list[dict]) -> int:
+        """The most tokens the messages come to for any of the models."""
+        return max(count_tokens(model, messages) for model in self.budgets)
+
+    def fits(self, messages: list[dict]) -> bool:
+        return all(
+            count_tokens(model, messages) <= budget
+            for model, budget in self.budgets.items()
+        )
+
+    def build(
+        self, schema: Union[Schema, str], query: str, plan: Union[Plan, str]
+    ) -> Prompt:
+        for schema_text, plan_text, omitted in self._candidates(schema, query, plan):
+            messages = self.render(schema_text, query, plan_text, omitted)
+            if self.fits(messages):
+                return Prompt(messages, self.count(messages), omitted)
+        return self._truncated(schema_text, query, plan_text, omitted)
+
+    def _candidates(
+        self, schema: Union[Schema, str], query: str, plan: Union[Plan, str]
+    ) -> Iterator[tuple[str, str, list[str]]]:
+        """
+        Yield the schema and plan as text, along with what was left out of
+        them, each more compressed than the last.
+        """
+
+        schema_omitted: list[str] = []
+        plan_omitted: list[str] = []
+
+        def text(schema, plan) -> tuple[str, str, list[str]]:
+            return (
+                schema.to_ddl() if isinstance(schema, Schema) else schema,
+                plan.digest() if isinstance(plan, Plan) else plan,
+                schema_omitted + plan_omitted,
+            )
+
+        yield text(schema, plan)
+
+        if isinstance(schema, Schema):
+            if any(
+                table.comment or any(column.comment for column in table.columns)
+                for table in schema.tables.values()
+            ):
+                schema = schema.without_comments()
+                schema_omitted.append("table and column comments")
+                yield text(schema, plan)
+
+            schema, collapsed = schema.collapse_partitions()
+            if collapsed:
+                schema_omitted.extend(collapsed)
+                yield text(schema, plan)
+
+        plan_text = text(schema, plan)[1]
+        if isinstance(plan, Plan):
+            weight = "time" if plan.analyzed else "cost"
+            for share in [0.01, 0.05, 0.2, 0.5, 1.0]:
+                digest = plan.digest(collapse_below=share)
+                if digest == plan_text:
+                    continue
+                plan_text = digest
+                plan_omitted[:] = [
+                    f"plan nodes under subtrees with less than {share:.0%} of "
+                    f"the {weight}"
+                ]
+                yield text(schema, plan_text)
+
+        if isinstance(schema, Schema):
+            referenced = schema.referenced_by(query)
+            if referenced and len(referenced) < len(schema.tables):
+                dropped = sorted(set(schema.tables) - referenced)
+                schema = Schema(
+                    tables={
+                        key: table
+                        for key, table in schema.tables.items()
+                        if key in referenced
+                    }
+                )
+                schema_omitted.append(
+                    f"{len(dropped)} related tables not in the query: "
+                    + ", ".join(dropped[:10])
+                    + (", ..." if len(dropped) > 10 else "")
+                )
+                yield text(schema, plan_text)
+
+            schema_omitted.append("constraints, indexes and view definitions")
+            yield text(schema.summary(), plan_text)
+
+    def _truncated(
+        self, schema_text: str, query: str, plan_text: str, omitted: list[str]
+    ) -> Prompt:
+        """
+        Cut the schema, and then the plan if that isn't enough, to the longest
+        prefix that fits.
+        """
+
+        schema_omitted = omitted + ["the rest of the schema"]
+
+        def render_schema(text: str) -> list[dict]:
+            return self.render(text, query, plan_text, schema_omitted)
+
+        if self.fits(render_schema("")):
+            length = self._prefix_length(schema_text, render_schema)
+            messages = render_schema(schema_text[:length])
+            return Prompt(messages, self.count(messages), schema_omitted)
+
+        plan_omitted = omitted + ["the schema", "the rest of the plan"]
+
+        def render_plan(text: str) -> list[dict]:
+            return self.render("", query, text, plan_omitted)
+
+        if not self.fits(render_plan("")):
+            raise PromptTooLarge(
+                "the query alone doesn't fit in the model's context window"
+            )
+        length = self._prefix_length(plan_text, render_plan)
+        messages = render_plan(plan_text[:length])
+        return Prompt(messages, self.count(messages), plan_omitted)
+
+    def _prefix_length(self, text: str, render: Callable[[str], list[dict]]) -> int:
+        """
+        The length of the longest prefix of `text` that fits once rendered,
+        given that none of it does. The text is cut between tables of a
+        schema or lines of a plan. Each of those is counted once, and the
+        prefix found from their running sums, rather than counting the whole
+        prompt again for every length tried.
+        """
+
+        pieces = _pieces(text)
+        ends = list(accumulate(len(piece) for piece in pieces))
+        empty = render("")
+        whole = len(pieces)
+        for model, budget in self.budgets.items():
+            room = budget - count_tokens(model, empty)
+            sums = accumulate(count_text(model, piece) for piece in pieces)
+            whole = min(whole, bisect_right(list(sums), room))
+
+        # Text doesn't always count the same in pieces as it does whole, so
+        # check the result, and give up a piece at a time until it fits.
+        while whole and not self.fits(render(text[: ends[whole - 1]])):
+            whole -= 1
+        if whole:
+            return ends[whole - 1]
+        # Not even the first piece fits, so keep as much of it as does.
+        return _longest(lambda length: self.fits(render(text[:length])), ends[0])
+
+
+def _pieces(text: str) -> list[str]:
+    """
+    Split text into the tables of a schema, which are separated by blank
+    lines, or else into lines. Joined, the pieces are the original text.
+    """
+    pieces = re.split(r"(?<=\n\n)", text)
+    if len(pieces) == 1:
+        pieces = text.splitlines(keepends=True)
+    return [piece for piece in pieces if piece] or [text]
+
+
+def _longest(fits: Callable[[int], bool], length: int) -> int:
+    """The largest length up to `length` that fits, given that 0 does."""
+
+    low, high = 0, length
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
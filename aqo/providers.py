@@ -0,0 +1,462 @@
+# Calling several LLM providers for the same advice: hedging slow ones with
+# the next in line, and skipping ones that keep failing.
+
+from __future__ import annotations
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import itertools
+import threading
+import time
+
+from typing import Callable, Optional
+
+from litellm import acompletion, completion
+
+from aqo import metrics
+
+
+@dataclass
+class Provider:
+    """One model on one provider, as configured in `ai_model` or a fallback."""
+
+    provider: str
+    model_name: str
+    api_key: Optional[str] = None
+    api_base: Optional[str] = None
+    api_version: Optional[str] = None
+    json_mode: bool = False
+    # The model's context window, when litellm doesn't know it.
+    max_input_tokens: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Provider:
+        return cls(
+            provider=data["provider"],
+            model_name=data["model_name"],
+            api_key=data.get("api_key"),
+            api_base=data.get("api_base"),
+            api_version=data.get("api_version"),
+            # Ollama's JSON mode works with any model, but OpenAI's only with
+            # some, so it has to be turned on there.
+            json_mode=data.get("json_mode", data["provider"] == "ollama"),
+            max_input_tokens=data.get("max_input_tokens"),
+        )
+
+    @property
+    def litellm_model(self) -> str:
+        if self.provider in ["openai", "anthropic"]:
+            return self.model_name
+        return f"{self.provider}/{self.model_name}"
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}/{self.model_name}"
+
+    def completion_args(self) -> dict:
+        args = {"model": self.litellm_model, "api_base": self.api_base}
+        if self.api_key:
+            args["api_key"] = self.api_key
+        if self.api_version:
+            args["api_version"] = self.api_version
+        if self.json_mode and self.provider == "openai":
+            args["response_format"] = {"type": "json_object"}
+        elif self.json_mode and self.provider == "ollama":
+            args["format"] = "json"
+        return args
+
+
+class CircuitBreaker:
+    """
+    Tracks a provider's health. After `failure_threshold` failures in a row
+    the circuit opens and the provider is skipped, until `cooldown` seconds
+    have passed and one trial request is let through. Also keeps a moving
+    average of successful response times.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.latency: Optional[float] = None
+        # The ticket of the trial request while one is in flight.
+        self._trial: Optional[int] = None
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> Optional[int]:
+        """
+        Return a ticket for a request if the circuit lets it through, or None
+        if it doesn't.
+        """
+
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return next(self._tickets)
+            if state == "half_open" and self._trial is None:
+                self._trial = next(self._tickets)
+                return self._trial
+            return None
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.failures = 0
+            self.opened_at = None
+            self._trial = None
+            self.latency = (
+                latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            )
+
+    def release(self, ticket: Optional[int]) -> None:
+        """
+        Give up on a request without an outcome, such as a hedge that lost, so
+        that if it was the trial request, it doesn't hold the circuit half
+        open for good.
+        """
+        with self._lock:
+            if ticket is not None and self._trial == ticket:
+                self._trial = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+            self.failures += 1
+            self._trial = None
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency": self.latency,
+        }
+
+
+class ProviderPool:
+    """
+    Runs a completion against the configured providers in order. If the
+    current one hasn't answered within `delay` seconds, the next one is
+    started alongside it, and a failed or invalid answer starts the next one
+    straight away. The first valid answer wins and the rest are cancelled.
+
+    Only errors count against a provider's circuit. An answer that `accept`
+    rejects, such as one that doesn't parse, is still a working provider.
+    """
+
+    def __init__(
+        self,
+        providers: list[Provider],
+        delay: float,
+        failure_threshold: int,
+        cooldown: float,
+    ):
+        self.providers = providers
+        self.delay = delay
+        self.breakers = {
+            provider.name: CircuitBreaker(failure_threshold, cooldown)
+            for provider in providers
+        }
+        # Shared by every `complete_sync` call. Losing requests keep their
+        # thread until they finish, so there is room for several calls'.
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(32, 4 * len(providers)), thread_name_prefix="aqo-llm"
+        )
+
+    def _take(self, queue: list[Provider]) -> Optional[tuple[Provider, int]]:
+        """
+        Pop providers off `queue` until one whose circuit lets it through, and
+        return it with its ticket.
+        """
+        while queue:
+            provider = queue.pop(0)
+            ticket = self.breakers[provider.name].allow()
+            if ticket is not None:
+                return provider, ticket
+        return None
+
+    def _first(self, queue: list[Provider]) -> tuple[Provider, Optional[int]]:
+        # If every circuit is open, try the first provider anyway rather than
+        # failing outright.
+        return self._take(queue) or (self.providers[0], None)
+
+    def _record(self, provider: Provider, call: Callable[[], tuple]) -> None:
+        """Record the outcome of a finished call on its provider's circuit."""
+        try:
+            _, latency = call()
+        except Exception:
+            self.breakers[provider.name].record_failure()
+            return
+        self.breakers[provider.name].record_success(latency)
+
+    def stats(self) -> dict:
+        return {name: breaker.to_dict() for name, breaker in self.breakers.items()}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def complete(
+        self,
+        messages: list[dict],
+        accept: Callable[[dict], bool],
+        **kwargs,
+    ) -> tuple[Provider, dict]:
+        """
+        Return the first completion that `accept` approves, and the provider
+        that gave it. If none is approved, the last completion is returned, or
+        the last error raised.
+        """
+
+        queue = list(self.providers)
+        running: dict[asyncio.Task, tuple[Provider, Optional[int]]] = {}
+        last_result: Optional[tuple[Provider, dict]] = None
+        last_error: Optional[Exception] = None
+
+        def start(provider: Provider, ticket: Optional[int]) -> None:
+            task = asyncio.ensure_future(self._call(provider, messages, **kwargs))
+            running[task] = (provider, ticket)
+
+        def start_next() -> None:
+            taken = self._take(queue)
+            if taken is not None:
+                start(*taken)
+
+        start(*self._first(queue))
+        try:
+            while running:
+                timeout = self.delay if queue and self.delay > 0 else None
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Hedge: the current providers are slow, so start another.
+                    start_next()
+                    continue
+
+                # Every task that finished is recorded, even once one has won.
+                winner = None
+                for task in done:
+                    provider, _ = running.pop(task)
+                    self._record(provider, task.result)
+                    if task.exception() is not None:
+                        last_error = task.exception()  # type: ignore
+                        continue
+                    result, _ = task.result()
+                    if accept(result):
+                        winner = winner or (provider, result)
+                    else:
+                        last_result = (provider, result)
+                if winner is not None:
+                    return winner
+                for _ in done:
+                    start_next()
+        finally:
+            for task, (provider, ticket) in running.items():
+                task.cancel()
+                self.breakers[provider.name].release(ticket)
+
+        if last_result is not None:
+            return last_result
+        assert last_error is not None
+        raise last_error
+
+    def complete_sync(
+        self,
+        messages: list[dict],
+        accept: Callable[[dict], bool],
+        throttle: Optional[Callable[[], None]] = None,
+        **kwargs,
+    ) -> tuple[Provider, dict]:
+        """
+        Like `complete`, but for callers without an event loop. Threads can't
+        be cancelled, so losing requests are left to finish in the background
+        and their results dropped. `throttle` is called before each request
+        is sent, hedges included, and may block to rate limit them.
+        """
+
+        queue = list(self.providers)
+        running: dict[Future, tuple[Provider, Optional[int]]] = {}
+        last_result: Optional[tuple[Provider, dict]] = None
+        last_error: Optional[Exception] = None
+
+        def start(provider: Provider, ticket: Optional[int]) -> None:
+            future = self._executor.submit(
+                self._call_sync, provider, messages, throttle, **kwargs
+            )
+            running[future] = (provider, ticket)
+
+        def start_next() -> None:
+            taken = self._take(queue)
+            if taken is not None:
+                start(*taken)
+
+        start(*self._first(queue))
+        try:
+            while running:
+                timeout = self.delay if queue and self.delay > 0 else None
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    start_next()
+                    continue
+
+                winner = None
+                for future in done:
+                    provider, _ = running.pop(future)
+                    self._record(provider, future.result)
+                    if future.exception() is not None:
+                        last_error = future.exception()  # type: ignore
+                        continue
+                    result, _ = future.result()
+                    if accept(result):
+                        winner = winner or (provider, result)
+                    else:
+                        last_result = (provider, result)
+                if winner is not None:
+                    return winner
+                for _ in done:
+                    start_next()
+        finally:
+            for future, (provider, ticket) in running.items():
+                if future.cancel():
+                    self.breakers[provider.name].release(ticket)
+                else:
+                    # Already running, so its outcome is recorded when it
+                    # finishes, though the result itself is dropped.
+                    future.add_done_callback(
+                        lambda future, provider=provider: self._record(
+                            provider, future.result
+                        )
+                    )
+
+        if last_result is not None:
+            return last_result
+        assert last_error is not None
+        raise last_error
+
+    def _call_sync(
+        self,
+        provider: Provider,
+        messages: list[dict],
+        throttle: Optional[Callable[[], None]],
+        **kwargs,
+    ) -> tuple[dict, float]:
+        if throttle is not None:
+            throttle()
+        start_time = time.monotonic()
+        with metrics.span("llm.completion", provider=provider.name):
+            try:
+                result = completion(
+                    messages=messages, **provider.completion_args(), **kwargs
+                )
+            except Exception:
+                self._observe(provider, start_time, "error")
+                raise
+        return result, self._observe(provider, start_time, "ok", result)
+
+    async def _call(
+        self, provider: Provider, messages: list[dict], **kwargs
+    ) -> tuple[dict, float]:
+        start_time = time.monotonic()
+        with metrics.span("llm.completion", provider=provider.name):
+            try:
+                result = await acompletion(
+                    messages=messages, **provider.completion_args(), **kwargs
+                )
+            except asyncio.CancelledError:
+                # Lost the hedge; not a failure of the provider.
+                self._observe(provider, start_time, "cancelled")
+                raise
+            except Exception:
+                self._observe(provider, start_time, "error")
+                raise
+        return result, self._observe(provider, start_time, "ok", result)
+
+    def _observe(
+        self,
+        provider: Provider,
+        start_time: float,
+        outcome: str,
+        result: Optional[dict] = None,
+    ) -> float:
+        latency = time.monotonic() - start_time
+        metrics.LLM_SECONDS.observe(latency, provider=provider.name, outcome=outcome)
+        if result is not None:
+            metrics.record_usage(provider.name, result)
+        return latency
+
+    async def stream(
+        self, messages: list[dict], **kwargs
+    ) -> tuple[Provider, object, Callable[[Optional[bool]], None]]:
+        """
+        Start a streamed completion on the first provider that accepts the
+        request. Streams can't be hedged once they have started, so this only
+        falls through to the next provider on errors starting one. Returns a
+        callback to record whether the stream succeeded, or None if it was
+        abandoned; only its first call counts.
+        """
+
+        last_error: Optional[Exception] = None
+        queue = list(self.providers)
+        taken: Optional[tuple[Provider, Optional[int]]] = self._first(queue)
+        while taken is not None:
+            provider, ticket = taken
+            breaker = self.breakers[provider.name]
+            start_time = time.monotonic()
+            try:
+                response = await acompletion(
+                    messages=messages,
+                    stream=True,
+                    **provider.completion_args(),
+                    **kwargs,
+                )
+            except asyncio.CancelledError:
+                breaker.release(ticket)
+                raise
+            except Exception as e:
+                self._observe(provider, start_time, "error")
+                breaker.record_failure()
+                last_error = e
+                taken = self._take(queue)
+                continue
+
+            finished = False
+
+            def finish(
+                ok: Optional[bool],
+                provider=provider,
+                breaker=breaker,
+                ticket=ticket,
+                start_time=start_time,
+            ) -> None:
+                nonlocal finished
+                if finished:
+                    return
+                finished = True
+                if ok is None:
+                    breaker.release(ticket)
+                    return
+                latency = self._observe(provider, start_time, "ok" if ok else "error")
+                if ok:
+                    breaker.record_success(latency)
+                else:
+                    breaker.record_failure()
+
+            return provider, response, finish
+
+        assert last_error is not None
+        raise last_error
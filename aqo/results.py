@@ -0,0 +1,240 @@
+# Query results kept on disk after a query runs, so that they can be paged
+# through without running the query again or holding them in memory.
+
+from __future__ import annotations
+from bisect import bisect_right
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from typing import Iterator, Optional
+
+from aqo import formats
+from aqo.config import Config
+
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+class ResultSession:
+    """
+    The rows of one query's result, spilled to a file in batches. Each batch
+    is written separately with `formats.dump_batch`, as Arrow IPC or typed
+    JSON, and its offset kept, so reading a page only loads the batches that
+    overlap it.
+
+    The file is held open for as long as the session lives, so its rows stay
+    readable even if another process removes the directory as stale.
+
+    A session is `complete` when it holds every row of the result, rather than
+    stopping at the row or size cap.
+    """
+
+    def __init__(self, session_id: str, query: str, path: str):
+        self.id = session_id
+        self.query = query
+        self.path = path
+        self.headers: list[str] = []
+        # The type of each column, where the database reports one.
+        self.types: list[Optional[formats.ColumnType]] = []
+        self.rowcount = 0
+        self.size = 0
+        self.complete = False
+        self.deleted = False
+        self.created_at = time.time()
+        self.accessed_at = self.created_at
+        self._file = open(path, "w+b")
+        # The file offset, length and first row number of each batch.
+        self._offsets: list[int] = []
+        self._lengths: list[int] = []
+        self._starts: list[int] = []
+
+    def append(self, rows: list[list]) -> None:
+        if not rows or self.deleted:
+            return
+        data = formats.dump_batch(self.headers, rows)
+        self._file.write(data)
+        self._file.flush()
+        _touch(os.path.dirname(self.path))
+        # Readers go by `_starts`, so it is extended last.
+        self._offsets.append(self.size)
+        self._lengths.append(len(data))
+        self._starts.append(self.rowcount)
+        self.size += len(data)
+        self.rowcount += len(rows)
+
+    def rows(self, offset: int, limit: int) -> list[list]:
+        """Return up to `limit` rows, starting from row number `offset`."""
+
+        result: list[list] = []
+        for rows in self.batches(offset, limit):
+            result.extend(rows)
+        return result
+
+    def batches(self, offset: int, limit: Optional[int] = None) -> Iterator[list[list]]:
+        """
+        Iterate over the rows from row number `offset` in the batches they
+        were written in, up to `limit` rows or to the end, reading one batch
+        at a time. Raises FileNotFoundError if the session has been deleted.
+
+        The iterator has a descriptor of its own, which keeps the rows
+        readable to the end even if the session is deleted partway through,
+        and which is closed once it has been run to the end.
+        """
+
+        end = self.rowcount if limit is None else min(offset + limit, self.rowcount)
+        if offset >= end:
+            return iter([])
+        try:
+            fd = os.dup(self._file.fileno())
+        except (OSError, ValueError):
+            raise FileNotFoundError(f"Result {self.id} has been deleted.")
+        return self._read(fd, offset, end)
+
+    def _read(self, fd: int, offset: int, end: int) -> Iterator[list[list]]:
+        try:
+            batch = bisect_right(self._starts, offset) - 1
+            while batch < len(self._starts) and self._starts[batch] < end:
+                data = os.pread(fd, self._lengths[batch], self._offsets[batch])
+                rows = formats.load_batch(data)
+                start = self._starts[batch]
+                yield rows[max(offset - start, 0) : end - start]
+                batch += 1
+        finally:
+            os.close(fd)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "query": self.query,
+            "headers": self.headers,
+            "rowcount": self.rowcount,
+            "complete": self.complete,
+            "size": self.size,
+            "created_at": self.created_at,
+            "accessed_at": self.accessed_at,
+        }
+
+    def delete(self) -> None:
+        self.deleted = True
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ResultStore:
+    """
+    The result sessions of recent queries, by id.
+
+    Sessions idle for longer than `results_idle_timeout` seconds are evicted,
+    as are the least recently used ones once there are more than
+    `results_max_sessions` or their files take more than `results_max_bytes`.
+    Eviction happens whenever a session is created or looked up.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        os.makedirs(config.results_path, exist_ok=True)
+        self._remove_stale(config.results_path)
+        # Each store has its own directory, so that the shell and the server
+        # can share a data directory.
+        self.path = tempfile.mkdtemp(dir=config.results_path)
+        self._sessions: dict[str, ResultSession] = {}
+        self._lock = threading.Lock()
+
+    def _remove_stale(self, path: str) -> None:
+        # Directories untouched for longer than the idle timeout only hold
+        # evicted sessions, or ones left behind by a process that exited. A
+        # store touches its directory whenever a session is read or written.
+        cutoff = time.time() - self.config.results_idle_timeout
+        for entry in os.scandir(path):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def create(self, session_id: str, query: str) -> ResultSession:
+        """Start a session, replacing any existing one with the same id."""
+
+        # Another store may have removed the directory as stale.
+        os.makedirs(self.path, exist_ok=True)
+        session = ResultSession(
+            session_id, query, os.path.join(self.path, f"{uuid.uuid4().hex}.batches")
+        )
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            self._sessions[session_id] = session
+        if previous is not None:
+            previous.delete()
+        self.evict()
+        return session
+
+    def full(self, session: ResultSession) -> bool:
+        """
+        Whether a session has reached the caps and should stop spilling. The
+        byte cap is on the session's file, since rows are kept on disk.
+        """
+        return (
+            session.deleted
+            or session.rowcount >= self.config.results_max_rows
+            or session.size >= self.config.results_max_bytes
+        )
+
+    def get(self, session_id: str) -> Optional[ResultSession]:
+        self.evict()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.accessed_at = time.time()
+        if session is not None:
+            _touch(self.path)
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        """Delete a session, returning False if there is none by that id."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.delete()
+        return True
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [session.to_dict() for session in self._sessions.values()]
+
+    def evict(self) -> None:
+        cutoff = time.time() - self.config.results_idle_timeout
+        evicted = []
+        with self._lock:
+            by_use = sorted(self._sessions.values(), key=lambda s: s.accessed_at)
+            total_size = sum(session.size for session in by_use)
+            for i, session in enumerate(by_use):
+                # The most recently used session is kept even when it is over
+                # the caps by itself, since it may be the one being filled.
+                over_caps = i < len(by_use) - 1 and (
+                    len(self._sessions) > self.config.results_max_sessions
+                    or total_size > self.config.results_max_bytes
+                )
+                if session.accessed_at >= cutoff and not over_caps:
+                    break
+                del self._sessions[session.id]
+                total_size -= session.size
+                evicted.append(session)
+        for session in evicted:
+            session.delete()
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.delete()
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,804 @@
+from __future__ import annotations
+from dataclasses import asdict, dataclass, field, replace
+import json
+import os
+import re
+import threading
+import time
+
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from aqo import metrics
+from aqo.config import Config
+from aqo.sql import identifiers
+
+if TYPE_CHECKING:
+    from aqo.db import Database
+
+
+@dataclass
+class Column:
+    name: str
+    type: str
+    nullable: bool = True
+    default: Optional[str] = None
+    extra: Optional[str] = None
+    comment: Optional[str] = None
+
+    def to_ddl(self) -> str:
+        ddl = f"{self.name} {self.type}"
+        if not self.nullable:
+            ddl += " NOT NULL"
+        if self.default is not None:
+            ddl += f" DEFAULT {self.default}"
+        if self.extra:
+            ddl += f" {self.extra}"
+        return ddl
+
+
+@dataclass
+class Constraint:
+    """
+    A primary key, foreign key, unique or check constraint. `definition` is
+    the constraint as it appears after `CONSTRAINT <name>` in DDL.
+    """
+
+    name: str
+    kind: str
+    definition: str
+    referenced_table: Optional[str] = None
+
+
+@dataclass
+class Index:
+    name: str
+    columns: list[str]
+    unique: bool
+    definition: str
+
+
+@dataclass
+class Table:
+    schema: Optional[str]
+    name: str
+    kind: str = "table"
+    columns: list[Column] = field(default_factory=list)
+    constraints: list[Constraint] = field(default_factory=list)
+    indexes: list[Index] = field(default_factory=list)
+    row_estimate: Optional[int] = None
+    comment: Optional[str] = None
+    view_definition: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Table:
+        return cls(
+            **{
+                **data,
+                "columns": [Column(**column) for column in data["columns"]],
+                "constraints": [Constraint(**c) for c in data["constraints"]],
+                "indexes": [Index(**index) for index in data["indexes"]],
+            }
+        )
+
+    @property
+    def qualified_name(self) -> str:
+        if self.schema is None or self.schema == "public":
+            return self.name
+        return f"{self.schema}.{self.name}"
+
+    def to_ddl(self) -> str:
+        if self.kind in ["view", "materialized view"]:
+            return (
+                f"CREATE {self.kind.upper()} {self.qualified_name} AS\n"
+                f"{(self.view_definition or '').strip().rstrip(';')};"
+            )
+
+        lines = [(column.to_ddl(), column.comment) for column in self.columns]
+        lines += [
+            (f"CONSTRAINT {constraint.name} {constraint.definition}", None)
+            for constraint in self.constraints
+        ]
+
+        body = []
+        for i, (code, comment) in enumerate(lines):
+            line = f"    {code}{',' if i < len(lines) - 1 else ''}"
+            if comment:
+                line += f" -- {comment}"
+            body.append(line)
+
+        ddl = []
+        if self.comment:
+            ddl.append(f"-- {self.comment}")
+        if self.row_estimate is not None:
+            ddl.append(f"-- ~{self.row_estimate} rows")
+        ddl.append(f"CREATE TABLE {self.qualified_name} (")
+        ddl.extend(body)
+        ddl.append(");")
+        ddl.extend(f"{index.definition};" for index in self.indexes)
+        return "\n".join(ddl)
+
+
+# The suffix that tells partitions of the same table apart, as in
+# orders_2024_01, orders_p3 or orders_default.
+_PARTITION_SUFFIX = re.compile(r"(?:_(?:p|part)?\d+)+$|_default$")
+
+
+@dataclass
+class Schema:
+    """
+    A structured model of a database's schema, keyed on qualified table name.
+    """
+
+    tables: dict[str, Table] = field(default_factory=dict)
+
+    def to_ddl(self) -> str:
+        return "\n\n".join(table.to_ddl() for table in self.tables.values()) + "\n"
+
+    def referenced_by(self, query: str) -> set[str]:
+        """
+        Return the qualified names of the tables and views that a query
+        mentions.
+        """
+
+        names = identifiers(query)
+        return {
+            key
+            for key, table in self.tables.items()
+            if table.qualified_name.lower() in names
+            or (table.schema in [None, "public"] and table.name.lower() in names)
+        }
+
+    def slice(self, table_names: Iterable[str]) -> Schema:
+        """
+        Return the part of the schema needed to reason about the given tables:
+        the tables themselves with their indexes, the tables underlying any
+        views among them, and every table one foreign key away in either
+        direction.
+        """
+
+        selected = set(table_names)
+        for name in list(selected):
+            table = self.tables[name]
+            if table.view_definition is not None:
+                selected |= self.referenced_by(table.view_definition)
+
+        neighbours = set()
+        for key, table in self.tables.items():
+            for constraint in table.constraints:
+                target = constraint.referenced_table
+                if target is None or target not in self.tables:
+                    continue
+                if key in selected:
+                    neighbours.add(target)
+                if target in selected:
+                    neighbours.add(key)
+        selected |= neighbours
+
+        return Schema(
+            tables={key: table for key, table in self.tables.items() if key in selected}
+        )
+
+    def without_comments(self) -> Schema:
+        """A copy of the schema without table and column comments."""
+
+        return Schema(
+            tables={
+                key: replace(
+                    table,
+                    comment=None,
+                    columns=[replace(column, comment=None) for column in table.columns],
+                )
+                for key, table in self.tables.items()
+            }
+        )
+
+    def collapse_partitions(self) -> tuple[Schema, list[str]]:
+        """
+        Collapse tables with the same name apart from a numeric suffix and the
+        same columns, such as the partitions of a table, into one of them,
+        with a comment naming the rest. Returns the collapsed schema and a
+        description of what was left out.
+        """
+
+        groups: dict[tuple, list[str]] = {}
+        for key, table in self.tables.items():
+            stem = _PARTITION_SUFFIX.sub("", table.name) or table.name
+            columns = tuple((column.name, column.type) for column in table.columns)
+            groups.setdefault((table.schema, stem, table.kind, columns), []).append(key)
+
+        tables = dict(self.tables)
+        omitted = []
+        for (_, stem, _, _), keys in groups.items():
+            if len(keys) < 2:
+                continue
+            # Keep the partitioned table itself if it is there.
+            keys.sort(key=lambda key: (self.tables[key].name != stem, key))
+            kept, others = keys[0], keys[1:]
+            names = [self.tables[key].name for key in others]
+            if len(names) > 6:
+                names = [*names[:3], "...", *names[-2:]]
+            tables[kept] = replace(
+                tables[kept],
+                comment=f"{len(others)} more tables with the same columns: "
+                + ", ".join(names),
+            )
+            for key in others:
+                del tables[key]
+            omitted.append(f"{len(others)} tables with the same columns as {kept}")
+        return Schema(tables=tables), omitted
+
+    def summary(self) -> str:
+        """A compact listing of each table's columns, without constraints."""
+
+        lines = []
+        for table in self.tables.values():
+            columns = ", ".join(f"{c.name} {c.type}" for c in table.columns)
+            kind = "" if table.kind == "table" else f"{table.kind} "
+            lines.append(f"-- {kind}{table.qualified_name}({columns})")
+        return "\n".join(lines) + "\n"
+
+    def relevant_to(self, query: str) -> Schema:
+        """
+        Return the slice of the schema relevant to a query, or the whole schema
+        if the query doesn't mention any known table.
+        """
+
+        referenced = self.referenced_by(query)
+        if not referenced:
+            return self
+        return self.slice(referenced)
+
+
+def introspect(db: Database, only: Optional[Iterable[str]] = None) -> Schema:
+    """
+    Build a Schema by reading the DB's catalog over its own connection, with
+    one batched query per kind of object. If `only` is given, just those
+    tables (by qualified name) are read.
+    """
+
+    with metrics.span("schema.introspect"), metrics.SCHEMA_SECONDS.time():
+        if db.config.db_type == "postgres":
+            return _introspect_postgres(db, only)
+        else:
+            return _introspect_mysql(db, only)
+
+
+def _fetch(db: Database, query: str, params: Optional[tuple] = None) -> list:
+    cursor = db.cursor()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    cursor.close()
+    return list(rows)
+
+
+_PG_USER_NAMESPACES = """
+    n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname !~ '^pg_(toast|temp)'
+"""
+
+_PG_KINDS = {
+    "r": "table",
+    "p": "table",
+    "f": "table",
+    "v": "view",
+    "m": "materialized view",
+}
+
+
+def _pg_filter(only: Optional[Iterable[str]]) -> tuple[str, Optional[tuple]]:
+    """
+    Return a WHERE clause selecting user tables, restricted to `only` if given,
+    along with its parameters.
+    """
+
+    if only is None:
+        return _PG_USER_NAMESPACES, None
+
+    # Qualified names omit the public schema, so match on both forms.
+    return (
+        _PG_USER_NAMESPACES + """
+        AND (n.nspname || '.' || c.relname = ANY(%s)
+             OR (n.nspname = 'public' AND c.relname = ANY(%s)))
+        """,
+        (list(only), list(only)),
+    )
+
+
+def _introspect_postgres(db: Database, only: Optional[Iterable[str]]) -> Schema:
+    schema = Schema()
+    where, params = _pg_filter(only)
+
+    tables = _fetch(
+        db,
+        f"""
+        SELECT n.nspname, c.relname, c.relkind, c.reltuples::bigint,
+               obj_description(c.oid, 'pg_class'),
+               CASE WHEN c.relkind IN ('v', 'm') THEN pg_get_viewdef(c.oid) END
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p', 'f', 'v', 'm') AND {where}
+        ORDER BY n.nspname, c.relname
+        """,
+        params,
+    )
+    for namespace, name, kind, reltuples, comment, view_definition in tables:
+        table = Table(
+            schema=namespace,
+            name=name,
+            kind=_PG_KINDS[kind],
+            # reltuples is -1 (or 0 on older versions) until the table has
+            # been analyzed.
+            row_estimate=reltuples if reltuples and reltuples > 0 else None,
+            comment=comment,
+            view_definition=view_definition,
+        )
+        schema.tables[table.qualified_name] = table
+
+    def table_for(namespace: str, name: str) -> Optional[Table]:
+        return schema.tables.get(Table(schema=namespace, name=name).qualified_name)
+
+    columns = _fetch(
+        db,
+        f"""
+        SELECT n.nspname, c.relname, a.attname,
+               format_type(a.atttypid, a.atttypmod), a.attnotnull,
+               pg_get_expr(d.adbin, d.adrelid), col_description(c.oid, a.attnum)
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE a.attnum > 0 AND NOT a.attisdropped
+          AND c.relkind IN ('r', 'p', 'f', 'v', 'm') AND {where}
+        ORDER BY n.nspname, c.relname, a.attnum
+        """,
+        params,
+    )
+    for namespace, name, column, type_, not_null, default, comment in columns:
+        table = table_for(namespace, name)
+        if table is not None:
+            table.columns.append(
+                Column(
+                    name=column,
+                    type=type_,
+                    nullable=not not_null,
+                    default=default,
+                    comment=comment,
+                )
+            )
+
+    constraint_kinds = {
+        "p": "primary key",
+        "f": "foreign key",
+        "u": "unique",
+        "c": "check",
+    }
+    constraints = _fetch(
+        db,
+        f"""
+        SELECT n.nspname, c.relname, con.conname, con.contype,
+               pg_get_constraintdef(con.oid), rn.nspname, r.relname
+        FROM pg_constraint con
+        JOIN pg_class c ON c.oid = con.conrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_class r ON r.oid = con.confrelid
+        LEFT JOIN pg_namespace rn ON rn.oid = r.relnamespace
+        WHERE con.contype IN ('p', 'f', 'u', 'c') AND {where}
+        ORDER BY n.nspname, c.relname, con.contype, con.conname
+        """,
+        params,
+    )
+    for namespace, name, conname, contype, definition, ref_ns, ref_name in constraints:
+        table = table_for(namespace, name)
+        if table is not None:
+            table.constraints.append(
+                Constraint(
+                    name=conname,
+                    kind=constraint_kinds[contype],
+                    definition=definition,
+                    referenced_table=(
+                        Table(schema=ref_ns, name=ref_name).qualified_name
+                        if ref_name is not None
+                        else None
+                    ),
+                )
+            )
+
+    # Indexes backing primary key, unique and exclusion constraints are
+    # already described by the constraint.
+    indexes = _fetch(
+        db,
+        f"""
+        SELECT n.nspname, c.relname, i.relname, ix.indisunique,
+               pg_get_indexdef(ix.indexrelid),
+               ARRAY(
+                   SELECT pg_get_indexdef(ix.indexrelid, k, true)
+                   FROM generate_series(1, ix.indnkeyatts) AS k
+               )
+        FROM pg_index ix
+        JOIN pg_class i ON i.oid = ix.indexrelid
+        JOIN pg_class c ON c.oid = ix.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE {where}
+          AND NOT EXISTS (
+              SELECT 1 FROM pg_constraint con
+              WHERE con.conindid = ix.indexrelid AND con.contype IN ('p', 'u', 'x')
+          )
+        ORDER BY n.nspname, c.relname, i.relname
+        """,
+        params,
+    )
+    for namespace, name, index, unique, definition, index_columns in indexes:
+        table = table_for(namespace, name)
+        if table is not None:
+            table.indexes.append(
+                Index(
+                    name=index,
+                    columns=list(index_columns),
+                    unique=unique,
+                    definition=definition,
+                )
+            )
+
+    return schema
+
+
+def _mysql_filter(only: Optional[Iterable[str]]) -> tuple[str, Optional[tuple]]:
+    if only is None:
+        return "TABLE_SCHEMA = DATABASE()", None
+
+    only = list(only)
+    placeholders = ", ".join(["%s"] * len(only))
+    return f"TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})", tuple(only)
+
+
+def _introspect_mysql(db: Database, only: Optional[Iterable[str]]) -> Schema:
+    schema = Schema()
+    where, params = _mysql_filter(only)
+
+    tables = _fetch(
+        db,
+        f"""
+        SELECT TABLE_NAME, TABLE_TYPE, TABLE_ROWS, TABLE_COMMENT
+        FROM information_schema.TABLES
+        WHERE {where}
+        ORDER BY TABLE_NAME
+        """,
+        params,
+    )
+    for name, table_type, rows, comment in tables:
+        schema.tables[name] = Table(
+            schema=None,
+            name=name,
+            kind="view" if table_type == "VIEW" else "table",
+            row_estimate=rows,
+            comment=comment or None,
+        )
+
+    views = _fetch(
+        db,
+        f"""
+        SELECT TABLE_NAME, VIEW_DEFINITION
+        FROM information_schema.VIEWS
+        WHERE {where}
+        """,
+        params,
+    )
+    for name, definition in views:
+        if name in schema.tables:
+            schema.tables[name].view_definition = definition
+
+    columns = _fetch(
+        db,
+        f"""
+        SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_DEFAULT,
+               EXTRA, COLUMN_COMMENT
+        FROM information_schema.COLUMNS
+        WHERE {where}
+        ORDER BY TABLE_NAME, ORDINAL_POSITION
+        """,
+        params,
+    )
+    for name, column, type_, nullable, default, extra, comment in columns:
+        if name not in schema.tables:
+            continue
+
+        # Expression defaults are flagged in EXTRA; anything else is a literal.
+        if default is not None and "DEFAULT_GENERATED" not in (extra or ""):
+            default = f"'{default}'"
+        extra = (extra or "").replace("DEFAULT_GENERATED", "").strip()
+        schema.tables[name].columns.append(
+            Column(
+                name=column,
+                type=type_,
+                nullable=nullable == "YES",
+                default=default,
+                extra=extra or None,
+                comment=comment or None,
+            )
+        )
+
+    statistics = _fetch(
+        db,
+        f"""
+        SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE {where}
+        ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+        """,
+        params,
+    )
+    index_columns: dict[tuple[str, str], list[str]] = {}
+    index_unique: dict[tuple[str, str], bool] = {}
+    for name, index, non_unique, column in statistics:
+        # Functional indexes have no column name.
+        index_columns.setdefault((name, index), []).append(column or "(expression)")
+        index_unique[(name, index)] = not int(non_unique)
+
+    for (name, index), cols in index_columns.items():
+        table = schema.tables.get(name)
+        if table is None:
+            continue
+
+        if index == "PRIMARY":
+            table.constraints.append(
+                Constraint(
+                    name="PRIMARY",
+                    kind="primary key",
+                    definition=f"PRIMARY KEY ({', '.join(cols)})",
+                )
+            )
+            continue
+
+        unique = index_unique[(name, index)]
+        table.indexes.append(
+            Index(
+                name=index,
+                columns=cols,
+                unique=unique,
+                definition=(
+                    f"CREATE {'UNIQUE ' if unique else ''}INDEX {index} "
+                    f"ON {name} ({', '.join(cols)})"
+                ),
+            )
+        )
+
+    foreign_keys = _fetch(
+        db,
+        f"""
+        SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME,
+               REFERENCED_COLUMN_NAME
+        FROM information_schema.KEY_COLUMN_USAGE
+        WHERE {where} AND REFERENCED_TABLE_NAME IS NOT NULL
+        ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION
+        """,
+        params,
+    )
+    fk_columns: dict[tuple[str, str, str], tuple[list[str], list[str]]] = {}
+    for name, constraint, column, ref_table, ref_column in foreign_keys:
+        local, remote = fk_columns.setdefault((name, constraint, ref_table), ([], []))
+        local.append(column)
+        remote.append(ref_column)
+
+    for (name, constraint, ref_table), (local, remote) in fk_columns.items():
+        if name in schema.tables:
+            schema.tables[name].constraints.append(
+                Constraint(
+                    name=constraint,
+                    kind="foreign key",
+                    definition=(
+                        f"FOREIGN KEY ({', '.join(local)}) "
+                        f"REFERENCES {ref_table} ({', '.join(remote)})"
+                    ),
+                    referenced_table=ref_table,
+                )
+            )
+
+    return schema
+
+
+def signatures(db: Database) -> dict[str, tuple[str, Optional[int]]]:
+    """
+    Return a checksum of the definition of every table, along with its current
+    row estimate, using a single catalog query. A table's checksum changes
+    whenever its columns, indexes, constraints or view definition do. Nullable
+    fields are coalesced, since concat_ws skips NULLs.
+    """
+
+    if db.config.db_type == "postgres":
+        rows = _fetch(
+            db,
+            f"""
+            SELECT n.nspname, c.relname, c.reltuples::bigint, md5(concat_ws('|',
+                c.relkind,
+                coalesce(obj_description(c.oid, 'pg_class'), '<null>'),
+                coalesce((
+                    SELECT string_agg(concat_ws(':', a.attname, a.atttypid,
+                                                a.atttypmod, a.attnotnull,
+                                                coalesce(pg_get_expr(d.adbin, d.adrelid),
+                                                         '<null>'),
+                                                coalesce(col_description(c.oid, a.attnum),
+                                                         '<null>')),
+                                      ',' ORDER BY a.attnum)
+                    FROM pg_attribute a
+                    LEFT JOIN pg_attrdef d
+                        ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+                    WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+                ), '<null>'),
+                -- Definitions include the names, so a rename is a change too.
+                coalesce((
+                    SELECT string_agg(pg_get_indexdef(i.indexrelid), ','
+                                      ORDER BY pg_get_indexdef(i.indexrelid))
+                    FROM pg_index i WHERE i.indrelid = c.oid
+                ), '<null>'),
+                coalesce((
+                    SELECT string_agg(con.conname || ':' || pg_get_constraintdef(con.oid),
+                                      ',' ORDER BY con.conname)
+                    FROM pg_constraint con WHERE con.conrelid = c.oid
+                ), '<null>'),
+                coalesce((
+                    SELECT string_agg(r.oid || ':' || r.xmin, ',')
+                    FROM pg_rewrite r WHERE r.ev_class = c.oid
+                ), '<null>')
+            ))
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'p', 'f', 'v', 'm') AND {_PG_USER_NAMESPACES}
+            ORDER BY n.nspname, c.relname
+            """,
+        )
+        return {
+            Table(schema=namespace, name=name).qualified_name: (
+                signature,
+                reltuples if reltuples and reltuples > 0 else None,
+            )
+            for namespace, name, reltuples, signature in rows
+        }
+
+    # GROUP_CONCAT silently truncates at 1024 bytes by default, which would
+    # hide changes to wide tables.
+    cursor = db.cursor()
+    cursor.execute("SET SESSION group_concat_max_len = 16777216")
+    cursor.close()
+    rows = _fetch(
+        db,
+        """
+        SELECT t.TABLE_NAME, t.TABLE_ROWS, MD5(CONCAT_WS('|',
+            t.TABLE_TYPE,
+            COALESCE(t.TABLE_COMMENT, '<null>'),
+            COALESCE((
+                SELECT GROUP_CONCAT(CONCAT_WS(':', c.COLUMN_NAME, c.COLUMN_TYPE,
+                                              c.IS_NULLABLE,
+                                              COALESCE(c.COLUMN_DEFAULT, '<null>'),
+                                              COALESCE(c.EXTRA, '<null>'),
+                                              COALESCE(c.COLUMN_COMMENT, '<null>'))
+                                    ORDER BY c.ORDINAL_POSITION)
+                FROM information_schema.COLUMNS c
+                WHERE c.TABLE_SCHEMA = t.TABLE_SCHEMA AND c.TABLE_NAME = t.TABLE_NAME
+            ), '<null>'),
+            COALESCE((
+                SELECT GROUP_CONCAT(CONCAT_WS(':', s.INDEX_NAME, s.NON_UNIQUE,
+                                              COALESCE(s.COLUMN_NAME, '<null>'))
+                                    ORDER BY s.INDEX_NAME, s.SEQ_IN_INDEX)
+                FROM information_schema.STATISTICS s
+                WHERE s.TABLE_SCHEMA = t.TABLE_SCHEMA AND s.TABLE_NAME = t.TABLE_NAME
+            ), '<null>'),
+            COALESCE((
+                SELECT GROUP_CONCAT(CONCAT_WS(':', k.CONSTRAINT_NAME, k.COLUMN_NAME,
+                                              COALESCE(k.REFERENCED_TABLE_NAME, '<null>'),
+                                              COALESCE(k.REFERENCED_COLUMN_NAME, '<null>'))
+                                    ORDER BY k.CONSTRAINT_NAME, k.ORDINAL_POSITION)
+                FROM information_schema.KEY_COLUMN_USAGE k
+                WHERE k.TABLE_SCHEMA = t.TABLE_SCHEMA AND k.TABLE_NAME = t.TABLE_NAME
+            ), '<null>'),
+            COALESCE((
+                SELECT MD5(v.VIEW_DEFINITION)
+                FROM information_schema.VIEWS v
+                WHERE v.TABLE_SCHEMA = t.TABLE_SCHEMA AND v.TABLE_NAME = t.TABLE_NAME
+            ), '<null>')
+        ))
+        FROM information_schema.TABLES t
+        WHERE t.TABLE_SCHEMA = DATABASE()
+        ORDER BY t.TABLE_NAME
+        """,
+    )
+    return {name: (signature, table_rows) for name, table_rows, signature in rows}
+
+
+class SchemaCache:
+    """
+    Keeps the schema model up to date without re-reading the whole catalog.
+
+    On each check, the per-table signatures are compared with those of the
+    cached model, and only tables that were added or changed are introspected
+    again. The model is persisted to a file in the data directory, so a restart
+    only needs the signature query. Checks happen at most once every
+    `schema_refresh_interval` seconds.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.path = config.schema_cache_path
+        self._schema: Optional[Schema] = None
+        self._signatures: dict[str, str] = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+        if config.schema_persist and os.path.exists(self.path):
+            self._load()
+
+    def get(self, db: Database) -> Schema:
+        with self._lock:
+            stale = (
+                time.monotonic() - self._checked_at
+                > self.config.schema_refresh_interval
+            )
+            hit = self._schema is not None and not stale
+            if not hit:
+                self._refresh(db)
+            metrics.cache_lookup("schema", hit=hit)
+            return self._schema  # type: ignore
+
+    def invalidate(self) -> None:
+        """Force the next `get` to check for changes."""
+        with self._lock:
+            self._checked_at = 0.0
+
+    def _refresh(self, db: Database) -> None:
+        current = signatures(db)
+        cached = self._schema.tables if self._schema is not None else {}
+        changed = [
+            name
+            for name, (signature, _) in current.items()
+            if name not in cached or self._signatures.get(name) != signature
+        ]
+        fresh = introspect(db, only=changed).tables if changed else {}
+
+        tables = {}
+        for name, (_, row_estimate) in current.items():
+            table = fresh.get(name) or cached.get(name)
+            if table is None:
+                # Dropped between the two queries.
+                continue
+            # The cached Table may still be in use by whoever got the previous
+            # schema, so it isn't changed in place.
+            tables[name] = replace(table, row_estimate=row_estimate)
+
+        dirty = bool(changed) or len(tables) != len(cached)
+        self._schema = Schema(tables=tables)
+        self._signatures = {name: signature for name, (signature, _) in current.items()}
+        self._checked_at = time.monotonic()
+        if dirty and self.config.schema_persist:
+            self._save()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self._schema = Schema(
+                tables={
+                    name: Table.from_dict(entry["table"])
+                    for name, entry in data["tables"].items()
+                }
+            )
+            self._signatures = {
+                name: entry["signature"] for name, entry in data["tables"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            # A corrupt or outdated cache file is rebuilt from scratch.
+            self._schema = None
+            self._signatures = {}
+
+    def _save(self) -> None:
+        assert self._schema is not None
+        data = {
+            "tables": {
+                name: {"signature": self._signatures[name], "table": asdict(table)}
+                for name, table in self._schema.tables.items()
+            }
+        }
+        # Write to a temporary file first, so a crash never leaves a partial
+        # cache behind.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
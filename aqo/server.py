@@ -1,71 +1,566 @@
 # AQO as an API, primarily for use with the AQO React UI.
 
-from fastapi import APIRouter, FastAPI
+import asyncio
+from dataclasses import asdict, fields
+import json
+import time
+from typing import Callable, Optional
+import uuid
+
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
 import uvicorn
 
+from aqo.batch import BatchOptimizer, RateLimiter, load_workload
+from aqo import formats, metrics
 from aqo.config import Config
-from aqo.db import Database
-from aqo.llm import LLM
+from aqo.db import ConnectionPool, DatabaseRegistry, QueryIdInUse, returns_rows
+from aqo.history import History
+from aqo.jobs import Job, JobQueue, QueueFull
+from aqo.llm import LLM, OptimizationResult
+from aqo.plan import Plan
+from aqo.schema import Schema
+from aqo.workload import RANKINGS
 
 
 class Query(BaseModel):
     query: str
+    # Lets the client cancel the query with DELETE /queries/{id}.
+    id: Optional[str] = None
+    # Overrides the configured statement timeout, in seconds, up to its cap.
+    statement_timeout: Optional[float] = None
+    # The id of the database to use, the default one if not given.
+    database: Optional[str] = None
+    # Queued jobs with a higher priority run first, up to `jobs_max_priority`.
+    priority: int = 0
+
+
+class Workload(BaseModel):
+    content: str
+    format: str = "auto"
+    database: Optional[str] = None
 
 
 class API:
     VERSION = "0.1.0"
 
     config: Config
-    db: Database
+    registry: DatabaseRegistry
     llm: LLM
 
     def __init__(self, config_path: str) -> None:
         self.config = Config(config_path)
-        self.db = Database(self.config)
+        # Pools are opened on first use, so only the databases that are
+        # actually queried hold connections.
+        self.registry = DatabaseRegistry(self.config)
         self.llm = LLM(self.config)
+        # Shared by every database's batches, since they share the models.
+        self.rate_limiter = RateLimiter(self.config.batch_requests_per_minute)
+        self.jobs = JobQueue(self.config, self._run_job, cancel=self._cancel_job)
+        metrics.JOBS.collect(self.jobs.stats)
         self.router = APIRouter()
         self._setup_routes()
 
+    def close(self) -> None:
+        # The registry is module-wide, so this API's collector has to go with
+        # it, or each app created in the process would leave one behind.
+        metrics.JOBS.remove(self.jobs.stats)
+        self.jobs.close()
+        self.registry.close()
+        self.llm.providers.close()
+
     def _setup_routes(self) -> None:
         self.router.add_api_route("/status", self.status, methods=["GET"])
+        self.router.add_api_route("/metrics", self.prometheus_metrics, methods=["GET"])
+        self.router.add_api_route("/databases", self.databases, methods=["GET"])
         self.router.add_api_route("/database", self.database_details, methods=["GET"])
         self.router.add_api_route("/schema", self.schema, methods=["GET"])
         self.router.add_api_route("/query", self.run_query, methods=["POST"])
+        self.router.add_api_route(
+            "/query/{query_id}/rows", self.query_rows, methods=["GET"]
+        )
+        self.router.add_api_route(
+            "/query/{query_id}", self.close_result, methods=["DELETE"]
+        )
         self.router.add_api_route("/optimize", self.optimize_query, methods=["POST"])
+        self.router.add_api_route(
+            "/optimize/stream", self.stream_optimize_query, methods=["POST"]
+        )
+        self.router.add_api_route("/jobs", self.list_jobs, methods=["GET"])
+        self.router.add_api_route("/jobs/{job_id}", self.job, methods=["GET"])
+        self.router.add_api_route("/jobs/{job_id}", self.cancel_job, methods=["DELETE"])
+        self.router.add_api_route("/batch", self.optimize_batch, methods=["POST"])
+        self.router.add_api_route("/top", self.top_statements, methods=["GET"])
+        self.router.add_api_route("/top/optimize", self.optimize_top, methods=["POST"])
+        self.router.add_api_route(
+            "/history/changes", self.plan_changes, methods=["GET"]
+        )
+        self.router.add_api_route(
+            "/history/{fingerprint}", self.query_history, methods=["GET"]
+        )
+        self.router.add_api_route("/providers", self.providers, methods=["GET"])
+        self.router.add_api_route("/queries", self.running_queries, methods=["GET"])
+        self.router.add_api_route(
+            "/queries/{query_id}", self.cancel_query, methods=["DELETE"]
+        )
 
-    def status(self):
+    async def status(self):
         """Healthcheck route for the UI."""
         return {"name": "AQO API", "version": self.VERSION}
 
-    def database_details(self):
+    async def prometheus_metrics(self):
+        """Metrics in the Prometheus text format."""
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    async def providers(self):
+        """The health and latency of each configured model."""
+        return self.llm.providers.stats()
+
+    async def databases(self):
+        """List the configured databases, and whether each has been used yet."""
+        active = self.registry.active()
+        return [
+            {
+                "id": database_id,
+                "type": database["type"],
+                "host": database["host"],
+                "port": database["port"],
+                "name": database["name"],
+                "replica_of": database.get("replica_of"),
+                "active": database_id in active,
+            }
+            for database_id, database in self.config.database_tables.items()
+        ]
+
+    async def database_details(self, database: Optional[str] = None):
         """Fetch details of the database config."""
-        return self.config.database
+        try:
+            return self.config.for_database(
+                database or self.config.default_database
+            ).database
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
 
-    def schema(self):
+    async def schema(self, database: Optional[str] = None):
         """Fetch the schema of the connected database."""
-        return {"schema": self.db.schema}
+        schema = await asyncio.to_thread(self._schema, database)
+        return {"schema": schema}
 
-    def run_query(self, query: Query):
+    async def run_query(self, query: Query, request: Request):
         """Run a query on the connected database."""
-        return self.db.query_as_json(query.query)
+        query_id = query.id or uuid.uuid4().hex
+        result = await self._cancel_on_disconnect(
+            request,
+            query_id,
+            asyncio.to_thread(
+                self._query_as_json,
+                query.database,
+                query_id,
+                query.query,
+                query.statement_timeout,
+            ),
+            query.database,
+        )
+        result.query_id = query_id
 
-    def optimize_query(self, query: Query):
-        """Optimize a query using LLM."""
-        return self.llm.optimize_as_json(
-            self.db.schema, query.query, self.db.explain_query(query.query)
+        media_type = formats.negotiate(request.headers.get("accept"))
+        if media_type == formats.JSON:
+            return result
+        meta = {
+            field.name: getattr(result, field.name)
+            for field in fields(result)
+            if field.name not in ["headers", "results", "types"]
+        }
+        batches = [result.results] if result.results else []
+        return StreamingResponse(
+            formats.encode(media_type, result.headers, batches, meta, result.types),
+            media_type=media_type,
         )
 
+    def query_rows(
+        self,
+        query_id: str,
+        request: Request,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        database: Optional[str] = None,
+    ):
+        """
+        Page through the rows of an earlier /query, without running it again.
+        `complete` is false when the kept rows stop short of the full result.
 
-def start_server(config_path: str) -> None:
+        With an `Accept` of application/vnd.aqo.columns+json or, when pyarrow
+        is installed, application/vnd.apache.arrow.stream, the rows are
+        streamed in that format, and all of them by default.
+        """
+        media_type = formats.negotiate(request.headers.get("accept"))
+        streamed = media_type != formats.JSON
+        if limit is None and not streamed:
+            limit = self.config.query_preview_limit
+        if (
+            offset < 0
+            or (limit is not None and limit <= 0)
+            or (not streamed and limit > self.config.results_max_page_size)
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail="'offset' must be non-negative and 'limit' between 1 and "
+                f"{self.config.results_max_page_size}.",
+            )
+        results = self._pool(database).results
+        session = results.get(query_id) if results else None
+        if session is None:
+            raise HTTPException(
+                status_code=404, detail="No such result, or it has expired."
+            )
+
+        # The session may be deleted between looking it up and reading it.
+        try:
+            if streamed:
+                batches = session.batches(offset, limit)
+            else:
+                rows = session.rows(offset, limit)  # type: ignore
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=404, detail="No such result, or it has expired."
+            )
+
+        if streamed:
+            meta = {
+                "offset": offset,
+                "rowcount": session.rowcount,
+                "complete": session.complete,
+            }
+            return StreamingResponse(
+                formats.encode(
+                    media_type, session.headers, batches, meta, session.types
+                ),
+                media_type=media_type,
+            )
+        return {
+            "headers": session.headers,
+            "rows": rows,
+            "offset": offset,
+            "rowcount": session.rowcount,
+            "complete": session.complete,
+        }
+
+    def close_result(self, query_id: str, database: Optional[str] = None):
+        """Discard the kept rows of an earlier /query."""
+        results = self._pool(database).results
+        if results is None or not results.delete(query_id):
+            raise HTTPException(status_code=404, detail="No such result.")
+        return {"deleted": query_id}
+
+    def optimize_query(self, query: Query, request: Request):
+        """
+        Queue a query to be optimized, returning its job right away. Poll
+        GET /jobs/{id} for its progress and, once it is done, its advice.
+        Jobs are limited per user, as given by the X-AQO-User header or else
+        the client's address.
+        """
+        if not 0 <= query.priority <= self.config.jobs_max_priority:
+            raise HTTPException(
+                status_code=400,
+                detail="'priority' must be between 0 and "
+                f"{self.config.jobs_max_priority}.",
+            )
+        # An unknown database is reported now rather than when the job runs.
+        self._pool(query.database)
+        try:
+            job = self.jobs.submit(dict(query), _user(request), query.priority)
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        return JSONResponse(self._job_details(job), status_code=202)
+
+    def list_jobs(
+        self,
+        user: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 100,
+    ):
+        """List the most recent jobs, newest first."""
+        return [self._job_details(job) for job in self.jobs.list(user, status, limit)]
+
+    def job(self, job_id: str):
+        """
+        A job's status, its current stage while running (explaining,
+        prompting or verifying) and its result, the OptimizationResult, once
+        it is done.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(
+                status_code=404, detail="No such job, or it has expired."
+            )
+        return self._job_details(job)
+
+    def cancel_job(self, job_id: str):
+        """Cancel a queued or running job."""
+        if not self.jobs.cancel(job_id):
+            raise HTTPException(
+                status_code=404, detail="No such job is queued or running."
+            )
+        return {"cancelled": job_id}
+
+    def _job_details(self, job: Job) -> dict:
+        return {**job.to_dict(), "position": self.jobs.position(job.id)}
+
+    async def stream_optimize_query(self, query: Query, request: Request):
+        """
+        Optimize a query using LLM, streaming the model's output as Server-Sent
+        Events: `token` events with each chunk of text, `field` events as each
+        key of the advice completes, then an `advice` event with the full,
+        checked advice.
+        """
+        query_id = query.id or uuid.uuid4().hex
+        explain = await self._cancel_on_disconnect(
+            request,
+            query_id,
+            asyncio.to_thread(
+                self._explain_query,
+                query.database,
+                query_id,
+                query.query,
+                query.statement_timeout,
+            ),
+            query.database,
+        )
+        schema = await asyncio.to_thread(self._schema_for, query.database, query.query)
+
+        async def events():
+            stream = self.llm.astream_optimize(schema, query.query, explain)
+            async for event, data in stream:
+                if event == "token":
+                    yield _sse(event, {"text": data})
+                elif event == "field":
+                    key, value = data
+                    yield _sse(event, {"key": key, "value": value})
+                else:
+                    if data.error is None:
+                        await asyncio.to_thread(
+                            self._check_advice, query.database, query.query, data
+                        )
+                    yield _sse(event, asdict(data))
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def optimize_batch(self, workload: Workload):
+        """
+        Optimize every distinct statement in a workload, streaming results as
+        JSON lines as they complete.
+        """
+        statements = load_workload(workload.content, workload.format)
+        records = self._batch_optimizer(workload.database).run(statements)
+        return StreamingResponse(
+            (json.dumps(record, default=str) + "\n" for record in records),
+            media_type="application/x-ndjson",
+        )
+
+    def top_statements(
+        self, by: str = "total_time", limit: int = 20, database: Optional[str] = None
+    ):
+        """List the statements that consume the most database time."""
+        self._check_ranking(by)
+        with self._pool(database).database() as db:
+            statements = db.top_statements(by, limit)
+        return [
+            {**asdict(statement), "mean_time": statement.mean_time}
+            for statement in statements
+        ]
+
+    def optimize_top(
+        self, by: str = "total_time", limit: int = 20, database: Optional[str] = None
+    ):
+        """
+        Optimize the statements that consume the most database time, streaming
+        results as JSON lines as they complete.
+        """
+        self._check_ranking(by)
+        with self._pool(database).database() as db:
+            statements = db.top_statements(by, limit)
+        records = self._batch_optimizer(database).run(statements)
+        return StreamingResponse(
+            (json.dumps(record, default=str) + "\n" for record in records),
+            media_type="application/x-ndjson",
+        )
+
+    def plan_changes(self, days: float = 7, database: Optional[str] = None):
+        """List the queries whose plans changed in the last `days` days."""
+        return self._history(database).plan_changes(since=time.time() - days * 86400)
+
+    def query_history(
+        self, fingerprint: str, days: float = 30, database: Optional[str] = None
+    ):
+        """
+        The recent executions of a query fingerprint, its daily latency trend
+        and the last advice given for it.
+        """
+        history = self._history(database)
+        return {
+            "executions": history.executions(fingerprint),
+            "latency_trend": history.latency_trend(
+                fingerprint, since=time.time() - days * 86400
+            ),
+            "advice": history.latest_advice(fingerprint),
+        }
+
+    def _history(self, database: Optional[str]) -> History:
+        history = self._pool(database).history
+        if history is None:
+            raise HTTPException(status_code=404, detail="History is disabled.")
+        return history
+
+    def running_queries(self, database: Optional[str] = None):
+        """List the queries currently running for /query and /optimize."""
+        return self._pool(database).running.list()
+
+    def cancel_query(self, query_id: str, database: Optional[str] = None):
+        """Cancel a running query by the id it was submitted with."""
+        if not self._pool(database).running.cancel(query_id):
+            raise HTTPException(status_code=404, detail="No such query is running.")
+        return {"cancelled": query_id}
+
+    async def _cancel_on_disconnect(
+        self, request: Request, query_id: str, work, database: Optional[str]
+    ):
+        """
+        Await `work`, cancelling its query if the client goes away first, so an
+        abandoned request doesn't keep a statement running on the database.
+        An id that another running query already has is a conflict.
+        """
+        task = asyncio.ensure_future(work)
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=0.5)
+                if done:
+                    return task.result()
+                if await request.is_disconnected():
+                    running = self._pool(database).running
+                    await asyncio.to_thread(running.cancel, query_id)
+                    return await task
+        except QueryIdInUse as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+    def _pool(self, database: Optional[str]) -> ConnectionPool:
+        try:
+            return self.registry.pool(database)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+    def _replica(self, database: Optional[str]) -> ConnectionPool:
+        try:
+            return self.registry.replica(database)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+    def _check_ranking(self, by: str) -> None:
+        if by not in RANKINGS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Statements can only be ranked by one of {RANKINGS}.",
+            )
+
+    def _batch_optimizer(self, database: Optional[str]) -> BatchOptimizer:
+        return BatchOptimizer(
+            self.config,
+            self._pool(database),
+            self.llm,
+            replica=self._replica(database),
+            rate_limiter=self.rate_limiter,
+        )
+
+    # The DB drivers are blocking, so these run in worker threads, each on its
+    # own pooled connection, while the event loop keeps serving other requests.
+    # Reads that don't need the latest writes, such as EXPLAIN, verification
+    # and schema introspection, go to a replica when there is one.
+
+    def _query_as_json(
+        self,
+        database: Optional[str],
+        query_id: str,
+        query: str,
+        timeout: Optional[float],
+    ):
+        pool = self._pool(database)
+        with pool.database() as db:
+            with pool.running.track(query_id, db, query):
+                return db.query_as_json(query, timeout=timeout, session_id=query_id)
+
+    def _explain_query(
+        self,
+        database: Optional[str],
+        query_id: str,
+        query: str,
+        timeout: Optional[float],
+    ) -> Plan:
+        # EXPLAIN ANALYZE runs the statement, so only reads go to a replica.
+        pool = self._replica(database) if returns_rows(query) else self._pool(database)
+        with pool.database() as db:
+            with pool.running.track(query_id, db, query):
+                return db.plan_for(query, timeout=timeout)
+
+    def _run_job(self, job: Job, stage: Callable[[str], None]) -> dict:
+        query = Query(**job.request)
+        # The job's query can be cancelled by its own id, or by the job's.
+        query_id = query.id or job.id
+        stage("explaining")
+        plan = self._explain_query(
+            query.database, query_id, query.query, query.statement_timeout
+        )
+        schema = self._schema_for(query.database, query.query)
+        stage("prompting")
+        advice = self.llm.optimize_as_json(schema, query.query, plan)
+        if advice.error is None:
+            stage("verifying")
+            self._check_advice(query.database, query.query, advice)
+        return asdict(advice)
+
+    def _cancel_job(self, job: Job) -> None:
+        query = Query(**job.request)
+        self._pool(query.database).running.cancel(query.id or job.id)
+
+    def _check_advice(
+        self, database: Optional[str], query: str, advice: OptimizationResult
+    ) -> None:
+        self._pool(database).check_advice(query, advice, self._replica(database))
+
+    def _schema(self, database: Optional[str]) -> str:
+        with self._replica(database).database() as db:
+            return db.schema
+
+    def _schema_for(self, database: Optional[str], query: str) -> Schema:
+        with self._replica(database).database() as db:
+            return db.schema_model_for(query)
+
+
+def _user(request: Request) -> str:
+    if request.headers.get("x-aqo-user"):
+        return request.headers["x-aqo-user"]
+    return request.client.host if request.client else "unknown"
+
+
+def _sse(event: str, data: object) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def create_app(config_path: str) -> FastAPI:
     app = FastAPI()
     app.add_middleware(
         CORSMiddleware,
         allow_origins="*",
-        allow_methods=["GET", "POST"],
+        allow_methods=["GET", "POST", "DELETE"],
     )
     api = API(config_path)
     app.include_router(api.router)
-    uvicorn.run(app, host="localhost", port=8000)
+    app.add_event_handler("shutdown", api.close)
+    return app
+
+
+def start_server(config_path: str) -> None:
+    uvicorn.run(create_app(config_path), host="localhost", port=8000)
@@ -0,0 +1,122 @@
+# Helpers for working with SQL text, independent of any database connection.
+
+import hashlib
+import re
+
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.IGNORECASE)
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_IDENTIFIER = re.compile(r"[a-z_][\w$]*(?:\s*\.\s*[a-z_][\w$]*)*")
+_PARENTHESIZED = re.compile(r"\([^()]*\)")
+_LITERAL = re.compile(f"{_STRING.pattern}|{_NUMBER.pattern}", re.IGNORECASE)
+
+
+def normalize(query: str) -> str:
+    """
+    Normalize a query so that queries differing only in literals, comments,
+    whitespace or case compare equal. Literals are replaced with `?`, and lists
+    of literals such as `IN (1, 2, 3)` collapse to `(?)`.
+    """
+
+    query = _COMMENT.sub(" ", query)
+    query = _STRING.sub("?", query)
+    query = _NUMBER.sub("?", query)
+    query = _PLACEHOLDER_LIST.sub("(?)", query)
+    query = _WHITESPACE.sub(" ", query)
+    return query.strip().rstrip(";").strip().lower()
+
+
+def fingerprint(query: str) -> str:
+    """A short, stable hash of the normalized form of a query."""
+    return hashlib.sha256(normalize(query).encode()).hexdigest()[:16]
+
+
+def literals(query: str) -> list[str]:
+    """The string and numeric literals in a query, in order."""
+    return [match.group() for match in _LITERAL.finditer(_COMMENT.sub(" ", query))]
+
+
+def returns_rows(query: str) -> bool:
+    """
+    Whether a query is a plain read that can be run through a server-side
+    cursor. Anything else is run with a regular cursor.
+    """
+
+    words = query.strip().split(maxsplit=1)
+    return bool(words) and words[0].lower() in ["select", "with", "values", "table"]
+
+
+def ordered(query: str) -> bool:
+    """
+    Whether a query orders its result, with an ORDER BY outside of any
+    parentheses, rather than only in a subquery or a window definition.
+    """
+
+    query = normalize(query)
+    count = 1
+    while count:
+        query, count = _PARENTHESIZED.subn(" ", query)
+    return re.search(r"\border by\b", query) is not None
+
+
+def identifiers(query: str) -> set[str]:
+    """
+    Return every identifier in a query, lowercased, with qualified names like
+    `schema.table` kept whole and also split into their parts. Keywords are
+    included too; callers match the result against names they know about.
+    """
+
+    query = _COMMENT.sub(" ", query)
+    query = _STRING.sub(" ", query)
+    query = query.replace('"', "").replace("`", "").lower()
+
+    names = set()
+    for match in _IDENTIFIER.finditer(query):
+        parts = [part.strip() for part in match.group().split(".")]
+        names.update(parts)
+        for i in range(len(parts) - 1):
+            names.add(".".join(parts[i : i + 2]))
+    return names
+
+
+def split_statements(text: str) -> list[str]:
+    """
+    Split a script into statements on semicolons, ignoring semicolons inside
+    quotes and comments. Statements are returned without the semicolon.
+    """
+
+    statements = []
+    current = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char in "'\"`":
+            end = text.find(char, i + 1)
+            # Doubled quotes are escapes, so keep scanning past them.
+            while end != -1 and text[end + 1 : end + 2] == char:
+                end = text.find(char, end + 2)
+            end = len(text) if end == -1 else end + 1
+            current.append(text[i:end])
+            i = end
+        elif text.startswith("--", i):
+            end = text.find("\n", i)
+            end = len(text) if end == -1 else end
+            current.append(text[i:end])
+            i = end
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            end = len(text) if end == -1 else end + 2
+            current.append(text[i:end])
+            i = end
+        elif char == ";":
+            statements.append("".join(current))
+            current = []
+            i += 1
+        else:
+            current.append(char)
+            i += 1
+    statements.append("".join(current))
+
+    return [s.strip() for s in statements if _COMMENT.sub("", s).strip()]
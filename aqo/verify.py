@@ -0,0 +1,178 @@
+# Checking the LLM's rewritten query against the original: that it returns the
+# same rows, and how much faster it actually is.
+
+from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import dataclass
+import hashlib
+import math
+import time
+
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from aqo.sql import ordered, returns_rows, split_statements
+
+if TYPE_CHECKING:
+    from aqo.db import Database
+
+
+@dataclass
+class Timings:
+    """
+    Latencies in seconds over several runs. The first run is reported as cold,
+    since it is the one that has to bring data into the caches.
+    """
+
+    runs: int
+    cold: float
+    warm_p50: float
+    warm_p95: float
+    rowcount: int
+    checksum: str
+
+
+@dataclass
+class Verification:
+    equivalent: bool
+    original: Optional[Timings] = None
+    optimized: Optional[Timings] = None
+    speedup: Optional[float] = None
+    error: Optional[str] = None
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile, which is well defined for a handful of runs."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def verify_rewrite(
+    db: Database, original: str, optimized: str, runs: int, timeout: float
+) -> Verification:
+    """
+    Run both queries `runs` times each inside a read-only transaction with a
+    statement timeout, and compare their result checksums and latencies.
+    Results are compared as multisets, unless the original query orders them.
+
+    Only single statements that return rows are run, since a driver may run
+    every statement in a script, and one of them could end the read-only
+    transaction.
+    """
+
+    for name, query in [("original", original), ("suggested", optimized)]:
+        if len(split_statements(query)) != 1 or not returns_rows(query):
+            return Verification(
+                equivalent=False,
+                error=f"The {name} query isn't a single read-only statement, "
+                "so it wasn't run.",
+            )
+
+    by_order = ordered(original)
+    try:
+        with _read_only(db, timeout):
+            original_timings = _measure(db, original, runs, by_order)
+            optimized_timings = _measure(db, optimized, runs, by_order)
+    except Exception as e:
+        return Verification(equivalent=False, error=str(e))
+
+    return Verification(
+        equivalent=(
+            original_timings.checksum == optimized_timings.checksum
+            and original_timings.rowcount == optimized_timings.rowcount
+        ),
+        original=original_timings,
+        optimized=optimized_timings,
+        speedup=(
+            original_timings.warm_p50 / optimized_timings.warm_p50
+            if optimized_timings.warm_p50 > 0
+            else None
+        ),
+    )
+
+
+@contextmanager
+def _read_only(db: Database, timeout: float) -> Iterator[None]:
+    """
+    A read-only transaction with a statement timeout, rolled back at the end
+    so nothing the queries do can stick.
+    """
+
+    timeout_ms = int(timeout * 1000)
+    db.conn.rollback()
+    cursor = db.cursor()
+    if db.config.db_type == "postgres":
+        cursor.execute("SET TRANSACTION READ ONLY")
+        cursor.execute(f"SET LOCAL statement_timeout = {timeout_ms}")
+    else:
+        cursor.execute(f"SET SESSION max_execution_time = {timeout_ms}")
+        cursor.execute("START TRANSACTION READ ONLY")
+    cursor.close()
+
+    try:
+        yield
+    finally:
+        db.conn.rollback()
+        if db.config.db_type == "mysql":
+            cursor = db.cursor()
+            cursor.execute("SET SESSION max_execution_time = DEFAULT")
+            cursor.close()
+
+
+def _measure(db: Database, query: str, runs: int, ordered: bool) -> Timings:
+    latencies = []
+    checksum = _Checksum(ordered)
+    for run in range(max(runs, 1)):
+        cursor = db.cursor()
+        latency = 0.0
+        start_time = time.monotonic()
+        cursor.execute(query)
+        while True:
+            batch = cursor.fetchmany(1000)
+            latency += time.monotonic() - start_time
+            if not batch:
+                break
+            # Hashing is left out of the timings, which are the database's.
+            if run == 0:
+                checksum.add(batch)
+            start_time = time.monotonic()
+        latencies.append(latency)
+        cursor.close()
+
+    warm = latencies[1:] or latencies
+    return Timings(
+        runs=len(latencies),
+        cold=latencies[0],
+        warm_p50=percentile(warm, 50),
+        warm_p95=percentile(warm, 95),
+        rowcount=checksum.rowcount,
+        checksum=checksum.hexdigest(),
+    )
+
+
+class _Checksum:
+    """
+    Hashes a result set batch by batch. Unordered results are hashed as the
+    sum of their row hashes, which doesn't depend on row order.
+    """
+
+    def __init__(self, ordered: bool):
+        self.ordered = ordered
+        self.rowcount = 0
+        self._running = hashlib.sha256()
+        self._total = 0
+
+    def add(self, batch: list) -> None:
+        for row in batch:
+            row_hash = hashlib.sha256(repr(tuple(row)).encode()).digest()
+            if self.ordered:
+                self._running.update(row_hash)
+            else:
+                self._total = (
+                    self._total + int.from_bytes(row_hash[:16], "big")
+                ) % 2**128
+        self.rowcount += len(batch)
+
+    def hexdigest(self) -> str:
+        if self.ordered:
+            return self._running.hexdigest()
+        return f"{self._total:032x}"
@@ -0,0 +1,232 @@
+# Estimating what suggested indexes would do to a query's plan, without
+# building them on the real tables.
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+import json
+import re
+import uuid
+
+import mysql.connector
+
+from typing import TYPE_CHECKING, Optional
+
+from aqo.sql import split_statements
+
+if TYPE_CHECKING:
+    from aqo.db import Database
+
+_CREATE_INDEX = re.compile(r"^\s*create\s+(unique\s+)?index\b", re.IGNORECASE)
+_INDEX_PARTS = re.compile(
+    r"^\s*create\s+(?:unique\s+)?index\s+(?:if\s+not\s+exists\s+)?"
+    r"[`\"]?(\w+)[`\"]?\s+on\s+(\S+)",
+    re.IGNORECASE,
+)
+_PARAMETER = re.compile(r"\$\d")
+
+
+@dataclass
+class IndexEvaluation:
+    """
+    The planner's estimated cost of a query with and without a set of
+    hypothetical indexes. `used_indexes` are the ones the new plan picks.
+
+    If `sample_rows` is set, the costs were estimated on clones of the tables
+    with up to that many rows each, not from the real tables' statistics.
+    """
+
+    method: str
+    indexes: list[str] = field(default_factory=list)
+    used_indexes: list[str] = field(default_factory=list)
+    baseline_cost: Optional[float] = None
+    hypothetical_cost: Optional[float] = None
+    cost_delta: Optional[float] = None
+    sample_rows: Optional[int] = None
+    error: Optional[str] = None
+
+
+def index_statements(ddl: str) -> list[str]:
+    """Return the CREATE INDEX statements in a block of DDL."""
+    return [s for s in split_statements(ddl or "") if _CREATE_INDEX.match(s)]
+
+
+def evaluate_indexes(
+    db: Database, query: str, ddl: str, sample_rows: int, shadow: Optional[dict]
+) -> Optional[IndexEvaluation]:
+    """
+    Compare the estimated cost of a query with and without the indexes that
+    `ddl` would create. Returns None if `ddl` creates no indexes.
+
+    Postgres uses HypoPG, which must be installed in the database. MySQL has
+    no hypothetical indexes, so the tables the query references are copied,
+    with up to `sample_rows` rows each, to a scratch database on the `shadow`
+    server, where the indexes are built invisible and the plan is compared
+    with them hidden and shown. Nothing is written to `db`, and without a
+    `shadow` server the indexes aren't evaluated.
+    """
+
+    indexes = index_statements(ddl)
+    if not indexes:
+        return None
+
+    try:
+        if db.config.db_type == "postgres":
+            evaluation = _evaluate_hypopg(db, query, indexes)
+        else:
+            evaluation = _evaluate_invisible(db, query, indexes, sample_rows, shadow)
+    except Exception as e:
+        db.conn.rollback()
+        method = "hypopg" if db.config.db_type == "postgres" else "invisible_index"
+        return IndexEvaluation(method=method, indexes=indexes, error=str(e))
+
+    if (
+        evaluation.baseline_cost is not None
+        and evaluation.hypothetical_cost is not None
+    ):
+        evaluation.cost_delta = evaluation.hypothetical_cost - evaluation.baseline_cost
+    return evaluation
+
+
+def _explain_json(cursor, db_type: str, query: str) -> str:
+    if db_type == "postgres":
+        # Normalized statements have $n parameters, which only a generic plan
+        # can handle.
+        generic = "GENERIC_PLAN, " if _PARAMETER.search(query) else ""
+        cursor.execute(f"EXPLAIN ({generic}FORMAT JSON) {query}")
+    else:
+        cursor.execute(f"EXPLAIN FORMAT=JSON {query}")
+    plan = cursor.fetchall()[0][0]
+    return plan if isinstance(plan, str) else json.dumps(plan)
+
+
+def _cost(db_type: str, plan: str) -> float:
+    if db_type == "postgres":
+        return float(json.loads(plan)[0]["Plan"]["Total Cost"])
+    return float(json.loads(plan)["query_block"]["cost_info"]["query_cost"])
+
+
+def _evaluate_hypopg(db: Database, query: str, indexes: list[str]) -> IndexEvaluation:
+    cursor = db.cursor()
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")
+    if cursor.fetchone() is None:
+        cursor.close()
+        raise RuntimeError(
+            "The hypopg extension is not installed. Run CREATE EXTENSION hypopg."
+        )
+    cursor.execute("SHOW server_version_num")
+    version = int(cursor.fetchone()[0])  # type: ignore
+    if _PARAMETER.search(query) and version < 160000:
+        cursor.close()
+        raise RuntimeError(
+            "The query has $n parameters, which can only be planned without "
+            "values on Postgres 16 or later, so its indexes weren't evaluated."
+        )
+
+    baseline = _explain_json(cursor, "postgres", query)
+    names = []
+    try:
+        for index in indexes:
+            cursor.execute("SELECT indexname FROM hypopg_create_index(%s)", (index,))
+            names.append(cursor.fetchone()[0])  # type: ignore
+        hypothetical = _explain_json(cursor, "postgres", query)
+    except Exception:
+        db.conn.rollback()
+        raise
+    finally:
+        # Hypothetical indexes live in the session, not the transaction, so
+        # they have to be dropped explicitly.
+        cursor.execute("SELECT hypopg_reset()")
+        cursor.close()
+
+    return IndexEvaluation(
+        method="hypopg",
+        indexes=indexes,
+        used_indexes=[
+            index for index, name in zip(indexes, names) if name in hypothetical
+        ],
+        baseline_cost=_cost("postgres", baseline),
+        hypothetical_cost=_cost("postgres", hypothetical),
+    )
+
+
+def _evaluate_invisible(
+    db: Database,
+    query: str,
+    indexes: list[str],
+    sample_rows: int,
+    shadow: Optional[dict],
+) -> IndexEvaluation:
+    if shadow is None:
+        raise RuntimeError(
+            "MySQL has no hypothetical indexes, so evaluating them needs a "
+            "scratch server to copy the tables to. Set [whatif.mysql_shadow]."
+        )
+
+    names = []
+    for index in indexes:
+        match = _INDEX_PARTS.match(index)
+        if match is None:
+            raise ValueError(f"Could not parse index name and table from: {index}")
+        if "." in match.group(2):
+            # A qualified name would refer to a database the copy doesn't have.
+            raise ValueError(f"Index must use an unqualified table name: {index}")
+        names.append(match.group(1))
+
+    tables = [
+        db.schema_model.tables[name].name
+        for name in db.schema_model.referenced_by(query)
+        if db.schema_model.tables[name].kind == "table"
+    ]
+
+    scratch = f"aqo_shadow_{uuid.uuid4().hex[:8]}"
+    source = db.cursor()
+    conn = mysql.connector.connect(
+        host=shadow["host"],
+        port=shadow["port"],
+        user=shadow["username"],
+        password=shadow["password"],
+    )
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"CREATE DATABASE `{scratch}`")
+        cursor.execute(f"USE `{scratch}`")
+        # Foreign keys may point at tables that aren't copied.
+        cursor.execute("SET SESSION foreign_key_checks = 0")
+        for table in tables:
+            source.execute(f"SHOW CREATE TABLE `{table}`")
+            cursor.execute(source.fetchall()[0][1])
+            source.execute(f"SELECT * FROM `{table}` LIMIT {int(sample_rows)}")
+            insert = None
+            while rows := source.fetchmany(1000):
+                if insert is None:
+                    values = ", ".join(["%s"] * len(rows[0]))
+                    insert = f"INSERT INTO `{table}` VALUES ({values})"
+                cursor.executemany(insert, rows)
+            conn.commit()
+            cursor.execute(f"ANALYZE TABLE `{table}`")
+            cursor.fetchall()
+
+        for index in indexes:
+            cursor.execute(f"{index} INVISIBLE")
+
+        cursor.execute("SET SESSION optimizer_switch = 'use_invisible_indexes=off'")
+        baseline = _explain_json(cursor, "mysql", query)
+        cursor.execute("SET SESSION optimizer_switch = 'use_invisible_indexes=on'")
+        hypothetical = _explain_json(cursor, "mysql", query)
+    finally:
+        source.close()
+        try:
+            cursor.execute(f"DROP DATABASE IF EXISTS `{scratch}`")
+        finally:
+            conn.close()
+
+    return IndexEvaluation(
+        method="invisible_index",
+        indexes=indexes,
+        used_indexes=[
+            index for index, name in zip(indexes, names) if f'"{name}"' in hypothetical
+        ],
+        baseline_cost=_cost("mysql", baseline),
+        hypothetical_cost=_cost("mysql", hypothetical),
+        sample_rows=sample_rows,
+    )
@@ -0,0 +1,122 @@
+# Discovering the statements that consume the most database time, from
+# pg_stat_statements on Postgres or performance_schema on MySQL.
+
+from __future__ import annotations
+from dataclasses import dataclass
+
+from typing import TYPE_CHECKING
+
+from aqo.sql import fingerprint
+
+if TYPE_CHECKING:
+    from aqo.db import Database
+
+RANKINGS = ["total_time", "mean_time", "rows", "calls"]
+
+
+@dataclass
+class Statement:
+    """
+    A distinct statement in a workload. `calls`, `total_time` (in seconds) and
+    `rows` add up every execution of the statement's fingerprint. `rows` is
+    rows examined on MySQL, and rows returned or affected on Postgres.
+    """
+
+    query: str
+    fingerprint: str
+    calls: int = 0
+    total_time: float = 0.0
+    rows: int = 0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+def top_statements(
+    db: Database, by: str = "total_time", limit: int = 20
+) -> list[Statement]:
+    """
+    Return the `limit` statements ranked highest by `by`, which is one of
+    RANKINGS, from the DB's own statement statistics.
+    """
+
+    if by not in RANKINGS:
+        raise ValueError(f"Statements can only be ranked by one of {RANKINGS}.")
+
+    if db.config.db_type == "postgres":
+        rows = _pg_stat_statements(db, by, limit)
+    else:
+        rows = _mysql_statement_digests(db, by, limit)
+
+    return [
+        Statement(
+            query=query,
+            fingerprint=fingerprint(query),
+            calls=int(calls),
+            total_time=float(total_time),
+            rows=int(row_count or 0),
+        )
+        for query, calls, total_time, row_count in rows
+    ]
+
+
+def _pg_stat_statements(db: Database, by: str, limit: int) -> list:
+    cursor = db.cursor()
+    cursor.execute("SHOW server_version_num")
+    version = int(cursor.fetchone()[0])  # type: ignore
+
+    # The timing columns gained an _exec_ infix in Postgres 13.
+    total, mean = ("total_exec_time", "mean_exec_time")
+    if version < 130000:
+        total, mean = ("total_time", "mean_time")
+    order_by = {
+        "total_time": total,
+        "mean_time": mean,
+        "rows": "rows",
+        "calls": "calls",
+    }[by]
+
+    cursor.execute(
+        f"""
+        SELECT s.query, s.calls, s.{total} / 1000, s.rows
+        FROM pg_stat_statements s
+        JOIN pg_database d ON d.oid = s.dbid
+        WHERE d.datname = current_database()
+          AND s.query NOT ILIKE '%%pg_stat_statements%%'
+        ORDER BY s.{order_by} DESC
+        LIMIT %s
+        """,
+        (limit,),
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    return list(rows)
+
+
+def _mysql_statement_digests(db: Database, by: str, limit: int) -> list:
+    # Timers are in picoseconds.
+    order_by = {
+        "total_time": "SUM_TIMER_WAIT",
+        "mean_time": "AVG_TIMER_WAIT",
+        "rows": "SUM_ROWS_EXAMINED",
+        "calls": "COUNT_STAR",
+    }[by]
+
+    # The sample text has real literals, so unlike the digest text it can be
+    # EXPLAINed.
+    cursor = db.cursor()
+    cursor.execute(
+        f"""
+        SELECT COALESCE(QUERY_SAMPLE_TEXT, DIGEST_TEXT), COUNT_STAR,
+               SUM_TIMER_WAIT / 1e12, SUM_ROWS_EXAMINED
+        FROM performance_schema.events_statements_summary_by_digest
+        WHERE SCHEMA_NAME = DATABASE() AND DIGEST_TEXT IS NOT NULL
+        ORDER BY {order_by} DESC
+        LIMIT %s
+        """,
+        (limit,),
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    return list(rows)
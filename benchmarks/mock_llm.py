@@ -0,0 +1,135 @@
+# A stand-in for an OpenAI-compatible chat completions API, which answers
+# every request with the same advice after a fixed delay, so that benchmarks
+# measure AQO rather than the model.
+
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+ADVICE = {
+    "query_advice": "Add an index on the join column.",
+    "schema_advice": "Index the foreign key.",
+    "query_optimized": None,
+    "schema_optimized": None,
+    "explanation": "The join scans the whole table for each row.",
+    "error": None,
+}
+
+
+class MockLLM:
+    """
+    Serves `POST /chat/completions` on localhost. Responses take `latency`
+    seconds; streamed ones are split into `chunks` pieces spread over that
+    time, with the first arriving after `first_token` seconds.
+    """
+
+    def __init__(self, latency: float, first_token: float = 0.0, chunks: int = 20):
+        self.latency = latency
+        self.first_token = first_token
+        self.chunks = chunks
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> MockLLM:
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                with mock._lock:
+                    mock.requests += 1
+
+                content = json.dumps(ADVICE)
+                prompt_tokens = sum(
+                    len(str(m.get("content", "")).split())
+                    for m in request.get("messages", [])
+                )
+                if request.get("stream"):
+                    self._stream(request, content)
+                else:
+                    time.sleep(mock.latency)
+                    self._send_json(
+                        {
+                            "id": "mock",
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": request.get("model", "mock"),
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": content,
+                                    },
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": {
+                                "prompt_tokens": prompt_tokens,
+                                "completion_tokens": len(content.split()),
+                                "total_tokens": prompt_tokens + len(content.split()),
+                            },
+                        }
+                    )
+
+            def _send_json(self, body: dict) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, request: dict, content: str) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+
+                size = max(1, -(-len(content) // mock.chunks))
+                pieces = [content[i : i + size] for i in range(0, len(content), size)]
+                time.sleep(mock.first_token)
+                interval = max(mock.latency - mock.first_token, 0) / len(pieces)
+                for i, piece in enumerate(pieces):
+                    if i:
+                        time.sleep(interval)
+                    chunk = {
+                        "id": "mock",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request.get("model", "mock"),
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": {"content": piece},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+        return Handler
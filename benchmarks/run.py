@@ -0,0 +1,408 @@
+# Benchmarks AQO end to end: seeds a synthetic schema, points AQO at a mock
+# LLM, and measures latency and throughput of the API under concurrent load.
+#
+#   python -m benchmarks.run --docker postgres --output report.json
+#   python -m benchmarks.run --config bench.toml --compare report.json
+#
+# Reports are JSON, so runs on different commits can be compared with
+# --compare.
+
+from __future__ import annotations
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tomllib
+import urllib.request
+
+from typing import Callable, Iterator, Optional
+
+import uvicorn
+
+from aqo.config import Config
+from aqo.db import Database
+from aqo.schema import SchemaCache
+from aqo.server import create_app
+from aqo.verify import percentile
+from benchmarks.mock_llm import MockLLM
+from benchmarks.seed import queries, seed
+
+SCENARIOS = ["schema", "query", "optimize", "optimize_stream"]
+
+DOCKER_IMAGES = {
+    "postgres": ("postgres:16", 5432),
+    "mysql": ("mysql:8.0", 3306),
+}
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    summary = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else None,
+    }
+    if latencies:
+        summary.update(
+            mean=sum(latencies) / len(latencies),
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            max=max(latencies),
+        )
+    return summary
+
+
+def load(
+    call: Callable[[int], Optional[dict]], requests: int, concurrency: int
+) -> dict:
+    """
+    Make `requests` calls with `concurrency` in flight. A call may return
+    extra timings, such as time to first token, which are summarized too.
+    """
+
+    latencies: list[float] = []
+    extra: dict[str, list[float]] = {}
+    errors = 0
+    lock = threading.Lock()
+
+    def run(i: int) -> None:
+        nonlocal errors
+        start_time = time.monotonic()
+        try:
+            timings = call(i) or {}
+        except Exception:
+            with lock:
+                errors += 1
+            return
+        with lock:
+            latencies.append(time.monotonic() - start_time)
+            for name, value in timings.items():
+                extra.setdefault(name, []).append(value)
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, range(requests)))
+    summary = summarize(latencies, errors, time.monotonic() - start_time)
+    for name, values in extra.items():
+        summary[name] = {
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+        }
+    return summary
+
+
+def post(url: str, body: dict) -> urllib.request.addinfourl:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    return urllib.request.urlopen(request, timeout=300)
+
+
+def bench_schema(config: Config, requests: int) -> dict:
+    """Cold introspection of the whole schema, without the on-disk cache."""
+
+    latencies = []
+    db = Database(config)
+    try:
+        for _ in range(requests):
+            cache = SchemaCache(config)
+            start_time = time.monotonic()
+            cache.get(db)
+            latencies.append(time.monotonic() - start_time)
+    finally:
+        db.close()
+    return summarize(latencies, 0, sum(latencies))
+
+
+def bench_query(base_url: str, workload: list[str], requests: int, concurrency: int):
+    def call(i: int) -> None:
+        with post(f"{base_url}/query", {"query": workload[i % len(workload)]}) as r:
+            if json.load(r).get("query_error"):
+                raise RuntimeError("query failed")
+
+    return load(call, requests, concurrency)
+
+
+def bench_optimize(
+    base_url: str, workload: list[str], requests: int, concurrency: int
+) -> dict:
+    def call(i: int) -> None:
+        with post(f"{base_url}/optimize", {"query": workload[i % len(workload)]}) as r:
+            job = json.load(r)
+        while job["status"] in ["queued", "running"]:
+            time.sleep(0.1)
+            with urllib.request.urlopen(f"{base_url}/jobs/{job['id']}") as r:
+                job = json.load(r)
+        if job["status"] != "done" or job["result"].get("error"):
+            raise RuntimeError("optimize failed")
+
+    return load(call, requests, concurrency)
+
+
+def bench_optimize_stream(
+    base_url: str, workload: list[str], requests: int, concurrency: int
+) -> dict:
+    def call(i: int) -> dict:
+        start_time = time.monotonic()
+        first_token = None
+        query = workload[i % len(workload)]
+        with post(f"{base_url}/optimize/stream", {"query": query}) as response:
+            for line in response:
+                if first_token is None and line.startswith(b"event: token"):
+                    first_token = time.monotonic() - start_time
+        return {"time_to_first_token": first_token or time.monotonic() - start_time}
+
+    return load(call, requests, concurrency)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def serve(config_path: str) -> Iterator[str]:
+    port = _free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_app(config_path), host="127.0.0.1", port=port, log_level="warning"
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+@contextmanager
+def docker_database(db_type: str) -> Iterator[dict]:
+    """Start a throwaway database container, yielding its [database] config."""
+
+    image, container_port = DOCKER_IMAGES[db_type]
+    env = {
+        "postgres": ["POSTGRES_USER=aqo", "POSTGRES_PASSWORD=aqo", "POSTGRES_DB=bench"],
+        "mysql": [
+            "MYSQL_USER=aqo",
+            "MYSQL_PASSWORD=aqo",
+            "MYSQL_DATABASE=bench",
+            "MYSQL_ROOT_PASSWORD=aqo",
+        ],
+    }[db_type]
+    args = ["docker", "run", "-d", "--rm", "-p", f"127.0.0.1::{container_port}"]
+    for value in env:
+        args += ["-e", value]
+    container = subprocess.check_output([*args, image], text=True).strip()
+    try:
+        mapping = subprocess.check_output(
+            ["docker", "port", container, str(container_port)], text=True
+        )
+        port = int(mapping.splitlines()[0].rsplit(":", 1)[1])
+        yield {
+            "type": db_type,
+            "host": "127.0.0.1",
+            "port": port,
+            "name": "bench",
+            "username": "aqo",
+            "password": "aqo",
+        }
+    finally:
+        subprocess.run(["docker", "stop", container], capture_output=True)
+
+
+def _toml_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return json.dumps(str(value))
+
+
+def write_config(path: str, tables: dict[str, dict]) -> None:
+    with open(path, "w") as f:
+        for name, values in tables.items():
+            f.write(f"[{name}]\n")
+            for key, value in values.items():
+                f.write(f"{key} = {_toml_value(value)}\n")
+            f.write("\n")
+
+
+def wait_for(config: Config, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            Database(config).close()
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, report: dict) -> None:
+    print(
+        f"{'scenario':<18}{'metric':<12}{'baseline':>12}{'current':>12}{'change':>10}"
+    )
+    for scenario, current in report["results"].items():
+        previous = baseline.get("results", {}).get(scenario)
+        if previous is None:
+            continue
+        for metric in ["p50", "p95", "throughput"]:
+            old, new = previous.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else ""
+            print(f"{scenario:<18}{metric:<12}{old:>12.4f}{new:>12.4f}{change:>10}")
+
+
+def run(args: argparse.Namespace, database: dict, data_dir: str) -> dict:
+    mock = MockLLM(args.llm_latency, first_token=args.first_token).start()
+    try:
+        config_path = os.path.join(data_dir, "bench.toml")
+        write_config(
+            config_path,
+            {
+                "database": database,
+                "ai_model": {
+                    "provider": "openai",
+                    "model_name": "gpt-3.5-turbo",
+                    "api_key": "mock",
+                    "api_base": mock.url,
+                },
+                "pool": {"size": args.concurrency},
+                "storage": {"data_dir": data_dir},
+                # Every request should do the work being measured.
+                "cache": {"enabled": False},
+                "schema": {"persist": False},
+                "query": {"plan_ttl": 0},
+                # All requests come from one address, so the job queue has to
+                # let that one user run --concurrency jobs at once.
+                "jobs": {
+                    "workers": args.concurrency,
+                    "max_per_user": args.concurrency,
+                    "max_queued": max(args.requests, 1000),
+                },
+            },
+        )
+        config = Config(config_path)
+        wait_for(config)
+
+        if not args.skip_seed:
+            print(f"Seeding {args.tables} tables of {args.rows} rows.", file=sys.stderr)
+            db = Database(config)
+            try:
+                seed(db, args.tables, args.rows)
+            finally:
+                db.close()
+
+        workload = queries(args.tables, args.distinct_queries)
+        results = {}
+        with serve(config_path) as base_url:
+            for scenario in args.scenarios:
+                print(f"Running {scenario}.", file=sys.stderr)
+                if scenario == "schema":
+                    results[scenario] = bench_schema(config, args.schema_runs)
+                elif scenario == "query":
+                    results[scenario] = bench_query(
+                        base_url, workload, args.requests, args.concurrency
+                    )
+                elif scenario == "optimize":
+                    results[scenario] = bench_optimize(
+                        base_url, workload, args.requests, args.concurrency
+                    )
+                elif scenario == "optimize_stream":
+                    results[scenario] = bench_optimize_stream(
+                        base_url, workload, args.requests, args.concurrency
+                    )
+        return results
+    finally:
+        mock.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark AQO end to end.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--config", help="AQO config whose [database] to benchmark against"
+    )
+    source.add_argument(
+        "--docker",
+        choices=sorted(DOCKER_IMAGES),
+        help="start a throwaway database container to benchmark against",
+    )
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--distinct-queries", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--schema-runs", type=int, default=5)
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.5, help="seconds per completion"
+    )
+    parser.add_argument(
+        "--first-token", type=float, default=0.05, help="seconds to first token"
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--output", help="JSON file to write the report to")
+    parser.add_argument("--compare", help="earlier report to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        if args.docker:
+            with docker_database(args.docker) as database:
+                results = run(args, database, data_dir)
+        else:
+            with open(args.config, "rb") as f:
+                database = tomllib.load(f)["database"]
+            results = run(args, database, data_dir)
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.time(),
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ["output", "compare", "config"]
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
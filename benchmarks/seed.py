@@ -0,0 +1,84 @@
+# A synthetic schema of configurable size: a chain of tables, each with a
+# foreign key to the one before it, so that generated queries join.
+
+from __future__ import annotations
+import random
+
+from aqo.db import Database
+
+
+def table_name(i: int) -> str:
+    return f"bench_{i}"
+
+
+def seed(db: Database, tables: int, rows: int) -> None:
+    """Drop and recreate `tables` tables of `rows` rows each."""
+
+    cursor = db.cursor()
+    for i in reversed(range(tables)):
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name(i)}")
+
+    for i in range(tables):
+        # MySQL ignores inline REFERENCES, so the key is declared separately.
+        parent = (
+            ", parent_id INTEGER,"
+            f" FOREIGN KEY (parent_id) REFERENCES {table_name(i - 1)} (id)"
+            if i
+            else ""
+        )
+        cursor.execute(f"""
+            CREATE TABLE {table_name(i)} (
+                id INTEGER PRIMARY KEY,
+                category INTEGER NOT NULL,
+                amount NUMERIC(12, 2) NOT NULL,
+                label VARCHAR(64) NOT NULL{parent}
+            )
+            """)
+
+        parent_value = f", 1 + MOD(n * 7, {rows})" if i else ""
+        parent_column = ", parent_id" if i else ""
+        if db.config.db_type == "postgres":
+            numbers = f"SELECT n FROM generate_series(1, {rows}) AS n"
+        else:
+            cursor.execute(f"SET SESSION cte_max_recursion_depth = {rows + 1}")
+            numbers = (
+                f"WITH RECURSIVE numbers (n) AS (SELECT 1 UNION ALL "
+                f"SELECT n + 1 FROM numbers WHERE n < {rows}) SELECT n FROM numbers"
+            )
+        cursor.execute(f"""
+            INSERT INTO {table_name(i)} (id, category, amount, label{parent_column})
+            SELECT n, MOD(n, 100), MOD(n * 37, 10000) / 100.0,
+                CONCAT('label-', MOD(n, 1000)){parent_value}
+            FROM ({numbers}) AS numbers
+            """)
+        cursor.execute(
+            f"ANALYZE {table_name(i)}"
+            if db.config.db_type == "postgres"
+            else f"ANALYZE TABLE {table_name(i)}"
+        )
+        if db.config.db_type == "mysql":
+            cursor.fetchall()
+
+    cursor.close()
+    db.commit()
+
+
+def queries(tables: int, count: int, random_seed: int = 0) -> list[str]:
+    """A deterministic set of join and aggregate queries over the schema."""
+
+    rng = random.Random(random_seed)
+    result = []
+    for _ in range(count):
+        depth = rng.randint(1, min(tables, 3))
+        first = rng.randint(0, tables - depth)
+        joined = [table_name(i) for i in range(first, first + depth)]
+        query = f"SELECT t0.category, COUNT(*), SUM(t0.amount) FROM {joined[0]} t0"
+        for j, name in enumerate(joined[1:], start=1):
+            query += f" JOIN {name} t{j} ON t{j}.parent_id = t{j - 1}.id"
+        query += (
+            f" WHERE t0.category = {rng.randint(0, 99)}"
+            f" AND t0.label = 'label-{rng.randint(0, 999)}'"
+            " GROUP BY t0.category"
+        )
+        result.append(query)
+    return result
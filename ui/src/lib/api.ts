@@ -40,6 +40,9 @@ export interface QueryResult {
   query_time: number;
   query_error?: string;
   explain: string;
+  session_id?: string | null;
+  mode?: "preview" | "instrumented" | "estimate";
+  message?: string | null;
 }
 
 export const runQuery = async (query: string): Promise<QueryResult> => {
@@ -54,6 +57,30 @@ export const runQuery = async (query: string): Promise<QueryResult> => {
   return result;
 };
 
+export interface QueryRows {
+  headers: string[];
+  rows: any[][];
+  offset: number;
+  rowcount: number;
+  complete: boolean;
+}
+
+export const fetchQueryRows = async (
+  sessionId: string,
+  offset: number,
+  limit: number,
+): Promise<QueryRows> => {
+  const params = new URLSearchParams({
+    offset: offset.toString(),
+    limit: limit.toString(),
+  });
+  const response = await apiFetch(`/query/${sessionId}/rows?${params}`);
+  if (!response.ok) {
+    throw new Error("The query's results have expired. Run it again.");
+  }
+  return await response.json() as QueryRows;
+};
+
 export interface OptimizedQuery {
   query_advice: string;
   schema_advice: string;
@@ -61,16 +88,56 @@ export interface OptimizedQuery {
   schema_optimized: string;
   explanation: string;
   error: string | null;
+  omitted?: string[];
+  model?: string | null;
 }
 
-export const optimizeQuery = async (query: string): Promise<OptimizedQuery> => {
-  const response = await apiFetch("/optimize", {
+export type OptimizeEvent =
+  | { event: "token"; data: { text: string } }
+  | { event: "field"; data: { key: keyof OptimizedQuery; value: string | null } }
+  | { event: "advice"; data: OptimizedQuery };
+
+// EventSource only supports GET, so the SSE stream from /optimize/stream is
+// read and split into events by hand.
+export const optimizeQueryStream = async (
+  query: string,
+  onEvent: (event: OptimizeEvent) => void,
+): Promise<void> => {
+  const response = await apiFetch("/optimize/stream", {
     method: "POST",
     body: JSON.stringify({ query }),
     headers: {
       "Content-Type": "application/json",
     },
   });
-  const result = await response.json() as OptimizedQuery;
-  return result;
+  if (response.body === null) {
+    return;
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = "";
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) {
+      return;
+    }
+    buffer += value;
+    let boundary = buffer.indexOf("\n\n");
+    while (boundary !== -1) {
+      const message = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf("\n\n");
+
+      let event = "";
+      let data = "";
+      for (const line of message.split("\n")) {
+        if (line.startsWith("event: ")) {
+          event = line.slice("event: ".length);
+        } else if (line.startsWith("data: ")) {
+          data += line.slice("data: ".length);
+        }
+      }
+      onEvent({ event, data: JSON.parse(data) } as OptimizeEvent);
+    }
+  }
 };
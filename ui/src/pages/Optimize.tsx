@@ -6,7 +6,16 @@ import { Button } from "@/components/ui/button";
 import { Code, FastForward, Zap } from "lucide-react";
 import CopyButton from "@/components/CopyButton";
 import { format } from "sql-formatter";
-import { type OptimizedQuery, optimizeQuery as optimizeQueryAPI } from "@/lib/api";
+import { type OptimizedQuery, optimizeQueryStream } from "@/lib/api";
+
+const emptyOptimizedQuery: OptimizedQuery = {
+  query_advice: "",
+  schema_advice: "",
+  query_optimized: "",
+  schema_optimized: "",
+  explanation: "",
+  error: null,
+};
 
 const optimizedQueryText = (optimizedQuery: OptimizedQuery): string => {
   let resultString = "";
@@ -63,6 +72,7 @@ export default function Optimize(): ReactElement {
   ]);
 
   const [loading, setLoading] = useState(false);
+  const [streamedText, setStreamedText] = useState("");
 
   const onOptimizeFormat = (): void => {
     const formattedQuery = format(optimizeQuery);
@@ -75,8 +85,20 @@ export default function Optimize(): ReactElement {
         return;
       }
       setLoading(true);
-      const response = await optimizeQueryAPI(optimizeQuery);
-      setOptimizedQuery(response);
+      setStreamedText("");
+      // Fill in each part of the advice as soon as the model finishes it.
+      let partial = { ...emptyOptimizedQuery };
+      setOptimizedQuery(partial);
+      await optimizeQueryStream(optimizeQuery, (message) => {
+        if (message.event === "token") {
+          setStreamedText((text) => text + message.data.text);
+        } else if (message.event === "field") {
+          partial = { ...partial, [message.data.key]: message.data.value };
+          setOptimizedQuery(partial);
+        } else {
+          setOptimizedQuery(message.data);
+        }
+      });
       setLoading(false);
     })();
   };
@@ -126,10 +148,14 @@ export default function Optimize(): ReactElement {
           </Button>
         </div>
         <div className="h-[40vh] overflow-auto">
-          {loading ? (
+          {loading && streamedText === "" ? (
             <p className="text-sm text-muted-foreground w-full text-center">
               Optimizing...
             </p>
+          ) : loading && optimizedQuery?.query_advice === "" ? (
+            <pre className="text-sm text-muted-foreground whitespace-pre-wrap p-2">
+              {streamedText}
+            </pre>
           ) : optimizedQuery !== null ? (
             <>
               <TabsContent value="query">
@@ -174,7 +200,11 @@ export default function Optimize(): ReactElement {
               <TabsContent value="explanation">
                 <CodeEditor
                   value={
-                    optimizedQuery.explanation ?? "(No Explanation Available)"
+                    (optimizedQuery.explanation ?? "(No Explanation Available)") +
+                    (optimizedQuery.omitted?.length
+                      ? "\n\nLeft out of the prompt to fit the model's context:\n" +
+                        optimizedQuery.omitted.map((item) => `- ${item}`).join("\n")
+                      : "")
                   }
                   data-color-mode="light"
                   className="bg-muted rounded-md h-[30vh]"
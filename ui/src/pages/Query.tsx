@@ -5,10 +5,12 @@ import { Button } from "@/components/ui/button";
 import CopyButton from "@/components/CopyButton";
 import { Code, FastForward, Play } from "lucide-react";
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs";
-import { runQuery } from "@/lib/api";
+import { fetchQueryRows, runQuery } from "@/lib/api";
 import QueryResultTable from "@/components/QueryResultTable";
 import { useStore } from "@/lib/store";
 
+const PAGE_SIZE = 100;
+
 export default function Query(): ReactElement {
   const [query, setQuery] = useStore((state) => [state.query, state.setQuery]);
   const addQueryToHistory = useStore((state) => state.addQueryHistory);
@@ -21,6 +23,8 @@ export default function Query(): ReactElement {
     state.setQueryResult,
   ]);
   const [loading, setLoading] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [moreError, setMoreError] = useState<string | null>(null);
 
   const onFormat = (): void => {
     const formattedQuery = format(query);
@@ -31,12 +35,42 @@ export default function Query(): ReactElement {
     setLoading(true);
     void (async () => {
       const response = await runQuery(query);
+      setMoreError(null);
       setResult(response);
       addQueryToHistory(query, response);
       setLoading(false);
     })();
   };
 
+  const hasMore =
+    result?.session_id != null &&
+    (result.rowcount === -1 || result.results.length < result.rowcount);
+
+  const onLoadMore = (): void => {
+    if (result?.session_id == null) return;
+    setLoadingMore(true);
+    void (async () => {
+      try {
+        const page = await fetchQueryRows(
+          result.session_id as string,
+          result.results.length,
+          PAGE_SIZE,
+        );
+        setResult({
+          ...result,
+          results: [...result.results, ...page.rows],
+          // A short page means the kept rows have run out, either at the
+          // end of the result or at the server's cap.
+          session_id:
+            page.rows.length < PAGE_SIZE ? null : result.session_id,
+        });
+      } catch (e) {
+        setMoreError((e as Error).message);
+      }
+      setLoadingMore(false);
+    })();
+  };
+
   const onOptimize = (): void => {
     setOptimizeQuery(query);
     setActiveTab("optimize");
@@ -88,7 +122,30 @@ export default function Query(): ReactElement {
             <TabsContent value="result">
               {result !== null && result !== undefined ? (
                 result.query_error === null ? (
-                  <QueryResultTable queryResult={result} />
+                  <>
+                    {result.message && (
+                      <p className="text-sm text-muted-foreground text-center w-full my-2">
+                        {result.message}
+                      </p>
+                    )}
+                    <QueryResultTable queryResult={result} />
+                    {hasMore && (
+                      <div className="flex flex-col items-center gap-1 my-2">
+                        <Button
+                          variant="outline"
+                          onClick={onLoadMore}
+                          disabled={loadingMore}
+                        >
+                          {loadingMore ? "Loading..." : "Load more"}
+                        </Button>
+                        {moreError !== null && (
+                          <p className="text-sm text-destructive">
+                            {moreError}
+                          </p>
+                        )}
+                      </div>
+                    )}
+                  </>
                 ) : (
                   <div className="text-center w-full px-4">
                     <p className="text-muted-foreground">